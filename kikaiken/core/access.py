@@ -0,0 +1,92 @@
+import os
+
+from nonebot import get_driver, logger
+
+from kikaiken.core.data_manager import list_access, add_access, remove_access
+
+# 是否只响应白名单中的群聊，默认关闭，开启前需要先用 whitelist add 添加群聊
+GROUP_WHITELIST_ENABLED = os.getenv("GROUP_WHITELIST_ENABLED", "false").lower() == "true"
+
+GROUP_WHITELIST = "group_whitelist"
+USER_BLACKLIST = "user_blacklist"
+
+
+class AccessFilter:
+    """
+    访问控制过滤器
+
+    群聊白名单和用户黑名单常驻内存，每个事件只需要两次集合查找就能决定是否丢弃，
+    名单的修改先写入数据库，成功后再同步到内存。超级用户不受名单限制。
+    """
+    whitelist_enabled: bool
+    group_whitelist: set[int]
+    user_blacklist: set[int]
+
+    def __init__(self, whitelist_enabled: bool = GROUP_WHITELIST_ENABLED):
+        self.whitelist_enabled = whitelist_enabled
+        self.group_whitelist = set()
+        self.user_blacklist = set()
+        self._superusers: set[int] = set()
+        self.rejected_users = 0
+        self.rejected_groups = 0
+
+    def stats(self) -> dict:
+        return {
+            "group_whitelist": len(self.group_whitelist),
+            "user_blacklist": len(self.user_blacklist),
+            "rejected_users": self.rejected_users,
+            "rejected_groups": self.rejected_groups,
+        }
+
+    async def load(self):
+        """
+        从数据库加载名单
+        """
+        self._superusers = {int(uid) for uid in get_driver().config.superusers if uid.isdigit()}
+        self.group_whitelist = set(await list_access(GROUP_WHITELIST) or [])
+        self.user_blacklist = set(await list_access(USER_BLACKLIST) or [])
+        logger.info(f"已加载 {len(self.group_whitelist)} 个白名单群聊和 {len(self.user_blacklist)} 个黑名单用户")
+        if self.whitelist_enabled and not self.group_whitelist:
+            logger.warning("群聊白名单已启用但名单为空，所有群聊消息都会被忽略，请使用 whitelist add 添加群聊，"
+                           "或设置 GROUP_WHITELIST_ENABLED=false")
+
+    def allow(self, user_id: int | None, group_id: int | None) -> bool:
+        """
+        判断是否处理来自该用户和群聊的事件
+        """
+        if user_id in self._superusers:
+            return True
+        if user_id in self.user_blacklist:
+            self.rejected_users += 1
+            return False
+        if group_id is not None and self.whitelist_enabled and group_id not in self.group_whitelist:
+            self.rejected_groups += 1
+            return False
+        return True
+
+    async def add_group(self, group_id: int) -> bool:
+        if not await add_access(GROUP_WHITELIST, group_id):
+            return False
+        self.group_whitelist.add(group_id)
+        return True
+
+    async def remove_group(self, group_id: int) -> bool:
+        if not await remove_access(GROUP_WHITELIST, group_id):
+            return False
+        self.group_whitelist.discard(group_id)
+        return True
+
+    async def block_user(self, user_id: int) -> bool:
+        if not await add_access(USER_BLACKLIST, user_id):
+            return False
+        self.user_blacklist.add(user_id)
+        return True
+
+    async def unblock_user(self, user_id: int) -> bool:
+        if not await remove_access(USER_BLACKLIST, user_id):
+            return False
+        self.user_blacklist.discard(user_id)
+        return True
+
+
+access_filter = AccessFilter()
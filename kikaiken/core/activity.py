@@ -0,0 +1,213 @@
+import asyncio
+import datetime
+import os
+
+from nonebot import logger
+from sqlalchemy import select, update, bindparam
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from kikaiken.core.data_manager import find_users_by_qids
+from kikaiken.core.db_connect import get_engine, get_read_engine
+from kikaiken.core.models.db_model import KikaikenUser, KikaikenActivityBitmap
+from kikaiken.core.user_manager import user_cache
+
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv("ACTIVITY_FLUSH_INTERVAL", "60"))  # 活跃状态写入数据库的间隔，单位秒
+ACTIVITY_KEEP_DAYS = int(os.getenv("ACTIVITY_KEEP_DAYS", "35"))  # 内存中保留的活跃位图天数
+
+_update_activity = update(KikaikenUser).where(KikaikenUser.qid == bindparam("b_qid")).values(
+    last_activity_date=bindparam("b_date"))
+
+
+def _set_bit(bitmap: bytearray, index: int):
+    byte = index >> 3
+    if byte >= len(bitmap):
+        bitmap.extend(bytes(byte + 1 - len(bitmap)))
+    bitmap[byte] |= 1 << (index & 7)
+
+
+def _to_int(bitmap: bytes | None) -> int:
+    return int.from_bytes(bitmap, "little") if bitmap else 0
+
+
+def _from_int(value: int) -> bytearray:
+    return bytearray(value.to_bytes((value.bit_length() + 7) // 8, "little"))
+
+
+class ActivityTracker:
+    """
+    用户活跃记录
+
+    每个用户每天只有第一次活跃会被记下，之后的消息只需要一次集合查找；
+    记下的用户定期通过一次批量 UPDATE 写入 last_activity_date，同时写入当天的活跃位图。
+    位图按 kikaiken_user.id 编号，日活、月活和留存都可以直接由位图计算，不需要扫描用户表。
+    启动时没能读到的位图会在第一次写入前从数据库读出并按位或合并，不会覆盖已有的数据；
+    还没有注册的用户会保留到当天结束，注册之后在下一次写入时补上。
+    """
+    flush_interval: float
+
+    def __init__(self, flush_interval: float = ACTIVITY_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._day = datetime.date.today()
+        self._seen: set[int] = set()  # 当天已经记录过的用户
+        self._dirty: dict[datetime.date, set[int]] = {}  # 日期 -> 还没有写入数据库的用户
+        self._bitmaps: dict[datetime.date, bytearray] = {}
+        self._synced: set[datetime.date] = set()  # 内存中的位图已经包含数据库中数据的日期
+        self._task: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+
+    def touch(self, qid: int):
+        """
+        记录一次用户活跃
+        """
+        today = datetime.date.today()
+        if today != self._day:
+            self._day = today
+            self._seen = set()
+        if qid in self._seen:
+            return
+        self._seen.add(qid)
+        self._dirty.setdefault(today, set()).add(qid)
+
+    async def start(self):
+        await self._load_bitmaps(datetime.date.today() - datetime.timedelta(days=ACTIVITY_KEEP_DAYS - 1))
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def _load_bitmaps(self, since: datetime.date):
+        query = select(KikaikenActivityBitmap.day, KikaikenActivityBitmap.bitmap).where(
+            KikaikenActivityBitmap.day >= since)
+        try:
+            async with get_read_engine().connect() as conn:
+                result = await conn.execute(query)
+                for row in result.fetchall():
+                    self._bitmaps[row.day] = bytearray(row.bitmap)
+        except Exception as e:
+            logger.error(f"读取活跃位图失败，将在写入时合并：{e}")
+            return
+        today = datetime.date.today()
+        self._synced.update(since + datetime.timedelta(days=offset) for offset in range((today - since).days + 1))
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        """
+        把记下的活跃用户写入数据库
+        """
+        async with self._lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+            try:
+                retry = await self._write(dirty)
+            except Exception as e:
+                logger.error(f"写入活跃记录失败：{e}")
+                retry = dirty
+            for day, qids in retry.items():
+                self._dirty.setdefault(day, set()).update(qids)
+            self._prune()
+
+    async def _merge_stored(self, conn, day: datetime.date):
+        """
+        把数据库中已有的位图按位或合并到内存中
+        """
+        query = select(KikaikenActivityBitmap.bitmap).where(KikaikenActivityBitmap.day == day)
+        stored = (await conn.execute(query)).scalar()
+        if stored:
+            self._bitmaps[day] = _from_int(_to_int(stored) | _to_int(self._bitmaps.get(day)))
+        self._synced.add(day)
+
+    async def _write(self, dirty: dict[datetime.date, set[int]]) -> dict[datetime.date, set[int]]:
+        """
+        写入活跃记录，返回需要在下一次写入时重试的用户
+        """
+        users = await find_users_by_qids({qid for qids in dirty.values() for qid in qids})
+        today = datetime.date.today()
+        params = []
+        changed = []
+        unresolved = {}
+        for day, qids in dirty.items():
+            bitmap = self._bitmaps.setdefault(day, bytearray())
+            for qid in qids:
+                if (user := users.get(qid)) is None:
+                    # 还没有创建的用户暂不统计，当天注册之后会在下一次写入时补上
+                    if day == today:
+                        unresolved.setdefault(day, set()).add(qid)
+                    continue
+                _set_bit(bitmap, user.id)
+                params.append({"b_qid": qid, "b_date": day})
+            changed.append(day)
+        if not params:
+            return unresolved
+        upsert = sqlite_insert(KikaikenActivityBitmap).values(
+            day=bindparam("b_day"), bitmap=bindparam("b_bitmap"), active_count=bindparam("b_count"))
+        upsert = upsert.on_conflict_do_update(index_elements=["day"], set_={
+            "bitmap": upsert.excluded.bitmap, "active_count": upsert.excluded.active_count})
+        async with get_engine().begin() as conn:
+            for day in changed:
+                if day not in self._synced:
+                    await self._merge_stored(conn, day)
+            await conn.execute(_update_activity, params)
+            await conn.execute(upsert, [
+                {"b_day": day, "b_bitmap": bytes(self._bitmaps[day]),
+                 "b_count": _to_int(self._bitmaps[day]).bit_count()} for day in changed
+            ])
+        for param in params:
+            user_cache.invalidate(param["b_qid"])
+        logger.debug(f"已写入 {len(params)} 条活跃记录")
+        return unresolved
+
+    def _prune(self):
+        oldest = datetime.date.today() - datetime.timedelta(days=ACTIVITY_KEEP_DAYS - 1)
+        for day in [day for day in self._bitmaps if day < oldest]:
+            del self._bitmaps[day]
+        self._synced = {day for day in self._synced if day >= oldest}
+
+    async def _bitmap(self, day: datetime.date) -> int:
+        if day not in self._bitmaps:
+            query = select(KikaikenActivityBitmap.bitmap).where(KikaikenActivityBitmap.day == day)
+            async with get_read_engine().connect() as conn:
+                result = await conn.execute(query)
+                bitmap = result.scalar()
+            return _to_int(bitmap)
+        return _to_int(self._bitmaps[day])
+
+    async def dau(self, day: datetime.date | None = None) -> int:
+        """
+        日活跃用户数
+        """
+        return (await self._bitmap(day or datetime.date.today())).bit_count()
+
+    async def active_users(self, end: datetime.date | None = None, days: int = 30) -> int:
+        """
+        截止到 end 的 days 天内的活跃用户数，days 为 30 时即为月活
+        """
+        end = end or datetime.date.today()
+        merged = 0
+        for offset in range(days):
+            merged |= await self._bitmap(end - datetime.timedelta(days=offset))
+        return merged.bit_count()
+
+    async def mau(self, end: datetime.date | None = None) -> int:
+        return await self.active_users(end, 30)
+
+    async def retention(self, cohort_day: datetime.date, day: datetime.date) -> float:
+        """
+        在 cohort_day 活跃的用户中，在 day 仍然活跃的比例
+        """
+        cohort = await self._bitmap(cohort_day)
+        total = cohort.bit_count()
+        if not total:
+            return 0.0
+        return (cohort & await self._bitmap(day)).bit_count() / total
+
+
+activity_tracker = ActivityTracker()
@@ -0,0 +1,98 @@
+import asyncio
+import os
+from typing import Coroutine
+
+from nonebot import logger
+
+TALK_QUIET_WINDOW = float(os.getenv("TALK_QUIET_WINDOW", "1.5"))  # 用户停止输入多久后才开始回复，单位秒
+TALK_MAX_PENDING = int(os.getenv("TALK_MAX_PENDING", "8"))  # 每个用户最多合并的消息条数
+
+
+class _UserInput:
+    pending: list[str]  # 还没有开始回复的消息
+    answering: list[str]  # 正在回复的消息
+    version: int
+    generation: asyncio.Task | None
+
+    def __init__(self):
+        self.pending = []
+        self.answering = []
+        self.version = 0
+        self.generation = None
+
+
+class InputAggregator:
+    """
+    按用户合并连续发送的消息
+
+    每条消息到达后等待一个静默窗口，窗口内又有新消息时只有最后一条消息的处理流程会继续，
+    并把这段时间内的所有消息合并成一个提示词；回复生成期间收到新消息时，正在进行的生成会被取消，
+    它对应的消息会和新消息一起重新合并。
+    """
+    quiet_window: float
+    max_pending: int
+
+    def __init__(self, quiet_window: float = TALK_QUIET_WINDOW, max_pending: int = TALK_MAX_PENDING):
+        self.quiet_window = quiet_window
+        self.max_pending = max_pending
+        self._inputs: dict[int, _UserInput] = {}
+
+    def __len__(self) -> int:
+        return len(self._inputs)
+
+    async def collect(self, uid: int, content: str) -> str | None:
+        """
+        提交一条消息，返回合并后的提示词；这条消息已经被之后的消息合并时返回 None
+        """
+        state = self._inputs.setdefault(uid, _UserInput())
+        if state.generation is not None and not state.generation.done():
+            # 用户还在补充内容，之前的回答作废，对应的消息重新放回待合并列表
+            state.generation.cancel()
+            state.pending = state.answering + state.pending
+            state.answering = []
+        state.pending.append(content)
+        if len(state.pending) > self.max_pending:
+            logger.debug(f"用户 {uid} 的待处理消息过多，丢弃最早的 {len(state.pending) - self.max_pending} 条")
+            del state.pending[:-self.max_pending]
+        state.version += 1
+        version = state.version
+        await asyncio.sleep(self.quiet_window)
+        if state.version != version:
+            return None
+        prompt = "\n".join(state.pending)
+        state.answering, state.pending = state.pending, []
+        return prompt
+
+    async def run(self, uid: int, coro: Coroutine) -> bool:
+        """
+        执行一次回复生成，被新消息打断时返回 False
+        """
+        state = self._inputs.setdefault(uid, _UserInput())
+        task = asyncio.create_task(coro)
+        state.generation = task
+        try:
+            await task
+            return True
+        except asyncio.CancelledError:
+            # 只吞掉被新消息打断的取消，调用方自身被取消时继续向上抛出
+            if task.cancelled() and not asyncio.current_task().cancelling():
+                return False
+            raise
+        finally:
+            if state.generation is task:
+                state.generation = None
+                self.done(uid)
+
+    def done(self, uid: int):
+        """
+        结束一次合并后的处理，没有进入 run 的提示词（例如被限流）也必须调用，否则用户的状态不会被清理
+        """
+        state = self._inputs.get(uid)
+        if state is None or state.generation is not None:
+            return
+        state.answering = []
+        if not state.pending:
+            self._inputs.pop(uid, None)
+
+
+input_aggregator = InputAggregator()
@@ -1,12 +1,24 @@
 import datetime
+import os
+from typing import Iterable
 
 from nonebot import logger
-from sqlalchemy import Column, Integer, String, select, insert, delete, Boolean, Date, update, DateTime, desc
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import select, insert, delete, desc, bindparam, func, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
-from kikaiken.core.db_connect import get_engine
+from kikaiken.core.db_connect import get_engine, get_read_engine
+from kikaiken.core.economy import economy, InsufficientCoinError
+from kikaiken.core.models.db_model import Base, KikaikenUserRecord, ConfigPersistence, LLMAPIKey, KikaikenUser, \
+    KikaikenAccessList
+from kikaiken.core.models.message_model import PageSource
+from kikaiken.core.user_manager import user_scope, record_writer, user_cache, CHUNK_SIZE
+from kikaiken.utils.cache import AsyncLRUCache
 
-Base = declarative_base()
+RECORD_COUNT_CACHE_TTL = float(os.getenv("RECORD_COUNT_CACHE_TTL", "30"))
+# 用户记录总数的缓存，翻页时不需要每次都重新计数
+record_count_cache = AsyncLRUCache(maxsize=1024, ttl=RECORD_COUNT_CACHE_TTL)
+# 每个用户已经定位过的翻页位置，和总数缓存同样的时间，多次执行 record -p 翻页时可以直接从上一页接着读
+record_cursor_cache = AsyncLRUCache(maxsize=1024, ttl=RECORD_COUNT_CACHE_TTL)
 
 
 async def auto_create_check():
@@ -18,33 +30,24 @@ async def auto_create_check():
         await conn.run_sync(Base.metadata.create_all)
 
 
-class KikaikenUserRecord(Base):
-    __tablename__ = "kikaiken_user_record"
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    qid = Column(Integer, nullable=False)
-    record_time = Column(DateTime, nullable=False, default=datetime.datetime.now())
-    content = Column(String(255), nullable=False)
-
-
 async def add_record(qid: int, content: str):
-    engine = get_engine()
-    add = insert(KikaikenUserRecord).values(qid=qid, content=content)
+    """
+    添加用户记录，记录时间以调用时刻为准，实际写入由 record_writer 异步完成
+    """
     try:
-        async with engine.begin() as conn:
-            await conn.execute(add)
-            await conn.commit()
-            return True
+        await record_writer.put({"qid": qid, "record_time": datetime.datetime.now(), "content": content})
+        return True
     except Exception as e:
         logger.error(f"添加失败：{e}")
         return False
 
 
 async def query_record(qid: int, count: int):
-    engine = get_engine()
+    engine = get_read_engine()
     query = select(KikaikenUserRecord).where(KikaikenUserRecord.qid == qid).order_by(
         desc(KikaikenUserRecord.record_time)).limit(count)
     try:
-        async with engine.begin() as conn:
+        async with engine.connect() as conn:
             result = await conn.execute(query)
             return result.fetchall()
     except Exception as e:
@@ -52,27 +55,83 @@ async def query_record(qid: int, count: int):
         return False
 
 
-class ConfigPersistence(Base):
+class RecordPageSource(PageSource):
     """
-    配置持久化表，用于保存一些全局设置
+    用户记录的分页数据源，按 (record_time, id) 从新到旧排列
+
+    读取某一页时先在索引上定位这一页的起点，再用键集分页只读取这一页的行；
+    已经读取过的页的终点按用户保存在 record_cursor_cache 中，之后的命令从上一页的终点继续读取，
+    只有第一次直接跳到很远的页时才需要在索引上跳过前面的行。
     """
-    __tablename__ = "config_persistence"
-    id = Column(Integer, primary_key=True)
-    key = Column(String, unique=True)
-    value = Column(String)
+    qid: int
+
+    def __init__(self, qid: int):
+        self.qid = qid
+        cursors = record_cursor_cache.get(qid)
+        if cursors is None:
+            cursors = {}
+            record_cursor_cache.set(qid, cursors)
+        self._cursors: dict[int, tuple[datetime.datetime, int]] = cursors  # 行号 -> 该行之前一行的 (record_time, id)
+
+    def _ordered(self, *columns):
+        return select(*columns).where(KikaikenUserRecord.qid == self.qid).order_by(
+            desc(KikaikenUserRecord.record_time), desc(KikaikenUserRecord.id))
+
+    def _after(self, query, cursor: tuple[datetime.datetime, int] | None):
+        if cursor is None:
+            return query
+        return query.where(tuple_(KikaikenUserRecord.record_time, KikaikenUserRecord.id) < tuple_(*cursor))
+
+    async def count(self) -> int:
+        return await record_count_cache.get_or_load(self.qid, self._count)
+
+    async def _count(self) -> int:
+        query = select(func.count()).select_from(KikaikenUserRecord).where(KikaikenUserRecord.qid == self.qid)
+        async with get_read_engine().connect() as conn:
+            result = await conn.execute(query)
+            return result.scalar()
+
+    async def _seek(self, conn, start: int) -> tuple[datetime.datetime, int] | None:
+        """
+        定位第 start 行之前一行的位置，只访问索引，不读取记录内容
+        """
+        known = max((row for row in self._cursors if row <= start), default=0)
+        if known == start:
+            return self._cursors.get(start)
+        query = self._after(self._ordered(KikaikenUserRecord.record_time, KikaikenUserRecord.id),
+                            self._cursors.get(known))
+        result = await conn.execute(query.offset(start - known - 1).limit(1))
+        row = result.fetchone()
+        if row is None:
+            return None
+        self._cursors[start] = (row.record_time, row.id)
+        return self._cursors[start]
+
+    async def fetch(self, page_num: int, rows_per_page: int) -> list[str]:
+        start = (page_num - 1) * rows_per_page
+        async with get_read_engine().connect() as conn:
+            cursor = await self._seek(conn, start) if start else None
+            if start and cursor is None:
+                return []
+            query = self._after(self._ordered(KikaikenUserRecord.record_time, KikaikenUserRecord.content,
+                                              KikaikenUserRecord.id), cursor)
+            result = await conn.execute(query.limit(rows_per_page))
+            rows = result.fetchall()
+        if rows:
+            self._cursors[start + len(rows)] = (rows[-1].record_time, rows[-1].id)
+        return [f"{row.record_time:%Y-%m-%d %H:%M:%S} {row.content}" for row in rows]
 
 
 async def get_config(key: str):
     """
     获取配置
     """
-    engine = get_engine()
+    engine = get_read_engine()
     query = select(ConfigPersistence).where(ConfigPersistence.key == key)
     try:
-        async with engine.begin() as conn:
-            await conn.execute(query)
-            result: ConfigPersistence = await conn.fetchone()
-            return result
+        async with engine.connect() as conn:
+            result = await conn.execute(query)
+            return result.fetchone()
     except Exception as e:
         logger.error(f"查询失败：{e}")
         return None
@@ -80,40 +139,27 @@ async def get_config(key: str):
 
 async def set_config(key: str, value: str):
     """
-    设置配置
+    设置配置，配置项不存在时会新建
     """
-    engine = get_engine()
-    update_query = update(ConfigPersistence).where(ConfigPersistence.key == key).values(value=value)
     try:
-        async with engine.begin() as conn:
-            await conn.execute(update_query)
-            await conn.commit()
-            return True
+        async with user_scope() as scope:
+            await scope.set_config(key, value)
+        return True
     except Exception as e:
         logger.error(f"设置失败：{e}")
         return False
 
 
-class LLMAPIKey(Base):
-    __tablename__ = "llm_apikey"
-    id = Column(Integer, primary_key=True)
-    model_type = Column(String)
-    model_name = Column(String)
-    api_key = Column(String)
-    notice = Column(String)
-
-
 async def list_keys():
     """
     列出所有key
     """
-    engine = get_engine()
+    engine = get_read_engine()
     query = select(LLMAPIKey)
     try:
-        async with engine.begin() as conn:
-            await conn.execute(query)
-            result: list[LLMAPIKey] = await conn.fetchall()
-            return result
+        async with engine.connect() as conn:
+            result = await conn.execute(query)
+            return result.fetchall()
     except Exception as e:
         logger.error(f"查询失败：{e}")
         return None
@@ -156,117 +202,198 @@ async def delete_key(key_id: int):
         return False
 
 
-class KikaikenUser(Base):
-    __tablename__ = "kikaiken_user"
-    id = Column(Integer, primary_key=True)
-    qid = Column(Integer)
-    nickname = Column(String)
-    permission_group = Column(Integer)
-    is_subscribed = Column(Boolean)  # 是否启用订阅服务
-    join_date = Column(Date)
-    lucky = Column(Integer)  # 幸运值，这个值也会影响一些其他的逻辑
-    last_sign_date = Column(Date)
-    coin = Column(Integer)
-    last_activity_date = Column(Date)
-    backpack = Column(String)
+async def list_access(list_type: str):
+    """
+    获取访问控制名单中的所有对象
+    """
+    engine = get_read_engine()
+    query = select(KikaikenAccessList.target_id).where(KikaikenAccessList.list_type == list_type)
+    try:
+        async with engine.connect() as conn:
+            result = await conn.execute(query)
+            return [row.target_id for row in result.fetchall()]
+    except Exception as e:
+        logger.error(f"查询失败：{e}")
+        return None
 
 
-async def create_user(qid: int, nickname: str = None, permission_group: int = 0, is_subscribed: bool = True,
-                      lucky: int = 0, last_sign_date: Date = None, coin: int = 0,
-                      last_activity_date: Date = None):
+async def add_access(list_type: str, target_id: int):
     """
-    创建用户
+    把对象加入访问控制名单，已经在名单中时不做任何事
     """
     engine = get_engine()
-    add = insert(KikaikenUser).values(
-        qid=qid,
-        nickname=nickname,
-        permission_group=permission_group,
-        is_subscribed=is_subscribed,
-        join_date=datetime.datetime.now(),
-        lucky=lucky,
-        last_sign_date=last_sign_date,
-        coin=coin,
-        last_activity_date=last_activity_date
-    )
+    add = sqlite_insert(KikaikenAccessList).values(
+        list_type=list_type,
+        target_id=target_id,
+        created_at=datetime.datetime.now(),
+    ).on_conflict_do_nothing(index_elements=["list_type", "target_id"])
     try:
         async with engine.begin() as conn:
             await conn.execute(add)
-            await conn.commit()
             return True
     except Exception as e:
         logger.error(f"添加失败：{e}")
         return False
 
 
-async def find_user_by_qid(qid: int):
+async def remove_access(list_type: str, target_id: int):
     """
-    通过qq号查找用户
+    把对象移出访问控制名单
     """
     engine = get_engine()
-    query = select(KikaikenUser).where(KikaikenUser.qid == qid)
+    delete_query = delete(KikaikenAccessList).where(KikaikenAccessList.list_type == list_type,
+                                                    KikaikenAccessList.target_id == target_id)
     try:
         async with engine.begin() as conn:
-            await conn.execute(query)
-            result: KikaikenUser = await conn.fetchone()
-            return result
+            await conn.execute(delete_query)
+            return True
+    except Exception as e:
+        logger.error(f"删除失败：{e}")
+        return False
+
+
+async def create_user(qid: int, nickname: str = None, permission_group: int = 0, is_subscribed: bool = True,
+                      lucky: int = 0, last_sign_date: datetime.date = None, coin: int = 0,
+                      last_activity_date: datetime.date = None):
+    """
+    创建用户
+    """
+    try:
+        async with user_scope() as scope:
+            await scope.create_user(qid, nickname, permission_group, is_subscribed, lucky, last_sign_date, coin,
+                                    last_activity_date)
+        return True
+    except Exception as e:
+        logger.error(f"添加失败：{e}")
+        return False
+
+
+async def find_user_by_qid(qid: int):
+    """
+    通过qq号查找用户，优先从 user_cache 中读取；
+    coin 列由 economy 每隔 ECONOMY_FLUSH_INTERVAL 秒写回，需要准确的余额时使用 economy.balance
+    """
+    try:
+        return await user_cache.get_or_load(qid, lambda: _load_user(qid))
     except Exception as e:
         logger.error(f"查询失败：{e}")
         return None
 
 
-async def set_nickname(qid: int, nickname: str):
+async def _load_user(qid: int):
+    engine = get_read_engine()
+    query = select(KikaikenUser).where(KikaikenUser.qid == qid)
+    async with engine.connect() as conn:
+        result = await conn.execute(query)
+        return result.fetchone()
+
+
+async def find_users_by_qids(qids: Iterable[int]) -> dict:
+    """
+    批量查找用户，返回 qq号 -> 用户 的字典，已缓存的用户不会再查询数据库
+    """
+    users = {}
+    missing = []
+    for qid in dict.fromkeys(qids):
+        if qid in user_cache:
+            user = user_cache.get(qid)
+            if user is not None:
+                users[qid] = user
+        else:
+            missing.append(qid)
+    if not missing:
+        return users
+    engine = get_read_engine()
+    query = select(KikaikenUser).where(KikaikenUser.qid.in_(bindparam("qids", expanding=True)))
+    try:
+        async with engine.connect() as conn:
+            for i in range(0, len(missing), CHUNK_SIZE):
+                result = await conn.execute(query, {"qids": missing[i:i + CHUNK_SIZE]})
+                users.update((row.qid, row) for row in result.fetchall())
+    except Exception as e:
+        logger.error(f"查询失败：{e}")
+        return users
+    for qid in missing:
+        user_cache.set(qid, users.get(qid))
+    return users
+
+
+async def create_users_many(qids: Iterable[int], permission_group: int = 0, is_subscribed: bool = True,
+                            coin: int = 0) -> int:
     """
-    设置用户昵称
+    批量创建用户，已存在的用户会被跳过，返回实际创建的数量
     """
-    engine = get_engine()
-    update_query = update(KikaikenUser).where(KikaikenUser.qid == qid).values(nickname=nickname)
     try:
-        async with engine.begin() as conn:
-            await conn.execute(update_query)
-            await conn.commit()
+        async with user_scope() as scope:
+            return await scope.create_users(qids, permission_group, is_subscribed, coin)
+    except Exception as e:
+        logger.error(f"添加失败：{e}")
+        return 0
 
-            await add_record(qid, f"修改昵称为：{nickname}")
 
-            return True
+async def add_coin_many(coins: dict[int, int]):
+    """
+    批量增加用户硬币，coins 为 qq号 -> 硬币数量，不存在的用户会被跳过；
+    余额、流水和记录在同一个事务中写入
+    """
+    try:
+        async with user_scope() as scope:
+            balances = await economy.add_many(coins, "获得硬币", scope)
+            for qid in balances:
+                scope.add_record(qid, f"获得硬币：{coins[qid]}")
+        return True
     except Exception as e:
         logger.error(f"更新失败：{e}")
         return False
 
 
-async def set_permission_group(qid: int, permission_group: int):
+async def set_lucky_many(luckies: dict[int, int]):
     """
-    设置用户权限组
+    批量设置用户幸运值，luckies 为 qq号 -> 幸运值
     """
-    engine = get_engine()
-    update_query = update(KikaikenUser).where(KikaikenUser.qid == qid).values(permission_group=permission_group)
     try:
-        async with engine.begin() as conn:
-            await conn.execute(update_query)
-            await conn.commit()
+        async with user_scope() as scope:
+            await scope.set_luckies(luckies)
+        return True
+    except Exception as e:
+        logger.error(f"更新失败：{e}")
+        return False
 
-            await add_record(qid, f"权限组被修改为：{permission_group}")
 
-            return True
+async def set_nickname(qid: int, nickname: str):
+    """
+    设置用户昵称
+    """
+    try:
+        async with user_scope() as scope:
+            await scope.set_nickname(qid, nickname)
+        return True
     except Exception as e:
         logger.error(f"更新失败：{e}")
         return False
 
 
-async def enable_subscribe(qid: int):
+async def set_permission_group(qid: int, permission_group: int):
     """
-    启用订阅服务
+    设置用户权限组
     """
-    engine = get_engine()
-    update_query = update(KikaikenUser).where(KikaikenUser.qid == qid).values(is_subscribed=True)
     try:
-        async with engine.begin() as conn:
-            await conn.execute(update_query)
-            await conn.commit()
+        async with user_scope() as scope:
+            await scope.set_permission_group(qid, permission_group)
+        return True
+    except Exception as e:
+        logger.error(f"更新失败：{e}")
+        return False
 
-            await add_record(qid, "订阅服务已启用")
 
-            return True
+async def enable_subscribe(qid: int):
+    """
+    启用订阅服务
+    """
+    try:
+        async with user_scope() as scope:
+            await scope.set_subscribe(qid, True)
+        return True
     except Exception as e:
         logger.error(f"更新失败：{e}")
         return False
@@ -276,16 +403,10 @@ async def disable_subscribe(qid: int):
     """
     禁用订阅服务
     """
-    engine = get_engine()
-    update_query = update(KikaikenUser).where(KikaikenUser.qid == qid).values(is_subscribed=False)
     try:
-        async with engine.begin() as conn:
-            await conn.execute(update_query)
-            await conn.commit()
-
-            await add_record(qid, "订阅服务已禁用")
-
-            return True
+        async with user_scope() as scope:
+            await scope.set_subscribe(qid, False)
+        return True
     except Exception as e:
         logger.error(f"更新失败：{e}")
         return False
@@ -295,29 +416,23 @@ async def set_lucky(qid: int, lucky: int):
     """
     设置用户幸运值
     """
-    engine = get_engine()
-    update_query = update(KikaikenUser).where(KikaikenUser.qid == qid).values(lucky=lucky)
     try:
-        async with engine.begin() as conn:
-            await conn.execute(update_query)
-            await conn.commit()
-            return True
+        async with user_scope() as scope:
+            await scope.set_lucky(qid, lucky)
+        return True
     except Exception as e:
         logger.error(f"更新失败：{e}")
         return False
 
 
-async def set_sign_date(qid: int, sign_date: Date):
+async def set_sign_date(qid: int, sign_date: datetime.date):
     """
     设置用户签到日期
     """
-    engine = get_engine()
-    update_query = update(KikaikenUser).where(KikaikenUser.qid == qid).values(last_sign_date=sign_date)
     try:
-        async with engine.begin() as conn:
-            await conn.execute(update_query)
-            await conn.commit()
-            return True
+        async with user_scope() as scope:
+            await scope.set_sign_date(qid, sign_date)
+        return True
     except Exception as e:
         logger.error(f"更新失败：{e}")
         return False
@@ -327,13 +442,9 @@ async def set_coin(qid: int, coin: int):
     """
     设置用户硬币
     """
-    engine = get_engine()
-    update_query = update(KikaikenUser).where(KikaikenUser.qid == qid).values(coin=coin)
     try:
-        async with engine.begin() as conn:
-            await conn.execute(update_query)
-            await conn.commit()
-            return True
+        await economy.set(qid, coin)
+        return True
     except Exception as e:
         logger.error(f"更新失败：{e}")
         return False
@@ -343,16 +454,10 @@ async def add_coin(qid: int, coin: int):
     """
     增加用户硬币
     """
-    engine = get_engine()
-    update_query = update(KikaikenUser).where(KikaikenUser.qid == qid).values(coin=KikaikenUser.coin + coin)
     try:
-        async with engine.begin() as conn:
-            await conn.execute(update_query)
-            await conn.commit()
-
-            await add_record(qid, f"获得硬币：{coin}")
-
-            return True
+        await economy.add(qid, coin, "获得硬币")
+        await add_record(qid, f"获得硬币：{coin}")
+        return True
     except Exception as e:
         logger.error(f"更新失败：{e}")
         return False
@@ -360,18 +465,15 @@ async def add_coin(qid: int, coin: int):
 
 async def delete_coin(qid: int, coin: int):
     """
-    删除用户硬币
+    删除用户硬币，余额不足时不做修改并返回 False
     """
-    engine = get_engine()
-    update_query = update(KikaikenUser).where(KikaikenUser.qid == qid).values(coin=KikaikenUser.coin - coin)
     try:
-        async with engine.begin() as conn:
-            await conn.execute(update_query)
-            await conn.commit()
-
-            await add_record(qid, f"失去硬币：{coin}")
-
-            return True
+        await economy.consume(qid, coin, "失去硬币")
+        await add_record(qid, f"失去硬币：{coin}")
+        return True
+    except InsufficientCoinError:
+        logger.info(f"用户 {qid} 的硬币不足")
+        return False
     except Exception as e:
         logger.error(f"更新失败：{e}")
         return False
@@ -379,18 +481,15 @@ async def delete_coin(qid: int, coin: int):
 
 async def consume_coin(qid: int, coin: int):
     """
-    消费用户硬币
+    消费用户硬币，余额不足时不做修改并返回 False
     """
-    engine = get_engine()
-    update_query = update(KikaikenUser).where(KikaikenUser.qid == qid).values(coin=KikaikenUser.coin - coin)
     try:
-        async with engine.begin() as conn:
-            await conn.execute(update_query)
-            await conn.commit()
-
-            await add_record(qid, f"消费硬币：{coin}")
-
-            return True
+        await economy.consume(qid, coin, "消费硬币")
+        await add_record(qid, f"消费硬币：{coin}")
+        return True
+    except InsufficientCoinError:
+        logger.info(f"用户 {qid} 的硬币不足")
+        return False
     except Exception as e:
         logger.error(f"更新失败：{e}")
         return False
@@ -400,14 +499,10 @@ async def update_last_activity_date(qid: int):
     """
     更新用户最后活跃时间
     """
-    engine = get_engine()
-    update_query = update(KikaikenUser).where(KikaikenUser.qid == qid).values(
-        last_activity_date=datetime.datetime.now())
     try:
-        async with engine.begin() as conn:
-            await conn.execute(update_query)
-            await conn.commit()
-            return True
+        async with user_scope() as scope:
+            await scope.update_last_activity_date(qid)
+        return True
     except Exception as e:
         logger.error(f"更新失败：{e}")
         return False
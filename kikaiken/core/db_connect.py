@@ -2,20 +2,50 @@ import datetime
 import os
 
 from nonebot import logger
-from sqlalchemy import AsyncAdaptedQueuePool
+from sqlalchemy import AsyncAdaptedQueuePool, event
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine
 
 
 class KikaikenDatabase:
-    engine: AsyncEngine
+    engine: AsyncEngine  # 写连接，所有写操作都经过这里
+    read_engine: AsyncEngine  # 只读连接池，sqlite 模式下与写连接分离
 
-    def set_engine(self, engine: AsyncEngine):
+    def set_engine(self, engine: AsyncEngine, read_engine: AsyncEngine | None = None):
         self.engine = engine
+        self.read_engine = read_engine or engine
 
 
 kdb = KikaikenDatabase()
 
 
+def _sqlite_pragmas(readonly: bool) -> list[str]:
+    """
+    根据环境变量生成连接建立时需要执行的 PRAGMA 语句
+    """
+    pragmas = [
+        f"PRAGMA synchronous={os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')}",
+        f"PRAGMA mmap_size={int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))}",
+        f"PRAGMA cache_size={int(os.getenv('SQLITE_CACHE_SIZE', '-16000'))}",  # 负数表示以KB为单位
+        f"PRAGMA busy_timeout={int(os.getenv('SQLITE_BUSY_TIMEOUT', '5000'))}",
+    ]
+    if readonly:
+        pragmas.append("PRAGMA query_only=ON")
+    else:
+        pragmas.insert(0, "PRAGMA journal_mode=WAL")
+    return pragmas
+
+
+def _apply_pragmas(engine: AsyncEngine, readonly: bool):
+    pragmas = _sqlite_pragmas(readonly)
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def _(dbapi_connection, _connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+
 async def sqlite_connect():
     logger.info("- 初始化数据库连接")
     # 首先检查配置文件中是否包含对应的配置项，如果不存在则使用默认值
@@ -30,15 +60,39 @@ async def sqlite_connect():
             sqlite_path = f"kikaiken_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}.kbp"
     # 通过SQLAlchemy连接数据库
     logger.debug(f"当前使用的数据库文件为：{sqlite_path}")
-    engine = create_async_engine(
-        f"sqlite+aiosqlite:///{sqlite_path}",
-        poolclass=AsyncAdaptedQueuePool,
-        pool_size=5,
-        max_overflow=10,
-        pool_timeout=30,
-        pool_recycle=1800
-    )
-    kdb.set_engine(engine)
+    engine_mode = os.getenv("SQLITE_ENGINE_MODE", "wal")
+    if engine_mode == "pool":  # 旧的通用连接池模式，读写共用一个引擎
+        engine = create_async_engine(
+            f"sqlite+aiosqlite:///{sqlite_path}",
+            poolclass=AsyncAdaptedQueuePool,
+            pool_size=5,
+            max_overflow=10,
+            pool_timeout=30,
+            pool_recycle=1800
+        )
+        kdb.set_engine(engine)
+    else:  # sqlite 专用模式，单个写连接串行化所有写入，读操作走独立的只读连接池
+        logger.debug("数据库使用 WAL 模式，读写连接分离")
+        engine = create_async_engine(
+            f"sqlite+aiosqlite:///{sqlite_path}",
+            poolclass=AsyncAdaptedQueuePool,
+            pool_size=1,
+            max_overflow=0,
+            pool_timeout=int(os.getenv("SQLITE_WRITE_TIMEOUT", "30")),
+        )
+        _apply_pragmas(engine, readonly=False)
+        # 先建立一次写连接，确保数据库文件存在且已切换到 WAL 模式
+        async with engine.connect() as conn:
+            await conn.exec_driver_sql("SELECT 1")
+        read_engine = create_async_engine(
+            f"sqlite+aiosqlite:///{sqlite_path}",
+            poolclass=AsyncAdaptedQueuePool,
+            pool_size=int(os.getenv("SQLITE_READ_POOL_SIZE", "4")),
+            max_overflow=0,
+            pool_timeout=30,
+        )
+        _apply_pragmas(read_engine, readonly=True)
+        kdb.set_engine(engine, read_engine)
     logger.success("Done!")
 
 
@@ -46,5 +100,14 @@ def get_engine():
     return kdb.engine
 
 
+def get_read_engine():
+    """
+    获取只读引擎，只用于查询
+    """
+    return kdb.read_engine
+
+
 async def release_engine():
+    if kdb.read_engine is not kdb.engine:
+        await kdb.read_engine.dispose()
     await kdb.engine.dispose()
@@ -0,0 +1,272 @@
+import asyncio
+import bisect
+import datetime
+import os
+from typing import Iterable
+
+from nonebot import logger
+from sqlalchemy import select, insert, update, bindparam
+
+from kikaiken.core.db_connect import get_engine, get_read_engine
+from kikaiken.core.models.db_model import KikaikenUser, KikaikenCoinLedger
+from kikaiken.core.user_manager import user_cache, UserScope, CHUNK_SIZE
+from kikaiken.utils.batch_writer import BatchWriter
+
+ECONOMY_FLUSH_INTERVAL = float(os.getenv("ECONOMY_FLUSH_INTERVAL", "1"))  # 余额写回用户表的间隔，单位秒
+
+_find_coins = select(KikaikenUser.qid, KikaikenUser.coin).where(
+    KikaikenUser.qid.in_(bindparam("b_qids", expanding=True)))
+_set_coin = update(KikaikenUser).where(KikaikenUser.qid == bindparam("b_qid")).values(coin=bindparam("b_coin"))
+_add_coin = update(KikaikenUser).where(KikaikenUser.qid == bindparam("b_qid")).values(
+    coin=KikaikenUser.coin + bindparam("b_delta"))
+_insert_ledger = insert(KikaikenCoinLedger)
+
+
+class InsufficientCoinError(Exception):
+    """
+    余额不足
+    """
+
+
+def _check_amount(coin: int, allow_zero: bool = False):
+    # 负数会让增加变成扣除并绕过余额检查，所以增减的数量一律必须是正数
+    if coin < 0 or (coin == 0 and not allow_zero):
+        raise ValueError(f"硬币数量必须是正数：{coin}")
+
+
+class Economy:
+    """
+    硬币系统
+
+    启动时把所有用户的余额加载到内存中，之后内存中的余额就是准确的余额：
+    每次变动在内存中同步完成，不会被其他协程打断，因此扣款不会透支；
+    变动同时写入只追加的 kikaiken_coin_ledger 流水表（由 BatchWriter 批量写入），
+    改动过的余额定期写回 kikaiken_user.coin。排行榜用一个按 (-余额, qq号) 排序的列表维护，
+    查询名次只需要一次二分查找。
+
+    economy 是 kikaiken_user.coin 唯一的写入方，其他模块不应该直接修改这一列。
+    需要和其他修改一起提交的变动（例如签到）把 UserScope 传给 add_many，
+    余额和流水会在这个 scope 的事务中写入，事务回滚时内存中的余额也会还原。
+    """
+    flush_interval: float
+
+    def __init__(self, flush_interval: float = ECONOMY_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._balances: dict[int, int] = {}
+        self._ranking: list[tuple[int, int]] = []  # (-余额, qq号)，升序排列即为余额从高到低
+        self._dirty: set[int] = set()
+        self._task: asyncio.Task | None = None
+        self.ledger = BatchWriter(
+            KikaikenCoinLedger.__table__,
+            batch_size=int(os.getenv("LEDGER_BATCH_SIZE", "100")),
+            flush_interval=float(os.getenv("LEDGER_FLUSH_INTERVAL", "1.0")),
+        )
+
+    def __len__(self) -> int:
+        return len(self._balances)
+
+    async def start(self):
+        """
+        加载所有用户的余额，并启动流水写入和余额写回
+        """
+        async with get_read_engine().connect() as conn:
+            result = await conn.execute(select(KikaikenUser.qid, KikaikenUser.coin))
+            self._balances = {row.qid: row.coin or 0 for row in result.fetchall()}
+        self._ranking = sorted((-coin, qid) for qid, coin in self._balances.items())
+        logger.info(f"已加载 {len(self._balances)} 个用户的硬币余额")
+        self.ledger.start()
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+        await self.ledger.close()
+
+    async def _ensure(self, qid: int) -> bool:
+        """
+        确保用户的余额已经在内存中，启动之后新建的用户会在第一次使用时加载
+        """
+        existing, _ = await self._ensure_many([qid])
+        return qid in existing
+
+    async def _ensure_many(self, qids: Iterable[int],
+                           scope: UserScope | None = None) -> tuple[set[int], set[int]]:
+        """
+        确保一批用户的余额已经在内存中，缺少的余额用 IN 查询一次性加载，返回 (其中存在的用户, 本次新加载的用户)；
+        传入 scope 时通过它的连接查询，能读到同一个事务中刚创建的用户
+        """
+        qids = list(dict.fromkeys(qids))
+        missing = [qid for qid in qids if qid not in self._balances]
+        loaded = set()
+        if missing:
+            if scope is not None:
+                rows = await self._load(scope.conn, missing)
+            else:
+                async with get_read_engine().connect() as conn:
+                    rows = await self._load(conn, missing)
+            for qid, coin in rows:
+                if qid not in self._balances:
+                    self._balances[qid] = coin or 0
+                    bisect.insort(self._ranking, (-self._balances[qid], qid))
+                    loaded.add(qid)
+        return {qid for qid in qids if qid in self._balances}, loaded
+
+    @staticmethod
+    async def _load(conn, qids: list[int]) -> list[tuple[int, int]]:
+        rows = []
+        for i in range(0, len(qids), CHUNK_SIZE):
+            result = await conn.execute(_find_coins, {"b_qids": qids[i:i + CHUNK_SIZE]})
+            rows.extend((row.qid, row.coin) for row in result.fetchall())
+        return rows
+
+    def _apply(self, qid: int, balance: int):
+        old = self._balances[qid]
+        index = bisect.bisect_left(self._ranking, (-old, qid))
+        del self._ranking[index]
+        bisect.insort(self._ranking, (-balance, qid))
+        self._balances[qid] = balance
+        self._dirty.add(qid)
+
+    @staticmethod
+    def _ledger_row(qid: int, delta: int, balance: int, reason: str) -> dict:
+        return {"qid": qid, "delta": delta, "balance": balance, "reason": reason, "created_at": datetime.datetime.now()}
+
+    async def _write_ledger(self, qid: int, delta: int, balance: int, reason: str):
+        await self.ledger.put(self._ledger_row(qid, delta, balance, reason))
+
+    async def balance(self, qid: int) -> int | None:
+        """
+        查询余额，用户不存在时返回 None
+        """
+        if not await self._ensure(qid):
+            return None
+        return self._balances[qid]
+
+    async def add(self, qid: int, coin: int, reason: str = "获得硬币") -> int:
+        """
+        增加硬币，coin 必须是正数，返回变动后的余额
+        """
+        _check_amount(coin)
+        if not await self._ensure(qid):
+            raise LookupError(f"用户 {qid} 不存在")
+        balance = self._balances[qid] + coin
+        self._apply(qid, balance)
+        await self._write_ledger(qid, coin, balance, reason)
+        return balance
+
+    async def add_many(self, coins: dict[int, int], reason: str = "获得硬币",
+                       scope: UserScope | None = None) -> dict[int, int]:
+        """
+        批量增加硬币，coins 为 qq号 -> 增加的数量（必须是正数），不存在的用户会被跳过，返回 qq号 -> 变动后的余额
+
+        所有余额只需要一次 IN 查询加载，内存中的变动一次完成，不会只改动一部分；
+        传入 scope 时余额和流水写入 scope 的事务，随它一起提交或回滚
+        """
+        for coin in coins.values():
+            _check_amount(coin)
+        existing, loaded = await self._ensure_many(coins, scope)
+        items = [(qid, coin) for qid, coin in coins.items() if qid in existing]
+        if not items:
+            return {}
+        if scope is not None:
+            # 先在事务中写入变化量，再修改内存，写入失败时内存不受影响
+            for i in range(0, len(items), CHUNK_SIZE):
+                await scope.conn.execute(_add_coin, [
+                    {"b_qid": qid, "b_delta": coin} for qid, coin in items[i:i + CHUNK_SIZE]])
+            scope.invalidate(qid for qid, _ in items)
+        balances = {}
+        rows = []
+        for qid, coin in items:
+            balance = self._balances[qid] + coin
+            self._apply(qid, balance)
+            balances[qid] = balance
+            rows.append(self._ledger_row(qid, coin, balance, reason))
+        if scope is not None:
+            scope.on_rollback(lambda: self._revert(items, loaded))
+            for i in range(0, len(rows), CHUNK_SIZE):
+                await scope.conn.execute(_insert_ledger, rows[i:i + CHUNK_SIZE])
+        else:
+            for row in rows:
+                await self.ledger.put(row)
+        return balances
+
+    def _revert(self, items: list[tuple[int, int]], loaded: set[int]):
+        """
+        事务回滚后撤销内存中的变动；在这个事务中才加载的用户可能是事务中刚创建的，回滚后已经不存在，直接移出内存
+        """
+        for qid, coin in items:
+            self._apply(qid, self._balances[qid] - coin)
+        for qid in loaded:
+            index = bisect.bisect_left(self._ranking, (-self._balances[qid], qid))
+            del self._ranking[index]
+            del self._balances[qid]
+            self._dirty.discard(qid)
+
+    async def consume(self, qid: int, coin: int, reason: str = "消费硬币") -> int:
+        """
+        扣除硬币，coin 必须是正数，余额不足时不做任何修改并抛出 InsufficientCoinError，返回变动后的余额
+        """
+        _check_amount(coin)
+        if not await self._ensure(qid):
+            raise LookupError(f"用户 {qid} 不存在")
+        # 检查和扣除之间没有 await，不会有其他协程在中间修改余额
+        balance = self._balances[qid] - coin
+        if balance < 0:
+            raise InsufficientCoinError(qid)
+        self._apply(qid, balance)
+        await self._write_ledger(qid, -coin, balance, reason)
+        return balance
+
+    async def set(self, qid: int, coin: int, reason: str = "设置硬币") -> int:
+        """
+        直接设置余额，余额不能是负数
+        """
+        _check_amount(coin, allow_zero=True)
+        if not await self._ensure(qid):
+            raise LookupError(f"用户 {qid} 不存在")
+        delta = coin - self._balances[qid]
+        self._apply(qid, coin)
+        await self._write_ledger(qid, delta, coin, reason)
+        return coin
+
+    def rank(self, qid: int) -> int | None:
+        """
+        查询用户在余额排行榜中的名次，从 1 开始
+        """
+        if qid not in self._balances:
+            return None
+        return bisect.bisect_left(self._ranking, (-self._balances[qid], qid)) + 1
+
+    def top(self, count: int = 10) -> list[tuple[int, int]]:
+        """
+        余额排行榜的前 count 名，返回 (qq号, 余额) 列表
+        """
+        return [(qid, -negative) for negative, qid in self._ranking[:count]]
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        """
+        把改动过的余额写回用户表
+        """
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        try:
+            async with get_engine().begin() as conn:
+                await conn.execute(_set_coin, [{"b_qid": qid, "b_coin": self._balances[qid]} for qid in dirty])
+        except Exception as e:
+            logger.error(f"写回硬币余额失败：{e}")
+            self._dirty |= dirty
+            return
+        for qid in dirty:
+            user_cache.invalidate(qid)
+
+
+economy = Economy()
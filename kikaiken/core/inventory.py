@@ -0,0 +1,160 @@
+import datetime
+import json
+import os
+import re
+
+from nonebot import logger
+from sqlalchemy import select, update, delete, bindparam
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from kikaiken.core.db_connect import get_engine, get_read_engine
+from kikaiken.core.models.db_model import KikaikenBackpackItem
+from kikaiken.core.user_manager import record_writer
+from kikaiken.utils.cache import AsyncLRUCache
+
+INVENTORY_CACHE_SIZE = int(os.getenv("INVENTORY_CACHE_SIZE", "2048"))
+INVENTORY_CACHE_TTL = float(os.getenv("INVENTORY_CACHE_TTL", "300"))
+
+_ITEM_SEPARATOR = re.compile(r"[,，;；\n]+")
+
+_find_items = select(KikaikenBackpackItem.item_id, KikaikenBackpackItem.count).where(
+    KikaikenBackpackItem.qid == bindparam("b_qid"), KikaikenBackpackItem.count > 0)
+_add_item = sqlite_insert(KikaikenBackpackItem).values(
+    qid=bindparam("b_qid"), item_id=bindparam("b_item"), count=bindparam("b_count"))
+_add_item = _add_item.on_conflict_do_update(index_elements=["qid", "item_id"], set_={
+    "count": KikaikenBackpackItem.count + _add_item.excluded.count})
+# 数量不足时不会更新任何行
+_remove_item = update(KikaikenBackpackItem).where(
+    KikaikenBackpackItem.qid == bindparam("b_qid"),
+    KikaikenBackpackItem.item_id == bindparam("b_item"),
+    KikaikenBackpackItem.count >= bindparam("b_count"),
+).values(count=KikaikenBackpackItem.count - bindparam("b_count"))
+_delete_empty = delete(KikaikenBackpackItem).where(
+    KikaikenBackpackItem.qid == bindparam("b_qid"),
+    KikaikenBackpackItem.item_id == bindparam("b_item"),
+    KikaikenBackpackItem.count <= 0,
+)
+
+
+def parse_backpack(raw: str | None) -> dict[str, int]:
+    """
+    解析旧的背包字符串，支持 JSON 对象 {"物品": 数量}、JSON 数组 ["物品", ...] 或 [{"item_id": "物品", "count": 数量}]，
+    以及 "物品:数量,物品" 形式的文本，无法识别的部分会被忽略
+    """
+    items: dict[str, int] = {}
+
+    def add(item, count=1):
+        try:
+            count = int(count)
+        except (TypeError, ValueError):
+            return
+        item = str(item).strip()
+        if item and count > 0:
+            items[item] = items.get(item, 0) + count
+
+    if not raw or not raw.strip():
+        return items
+    try:
+        data = json.loads(raw)
+    except ValueError:
+        data = None
+    if isinstance(data, dict):
+        for item, count in data.items():
+            add(item, count)
+    elif isinstance(data, list):
+        for entry in data:
+            if isinstance(entry, dict):
+                item = entry.get("item_id", entry.get("id", entry.get("name")))
+                if item is not None:
+                    add(item, entry.get("count", 1))
+            elif isinstance(entry, (str, int)):
+                add(entry)
+    else:
+        for part in _ITEM_SEPARATOR.split(raw):
+            item, _, count = part.partition(":") if ":" in part else part.partition("：")
+            add(item, count.strip() or 1)
+    return items
+
+
+def _check_count(count: int):
+    # 负数会让增加变成扣除、让扣除绕过数量检查，所以一律拒绝
+    if count <= 0:
+        raise ValueError(f"物品数量必须是正数：{count}")
+
+
+class Inventory:
+    """
+    背包
+
+    每种物品单独一行，增减物品只需要一条 UPSERT 或条件 UPDATE，不需要读出整个背包；
+    扣除物品时数量不足不会有任何修改。读取整个背包的结果会被缓存，写入后对应用户的缓存失效。
+    """
+
+    def __init__(self):
+        self._cache = AsyncLRUCache(maxsize=INVENTORY_CACHE_SIZE, ttl=INVENTORY_CACHE_TTL, negative_ttl=0)
+
+    async def _load(self, qid: int) -> dict[str, int]:
+        async with get_read_engine().connect() as conn:
+            result = await conn.execute(_find_items, {"b_qid": qid})
+            return {row.item_id: row.count for row in result.fetchall()}
+
+    async def get(self, qid: int) -> dict[str, int]:
+        """
+        读取用户的背包，返回 物品 -> 数量
+        """
+        return dict(await self._cache.get_or_load(qid, lambda: self._load(qid)))
+
+    async def count(self, qid: int, item_id: str) -> int:
+        return (await self._cache.get_or_load(qid, lambda: self._load(qid))).get(item_id, 0)
+
+    async def _record(self, qid: int, content: str):
+        await record_writer.put({"qid": qid, "record_time": datetime.datetime.now(), "content": content})
+
+    async def add(self, qid: int, item_id: str, count: int = 1):
+        """
+        增加物品，count 必须是正数
+        """
+        _check_count(count)
+        async with get_engine().begin() as conn:
+            await conn.execute(_add_item, {"b_qid": qid, "b_item": item_id, "b_count": count})
+        self._cache.invalidate(qid)
+        await self._record(qid, f"获得物品：{item_id} × {count}")
+
+    async def remove(self, qid: int, item_id: str, count: int = 1) -> bool:
+        """
+        扣除物品，数量不足时不做任何修改并返回 False，count 必须是正数
+        """
+        _check_count(count)
+        params = {"b_qid": qid, "b_item": item_id, "b_count": count}
+        async with get_engine().begin() as conn:
+            result = await conn.execute(_remove_item, params)
+            if not result.rowcount:
+                return False
+            await conn.execute(_delete_empty, params)
+        self._cache.invalidate(qid)
+        await self._record(qid, f"失去物品：{item_id} × {count}")
+        return True
+
+    async def grant_many(self, grants: dict[int, dict[str, int]]):
+        """
+        批量发放物品，grants 为 qq号 -> (物品 -> 数量)，全部发放在同一个事务中完成
+        """
+        for items in grants.values():
+            for count in items.values():
+                _check_count(count)
+        params = [
+            {"b_qid": qid, "b_item": item_id, "b_count": count}
+            for qid, items in grants.items() for item_id, count in items.items()
+        ]
+        if not params:
+            return
+        async with get_engine().begin() as conn:
+            await conn.execute(_add_item, params)
+        for qid, items in grants.items():
+            self._cache.invalidate(qid)
+            for item_id, count in items.items():
+                await self._record(qid, f"获得物品：{item_id} × {count}")
+        logger.debug(f"已向 {len(grants)} 个用户发放 {len(params)} 种物品")
+
+
+inventory = Inventory()
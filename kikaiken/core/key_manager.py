@@ -1,3 +1,15 @@
+import asyncio
+import os
+import time
+
+from nonebot import logger
+
+from kikaiken.core.data_manager import list_keys
+from kikaiken.utils.rate_limit import TokenBucket
+
+DEEPSEEK_MODEL = os.getenv("DEEPSEEK_MODEL", "deepseek-chat")  # DeepSeek 官方接口使用的模型
+
+
 class Apikey:
     """
     API密钥存储的基类
@@ -21,7 +33,7 @@ class DeepSeekApikey(Apikey):
     Deepseek的API密钥
     """
     model_type: str = "deepseek"
-    model_name: str = "deepseek-chat"
+    model_name: str = DEEPSEEK_MODEL
     key: str = ""
 
     def __init__(self, key: str):
@@ -39,3 +51,223 @@ class SiliconFlowApikey(Apikey):
     def __init__(self, model: str, key: str):
         self.set_name(model)
         self.set_key(key)
+
+
+def create_apikey(model_type: str, model_name: str, key: str) -> Apikey:
+    """
+    根据模型类型创建对应的API密钥对象
+    """
+    if model_type == "deepseek":
+        apikey = DeepSeekApikey(key)
+        if model_name:
+            apikey.set_name(model_name)
+        return apikey
+    if model_type == "siliconflow":
+        return SiliconFlowApikey(model_name, key)
+    apikey = Apikey()
+    apikey.set_type(model_type)
+    apikey.set_name(model_name)
+    apikey.set_key(key)
+    return apikey
+
+
+KEY_RPM = float(os.getenv("KEY_RPM", "60"))  # 每个key每分钟的请求数上限
+KEY_TPM = float(os.getenv("KEY_TPM", "100000"))  # 每个key每分钟的token数上限
+KEY_CONCURRENCY = int(os.getenv("KEY_CONCURRENCY", "4"))  # 每个key同时进行的请求数上限
+KEY_COOLDOWN_BASE = float(os.getenv("KEY_COOLDOWN_BASE", "5"))  # 出错后冷却时间的基数，单位秒
+KEY_COOLDOWN_MAX = float(os.getenv("KEY_COOLDOWN_MAX", "300"))
+KEY_ACQUIRE_TIMEOUT = float(os.getenv("KEY_ACQUIRE_TIMEOUT", "30"))  # 等待可用key的最长时间
+
+
+class NoAvailableKeyError(Exception):
+    """
+    没有配置对应模型的key，或者在限定时间内等不到可用的key
+    """
+
+
+class KeyState:
+    """
+    key的运行时状态，包括限流令牌桶、并发数和冷却信息
+    """
+    key_id: int
+    apikey: Apikey
+    in_flight: int
+    failures: int
+    cooldown_until: float
+
+    def __init__(self, key_id: int, apikey: Apikey):
+        self.key_id = key_id
+        self.apikey = apikey
+        self.rpm = TokenBucket(KEY_RPM / 60, KEY_RPM)
+        self.tpm = TokenBucket(KEY_TPM / 60, KEY_TPM)
+        self.in_flight = 0
+        self.failures = 0
+        self.cooldown_until = 0.0
+
+    def matches(self, model_type: str, model_name: str | None) -> bool:
+        if self.apikey.model_type != model_type:
+            return False
+        return not model_name or not self.apikey.model_name or self.apikey.model_name == model_name
+
+    def wait_time(self, tokens: int) -> float | None:
+        """
+        距离这个key可以再次使用还需要等待的秒数，受并发限制时返回 None
+        """
+        if self.in_flight >= KEY_CONCURRENCY:
+            return None
+        return max(self.cooldown_until - time.monotonic(), self.rpm.wait_time(1), self.tpm.wait_time(tokens), 0.0)
+
+    def load(self) -> float:
+        return self.in_flight / KEY_CONCURRENCY
+
+
+class KeyLease:
+    """
+    一次key的使用，进入上下文时获取key，离开时归还，发生限流或服务端错误时key会进入冷却
+    """
+    state: KeyState | None
+
+    def __init__(self, pool: "KeyPool", model_type: str, model_name: str | None, tokens: int, timeout: float):
+        self.pool = pool
+        self.model_type = model_type
+        self.model_name = model_name
+        self.tokens = tokens
+        self.timeout = timeout
+        self.state = None
+
+    @property
+    def key(self) -> str:
+        return self.state.apikey.key
+
+    async def __aenter__(self) -> "KeyLease":
+        self.state = await self.pool.wait_for_key(self.model_type, self.model_name, self.tokens, self.timeout)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        status = getattr(exc, "status_code", None)
+        if exc is not None and status is not None and (status == 429 or status >= 500):
+            self.pool.cooldown(self.state, status)
+        elif exc is None:
+            self.state.failures = 0
+        await self.pool.release(self.state)
+
+
+class KeyPool:
+    """
+    API密钥池
+
+    启动时从数据库加载一次全部key，每次请求选出负载最低且未被限流的key，
+    同负载的key之间轮询；通过 apikey 命令增删key后调用 reload 即可热更新。
+    """
+
+    def __init__(self):
+        self._keys: dict[int, KeyState] = {}
+        self._cursor = 0
+        self._condition = asyncio.Condition()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    async def reload(self):
+        """
+        重新加载key，已存在的key会保留限流和冷却状态
+        """
+        rows = await list_keys() or []
+        keys: dict[int, KeyState] = {}
+        for row in rows:
+            state = self._keys.get(row.id)
+            if state is None or state.apikey.key != row.api_key:
+                state = KeyState(row.id, create_apikey(row.model_type, row.model_name, row.api_key))
+            keys[row.id] = state
+        # 环境变量中的key作为兜底，使用负数id以免和数据库中的key冲突
+        # DeepSeek 的key使用 DEEPSEEK_MODEL，和 talk 中的 deepseek 服务商保持一致
+        for key_id, model_type, model_name, env in ((-1, "siliconflow", "", "SILICONFLOW_API_KEY"),
+                                                    (-2, "deepseek", DEEPSEEK_MODEL, "DEEPSEEK_API_KEY")):
+            if key := os.getenv(env):
+                keys[key_id] = self._keys.get(key_id) or KeyState(key_id, create_apikey(model_type, model_name, key))
+        self._keys = keys
+        logger.info(f"已加载 {len(keys)} 个API密钥")
+        async with self._condition:
+            self._condition.notify_all()
+
+    def has_keys(self, model_type: str, model_name: str | None = None) -> bool:
+        """
+        是否配置了可用于该模型的key
+        """
+        return any(state.matches(model_type, model_name) for state in self._keys.values())
+
+    def _pick(self, model_type: str, model_name: str | None, tokens: int) -> tuple[KeyState | None, float | None]:
+        """
+        选出一个立即可用的key，没有时返回最短的等待时间
+        """
+        candidates = [state for state in self._keys.values() if state.matches(model_type, model_name)]
+        if not candidates:
+            raise NoAvailableKeyError(f"没有可用于 {' '.join(filter(None, (model_type, model_name)))} 的API密钥")
+        self._cursor += 1
+        # 轮询起点每次后移一位，负载相同时就会依次选到不同的key
+        offset = self._cursor % len(candidates)
+        candidates = candidates[offset:] + candidates[:offset]
+        ready = []
+        min_wait = None
+        for state in candidates:
+            wait = state.wait_time(tokens)
+            if wait is None:
+                continue
+            if wait <= 0:
+                ready.append(state)
+            elif min_wait is None or wait < min_wait:
+                min_wait = wait
+        for state in sorted(ready, key=KeyState.load):
+            if not state.tpm.try_acquire(tokens):
+                continue
+            # 两个桶要么都扣，要么都不扣，RPM 不足时退还已经取出的 TPM
+            if state.rpm.try_acquire(1):
+                return state, None
+            state.tpm.refund(tokens)
+        return None, min_wait
+
+    def acquire(self, model_type: str, model_name: str | None = None, tokens: int = 1,
+                timeout: float = KEY_ACQUIRE_TIMEOUT) -> KeyLease:
+        """
+        获取一个可用的key，用法：
+            async with key_pool.acquire("siliconflow", model, tokens) as lease:
+                ...使用 lease.key 发起请求
+        """
+        return KeyLease(self, model_type, model_name, tokens, timeout)
+
+    async def wait_for_key(self, model_type: str, model_name: str | None, tokens: int, timeout: float) -> KeyState:
+        """
+        等待并占用一个可用的key，所有key都在限流或冷却时会等待，超时后抛出 NoAvailableKeyError
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        async with self._condition:
+            while True:
+                state, wait = self._pick(model_type, model_name, tokens)
+                if state is not None:
+                    state.in_flight += 1
+                    return state
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise NoAvailableKeyError(f"等待 {model_type} 的API密钥超时")
+                try:
+                    await asyncio.wait_for(self._condition.wait(), min(remaining, wait or remaining))
+                except asyncio.TimeoutError:
+                    pass
+
+    async def release(self, state: KeyState):
+        state.in_flight -= 1
+        async with self._condition:
+            self._condition.notify_all()
+
+    def cooldown(self, state: KeyState, status: int):
+        """
+        让key进入冷却，连续出错时冷却时间指数增长
+        """
+        state.failures += 1
+        seconds = min(KEY_COOLDOWN_BASE * 2 ** (state.failures - 1), KEY_COOLDOWN_MAX)
+        state.cooldown_until = time.monotonic() + seconds
+        logger.warning(f"API密钥 {state.key_id} 返回 {status}，冷却 {seconds:.0f} 秒")
+
+
+key_pool = KeyPool()
@@ -8,8 +8,45 @@ from langchain_openai.chat_models.base import BaseChatOpenAI
 from pydantic import Field, ConfigDict, model_validator
 from typing_extensions import Self
 
+from kikaiken.utils.http import get_async_client, get_sync_client, close_clients
+
 SILICONFLOW_API_BASE = "https://api.siliconflow.cn/v1"
 
+# 按 (base_url, key) 共享的 OpenAI 客户端，底层都使用同一个 httpx 连接池
+_async_openai_clients: dict[tuple[str, str], openai.AsyncOpenAI] = {}
+_openai_clients: dict[tuple[str, str], openai.OpenAI] = {}
+
+
+def get_async_openai_client(base_url: str, api_key: str) -> openai.AsyncOpenAI:
+    """
+    获取共享的异步 OpenAI 客户端
+    """
+    key = (base_url, api_key)
+    if (client := _async_openai_clients.get(key)) is None:
+        client = _async_openai_clients[key] = openai.AsyncOpenAI(
+            api_key=api_key, base_url=base_url, http_client=get_async_client())
+    return client
+
+
+def get_openai_client(base_url: str, api_key: str) -> openai.OpenAI:
+    """
+    获取共享的同步 OpenAI 客户端
+    """
+    key = (base_url, api_key)
+    if (client := _openai_clients.get(key)) is None:
+        client = _openai_clients[key] = openai.OpenAI(
+            api_key=api_key, base_url=base_url, http_client=get_sync_client())
+    return client
+
+
+async def close_llm_clients():
+    """
+    释放所有共享的客户端，在 driver.on_shutdown 中调用
+    """
+    _async_openai_clients.clear()
+    _openai_clients.clear()
+    await close_clients()
+
 
 class ChatSiliconFlow(BaseChatOpenAI):
     model_name: str = Field(alias="model")
@@ -22,6 +59,8 @@ class ChatSiliconFlow(BaseChatOpenAI):
         default_factory=from_env("SILICONFLOW_API_BASE", default=SILICONFLOW_API_BASE)
     )
     """硅基流动 API base URL"""
+    skip_sync_client: bool = False
+    """不创建同步客户端，只使用异步接口时可以开启"""
 
     model_config = ConfigDict(populate_by_name=True)
 
@@ -41,11 +80,10 @@ class ChatSiliconFlow(BaseChatOpenAI):
                 self.api_key
         ):
             raise ValueError("If using default api base, SILICONFLOW_API_KEY must be set.")
-        client_params: dict = {
+        # 每个实例自己的请求参数通过 with_options 设置，复制出的客户端仍共享同一个连接池
+        client_options: dict = {
             k: v
             for k, v in {
-                "api_key": self.api_key,
-                "base_url": self.api_base,
                 "timeout": self.request_timeout,
                 "max_retries": self.max_retries,
                 "default_headers": self.default_headers,
@@ -54,16 +92,19 @@ class ChatSiliconFlow(BaseChatOpenAI):
             if v is not None
         }
 
-        if not (self.client or None):
-            sync_specific: dict = {"http_client": self.http_client}
-            self.client = openai.OpenAI(
-                **client_params, **sync_specific
-            ).chat.completions
+        if not (self.client or None) and not self.skip_sync_client:
+            if self.http_client is not None:
+                client = openai.OpenAI(api_key=self.api_key, base_url=self.api_base, http_client=self.http_client)
+            else:
+                client = get_openai_client(self.api_base, self.api_key)
+            self.client = client.with_options(**client_options).chat.completions
         if not (self.async_client or None):
-            async_specific: dict = {"http_client": self.http_async_client}
-            self.async_client = openai.AsyncOpenAI(
-                **client_params, **async_specific
-            ).chat.completions
+            if self.http_async_client is not None:
+                async_client = openai.AsyncOpenAI(
+                    api_key=self.api_key, base_url=self.api_base, http_client=self.http_async_client)
+            else:
+                async_client = get_async_openai_client(self.api_base, self.api_key)
+            self.async_client = async_client.with_options(**client_options).chat.completions
         return self
 
     def _create_chat_result(
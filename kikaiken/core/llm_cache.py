@@ -0,0 +1,153 @@
+import asyncio
+import datetime
+import hashlib
+import os
+import re
+import unicodedata
+
+from nonebot import logger
+from sqlalchemy import select, delete, update, bindparam, func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from kikaiken.core.db_connect import get_engine, get_read_engine
+from kikaiken.core.models.db_model import LLMResponseCache
+from kikaiken.utils.cache import AsyncLRUCache
+
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "1024"))  # 内存中缓存的回复数量
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "86400"))  # 回复的有效期，单位秒
+LLM_CACHE_MAX_ROWS = int(os.getenv("LLM_CACHE_MAX_ROWS", "10000"))  # 数据库中最多保留的回复数量
+LLM_CACHE_MAINTAIN_INTERVAL = float(os.getenv("LLM_CACHE_MAINTAIN_INTERVAL", "300"))
+
+_WHITESPACE = re.compile(r"\s+")
+_TRAILING_PUNCTUATION = re.compile(r"[\s。．.！!？?~～…]+$")
+
+
+def normalize_prompt(text: str) -> str:
+    """
+    规范化提示词：统一全半角、大小写和空白，并去掉句末的语气标点
+    """
+    text = unicodedata.normalize("NFKC", text).strip().lower()
+    text = _WHITESPACE.sub(" ", text)
+    return _TRAILING_PUNCTUATION.sub("", text)
+
+
+def cache_key(model_name: str, system_prompt: str, content: str) -> str:
+    raw = "\x00".join((model_name, normalize_prompt(system_prompt), normalize_prompt(content)))
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    模型回复缓存
+
+    内存中的 LRU 作为第一层，数据库中的 llm_response_cache 表作为第二层，
+    两层都按 LLM_CACHE_TTL 过期；命中次数在内存中累计，由后台任务定期写回数据库。
+    """
+
+    def __init__(self):
+        self._memory = AsyncLRUCache(maxsize=LLM_CACHE_SIZE, ttl=LLM_CACHE_TTL, negative_ttl=0)
+        self._hits: dict[str, int] = {}
+        self._task: asyncio.Task | None = None
+        self.saved_ms = 0  # 命中缓存累计节省的生成时间
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._maintain_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self._flush_hits()
+
+    def stats(self) -> dict:
+        return {**self._memory.stats.as_dict(), "size": len(self._memory), "saved_ms": self.saved_ms}
+
+    async def get(self, model_name: str, system_prompt: str, content: str) -> str | None:
+        """
+        查找缓存的回复，未命中时返回 None
+        """
+        key = cache_key(model_name, system_prompt, content)
+        try:
+            entry = await self._memory.get_or_load(key, lambda: self._load(key))
+        except Exception as e:
+            logger.error(f"查询回复缓存失败：{e}")
+            return None
+        if entry is None:
+            return None
+        response, latency_ms = entry
+        self._hits[key] = self._hits.get(key, 0) + 1
+        self.saved_ms += latency_ms
+        return response
+
+    async def put(self, model_name: str, system_prompt: str, content: str, response: str,
+                  latency_ms: int, tokens: int):
+        """
+        写入一条回复，同时写入内存和数据库
+        """
+        key = cache_key(model_name, system_prompt, content)
+        self._memory.set(key, (response, latency_ms))
+        now = datetime.datetime.now()
+        upsert = sqlite_insert(LLMResponseCache).values(
+            key=key,
+            model_name=model_name,
+            prompt=normalize_prompt(content),
+            response=response,
+            created_at=now,
+            last_hit_at=now,
+            hits=0,
+            latency_ms=latency_ms,
+            tokens=tokens,
+        ).on_conflict_do_nothing(index_elements=["key"])
+        try:
+            async with get_engine().begin() as conn:
+                await conn.execute(upsert)
+        except Exception as e:
+            logger.error(f"写入回复缓存失败：{e}")
+
+    async def _load(self, key: str) -> tuple[str, int] | None:
+        expire_before = datetime.datetime.now() - datetime.timedelta(seconds=LLM_CACHE_TTL)
+        query = select(LLMResponseCache.response, LLMResponseCache.latency_ms).where(
+            LLMResponseCache.key == key, LLMResponseCache.created_at >= expire_before)
+        async with get_read_engine().connect() as conn:
+            result = await conn.execute(query)
+            row = result.fetchone()
+        return (row.response, row.latency_ms) if row else None
+
+    async def _flush_hits(self):
+        if not self._hits:
+            return
+        hits, self._hits = self._hits, {}
+        statement = update(LLMResponseCache).where(LLMResponseCache.key == bindparam("b_key")).values(
+            hits=LLMResponseCache.hits + bindparam("b_hits"), last_hit_at=bindparam("b_now"))
+        now = datetime.datetime.now()
+        try:
+            async with get_engine().begin() as conn:
+                await conn.execute(statement, [{"b_key": k, "b_hits": v, "b_now": now} for k, v in hits.items()])
+        except Exception as e:
+            logger.error(f"更新回复缓存命中次数失败：{e}")
+
+    async def _prune(self):
+        """
+        删除过期的回复，并按最近命中时间淘汰超出 LLM_CACHE_MAX_ROWS 的部分
+        """
+        expire_before = datetime.datetime.now() - datetime.timedelta(seconds=LLM_CACHE_TTL)
+        async with get_engine().begin() as conn:
+            await conn.execute(delete(LLMResponseCache).where(LLMResponseCache.created_at < expire_before))
+            result = await conn.execute(select(func.count()).select_from(LLMResponseCache))
+            excess = result.scalar() - LLM_CACHE_MAX_ROWS
+            if excess > 0:
+                oldest = select(LLMResponseCache.key).order_by(LLMResponseCache.last_hit_at).limit(excess)
+                await conn.execute(delete(LLMResponseCache).where(LLMResponseCache.key.in_(oldest)))
+
+    async def _maintain_loop(self):
+        while True:
+            await asyncio.sleep(LLM_CACHE_MAINTAIN_INTERVAL)
+            await self._flush_hits()
+            try:
+                await self._prune()
+            except Exception as e:
+                logger.error(f"清理回复缓存失败：{e}")
+
+
+response_cache = ResponseCache()
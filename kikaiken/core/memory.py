@@ -0,0 +1,239 @@
+import asyncio
+import datetime
+import os
+import re
+import time
+from collections import deque
+from typing import Awaitable, Callable
+
+from langchain_core.messages import BaseMessage, SystemMessage, HumanMessage, AIMessage
+from nonebot import logger
+from sqlalchemy import select, desc
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from kikaiken.core.db_connect import get_engine, get_read_engine
+from kikaiken.core.models.db_model import KikaikenConversation, KikaikenConversationSummary
+from kikaiken.utils.batch_writer import BatchWriter
+
+TALK_CONTEXT_TOKENS = int(os.getenv("TALK_CONTEXT_TOKENS", "3000"))  # 单次请求的上下文 token 预算
+TALK_HISTORY_TURNS = int(os.getenv("TALK_HISTORY_TURNS", "40"))  # 内存中为每个用户保留的最大对话条数
+TALK_IDLE_SECONDS = float(os.getenv("TALK_IDLE_SECONDS", "1800"))  # 超过这个时间没有对话的用户会被移出内存
+
+_CJK = re.compile(r"[\u2e80-\u9fff\uf900-\ufaff\uff00-\uffef]")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估计文本的 token 数：中日韩字符按每字一个 token，其余字符按每四个一个 token
+    """
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+class Turn:
+    """
+    一条对话
+    """
+    seq: int
+    role: str
+    content: str
+    tokens: int
+
+    def __init__(self, seq: int, role: str, content: str):
+        self.seq = seq
+        self.role = role
+        self.content = content
+        self.tokens = estimate_tokens(content)
+
+    def to_message(self) -> BaseMessage:
+        return HumanMessage(self.content) if self.role == "user" else AIMessage(self.content)
+
+
+# 摘要函数：传入旧的摘要和新被移出的对话，返回新的摘要
+Summarizer = Callable[[str, list[Turn]], Awaitable[str]]
+
+
+class Conversation:
+    """
+    单个用户的对话上下文，最近的对话保存在环形缓冲中，更早的对话被合并进摘要
+    """
+    qid: int
+    turns: deque[Turn]
+    summary: str
+    summarized_seq: int
+    next_seq: int
+    last_active: float
+
+    def __init__(self, qid: int, turns: list[Turn], summary: str, summarized_seq: int, next_seq: int):
+        self.qid = qid
+        self.turns = deque(turns, maxlen=TALK_HISTORY_TURNS)
+        self.summary = summary
+        self.summarized_seq = summarized_seq
+        self.next_seq = next_seq
+        self.last_active = time.monotonic()
+        self.evicted: list[Turn] = []  # 等待合并进摘要的对话
+        self.summarizing: asyncio.Task | None = None
+
+    def has_history(self) -> bool:
+        return bool(self.turns or self.summary)
+
+    def trim(self, reserved_tokens: int):
+        """
+        从最早的对话开始移出缓冲，直到剩余对话加上 reserved_tokens 不超过预算
+        """
+        total = reserved_tokens + estimate_tokens(self.summary) + sum(turn.tokens for turn in self.turns)
+        while self.turns and total > TALK_CONTEXT_TOKENS:
+            turn = self.turns.popleft()
+            total -= turn.tokens
+            self.evicted.append(turn)
+
+    def build_messages(self, system_prompt: str, content: str) -> list[BaseMessage]:
+        """
+        构造本轮请求的消息列表，总长度控制在 TALK_CONTEXT_TOKENS 之内
+        """
+        self.last_active = time.monotonic()
+        self.trim(estimate_tokens(system_prompt) + estimate_tokens(content))
+        if self.summary:
+            system_prompt = f"{system_prompt}\n\n以下是你和用户之前对话的摘要：\n{self.summary}"
+        return [SystemMessage(system_prompt), *(turn.to_message() for turn in self.turns), HumanMessage(content)]
+
+    def append(self, role: str, content: str) -> Turn:
+        turn = Turn(self.next_seq, role, content)
+        self.next_seq += 1
+        if len(self.turns) == self.turns.maxlen:
+            self.evicted.append(self.turns[0])
+        self.turns.append(turn)
+        self.last_active = time.monotonic()
+        return turn
+
+
+class ConversationStore:
+    """
+    按qq号管理对话上下文，对话写入数据库，闲置的上下文会被移出内存
+    """
+
+    def __init__(self):
+        self._conversations: dict[int, Conversation] = {}
+        self._loading: dict[int, asyncio.Task] = {}
+        self._writer = BatchWriter(KikaikenConversation.__table__)
+        self._summarizer: Summarizer | None = None
+        self._sweeper: asyncio.Task | None = None
+
+    def set_summarizer(self, summarizer: Summarizer):
+        self._summarizer = summarizer
+
+    def start(self):
+        self._writer.start()
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def close(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        await self._writer.close()
+
+    async def get(self, qid: int) -> Conversation:
+        """
+        获取用户的对话上下文，不在内存中时从数据库加载
+        """
+        if (conversation := self._conversations.get(qid)) is not None:
+            return conversation
+        task = self._loading.get(qid)
+        if task is None:
+            task = asyncio.create_task(self._load(qid))
+            self._loading[qid] = task
+            task.add_done_callback(lambda _: self._loading.pop(qid, None))
+        conversation = await asyncio.shield(task)
+        self._conversations.setdefault(qid, conversation)
+        return self._conversations[qid]
+
+    async def append(self, qid: int, role: str, content: str):
+        """
+        追加一条对话，被挤出缓冲的对话会在后台合并进摘要
+        """
+        conversation = await self.get(qid)
+        turn = conversation.append(role, content)
+        await self._writer.put({
+            "qid": qid,
+            "seq": turn.seq,
+            "role": role,
+            "content": content,
+            "created_at": datetime.datetime.now(),
+        })
+        self._schedule_summary(conversation)
+
+    def _schedule_summary(self, conversation: Conversation):
+        if not conversation.evicted or self._summarizer is None:
+            return
+        if conversation.summarizing is None or conversation.summarizing.done():
+            conversation.summarizing = asyncio.create_task(self._summarize(conversation))
+
+    async def _summarize(self, conversation: Conversation):
+        while conversation.evicted:
+            turns, conversation.evicted = conversation.evicted, []
+            try:
+                summary = await self._summarizer(conversation.summary, turns)
+            except Exception as e:
+                logger.error(f"更新对话摘要失败：{e}")
+                return
+            conversation.summary = summary
+            conversation.summarized_seq = turns[-1].seq
+            await self._save_summary(conversation)
+
+    async def _save_summary(self, conversation: Conversation):
+        engine = get_engine()
+        upsert = sqlite_insert(KikaikenConversationSummary).values(
+            qid=conversation.qid,
+            summary=conversation.summary,
+            summarized_seq=conversation.summarized_seq,
+            updated_at=datetime.datetime.now(),
+        )
+        upsert = upsert.on_conflict_do_update(
+            index_elements=["qid"],
+            set_={
+                "summary": upsert.excluded.summary,
+                "summarized_seq": upsert.excluded.summarized_seq,
+                "updated_at": upsert.excluded.updated_at,
+            },
+        )
+        try:
+            async with engine.begin() as conn:
+                await conn.execute(upsert)
+        except Exception as e:
+            logger.error(f"保存对话摘要失败：{e}")
+
+    async def _load(self, qid: int) -> Conversation:
+        engine = get_read_engine()
+        async with engine.connect() as conn:
+            result = await conn.execute(
+                select(KikaikenConversationSummary).where(KikaikenConversationSummary.qid == qid))
+            summary_row = result.fetchone()
+            summary, summarized_seq = (summary_row.summary, summary_row.summarized_seq) if summary_row else ("", -1)
+            result = await conn.execute(
+                select(KikaikenConversation)
+                .where(KikaikenConversation.qid == qid, KikaikenConversation.seq > summarized_seq)
+                .order_by(desc(KikaikenConversation.seq))
+                .limit(TALK_HISTORY_TURNS))
+            rows = result.fetchall()
+        turns = [Turn(row.seq, row.role, row.content) for row in reversed(rows)]
+        next_seq = (turns[-1].seq if turns else summarized_seq) + 1
+        return Conversation(qid, turns, summary, summarized_seq, next_seq)
+
+    def sweep(self):
+        """
+        移出闲置的对话上下文，正在生成摘要的上下文会被保留
+        """
+        deadline = time.monotonic() - TALK_IDLE_SECONDS
+        for qid, conversation in list(self._conversations.items()):
+            if conversation.last_active < deadline and (
+                    conversation.summarizing is None or conversation.summarizing.done()):
+                del self._conversations[qid]
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(min(TALK_IDLE_SECONDS, 60))
+            self.sweep()
+
+
+conversation_store = ConversationStore()
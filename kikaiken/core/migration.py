@@ -0,0 +1,180 @@
+import json
+import os
+from typing import Awaitable, Callable
+
+from nonebot import logger
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from kikaiken.core.db_connect import get_engine
+from kikaiken.core.inventory import parse_backpack
+
+
+class Migration:
+    """
+    一次数据库结构变更，version 从 1 开始递增
+    """
+    version: int
+    description: str
+    upgrade: Callable[[AsyncConnection], Awaitable[None]]
+
+    def __init__(self, version: int, description: str, upgrade: Callable[[AsyncConnection], Awaitable[None]]):
+        self.version = version
+        self.description = description
+        self.upgrade = upgrade
+
+
+MIGRATIONS: list[Migration] = []
+
+
+def migration(version: int, description: str):
+    """
+    注册一个迁移，迁移函数会在单独的事务中执行，且必须是幂等的（新建的数据库已经由 create_all 建好了全部结构）
+    """
+
+    def decorator(func: Callable[[AsyncConnection], Awaitable[None]]):
+        MIGRATIONS.append(Migration(version, description, func))
+        return func
+
+    return decorator
+
+
+async def get_schema_version(conn: AsyncConnection) -> int:
+    result = await conn.exec_driver_sql("PRAGMA user_version")
+    return result.scalar()
+
+
+async def merge_duplicate_users(conn: AsyncConnection) -> int:
+    """
+    合并qq号重复的用户，保留最早创建的一条：硬币相加，权限组取最高，背包物品合并，日期取最新的签到和活跃日期；
+    返回删除的行数
+    """
+    result = await conn.exec_driver_sql(
+        "SELECT qid FROM kikaiken_user WHERE qid IS NOT NULL GROUP BY qid HAVING count(*) > 1"
+    )
+    qids = [row.qid for row in result.fetchall()]
+    removed = 0
+    for qid in qids:
+        result = await conn.exec_driver_sql(
+            "SELECT id, nickname, permission_group, coin, backpack, last_sign_date, last_activity_date "
+            "FROM kikaiken_user WHERE qid = ? ORDER BY id", (qid,)
+        )
+        rows = result.fetchall()
+        backpack: dict[str, int] = {}
+        for row in rows:
+            for item_id, count in parse_backpack(row.backpack).items():
+                backpack[item_id] = backpack.get(item_id, 0) + count
+        await conn.exec_driver_sql(
+            "UPDATE kikaiken_user SET nickname = ?, permission_group = ?, coin = ?, backpack = ?, "
+            "last_sign_date = ?, last_activity_date = ? WHERE id = ?",
+            (
+                next((row.nickname for row in rows if row.nickname), None),
+                max((row.permission_group for row in rows if row.permission_group is not None), default=None),
+                sum(row.coin or 0 for row in rows),
+                json.dumps(backpack, ensure_ascii=False) if backpack else None,
+                max((row.last_sign_date for row in rows if row.last_sign_date), default=None),
+                max((row.last_activity_date for row in rows if row.last_activity_date), default=None),
+                rows[0].id,
+            ),
+        )
+        await conn.exec_driver_sql(
+            "DELETE FROM kikaiken_user WHERE qid = ? AND id != ?", (qid, rows[0].id)
+        )
+        removed += len(rows) - 1
+    if qids:
+        logger.warning(f"合并了 {len(qids)} 个重复的qq号，删除了 {removed} 条重复的用户数据：{qids}")
+    return removed
+
+
+@migration(1, "为用户qq号添加唯一索引，为用户记录添加 (qid, record_time) 索引")
+async def _(conn: AsyncConnection):
+    # 旧数据中可能存在重复的qq号，先合并到最早创建的一条再建唯一索引
+    await merge_duplicate_users(conn)
+    await conn.exec_driver_sql(
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_kikaiken_user_qid ON kikaiken_user (qid)"
+    )
+    await conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_kikaiken_user_record_qid_time ON kikaiken_user_record (qid, record_time)"
+    )
+
+
+@migration(2, "把用户背包字符串拆分到 kikaiken_backpack_item 表")
+async def _(conn: AsyncConnection):
+    result = await conn.exec_driver_sql(
+        "SELECT qid, backpack FROM kikaiken_user WHERE backpack IS NOT NULL AND backpack != ''"
+    )
+    params = [
+        (qid, item_id, count)
+        for qid, backpack in result.fetchall()
+        for item_id, count in parse_backpack(backpack).items()
+    ]
+    if params:
+        # 以旧数据为准覆盖数量，重复执行不会让物品翻倍
+        await conn.exec_driver_sql(
+            "INSERT INTO kikaiken_backpack_item (qid, item_id, count) VALUES (?, ?, ?) "
+            "ON CONFLICT (qid, item_id) DO UPDATE SET count = excluded.count",
+            params,
+        )
+    await conn.exec_driver_sql("UPDATE kikaiken_user SET backpack = NULL WHERE backpack IS NOT NULL")
+    logger.info(f"已迁移 {len(params)} 条背包物品")
+
+
+async def run_migrations():
+    """
+    将数据库结构升级到最新版本，当前版本记录在 PRAGMA user_version 中
+    """
+    engine = get_engine()
+    async with engine.connect() as conn:
+        current = await get_schema_version(conn)
+    pending = sorted((m for m in MIGRATIONS if m.version > current), key=lambda m: m.version)
+    if not pending:
+        logger.debug(f"数据库结构已是最新版本：{current}")
+    for m in pending:
+        logger.info(f"- 升级数据库结构到版本 {m.version}：{m.description}")
+        async with engine.begin() as conn:
+            await m.upgrade(conn)
+            await conn.exec_driver_sql(f"PRAGMA user_version = {m.version}")
+    if os.getenv("SQLITE_CHECK_QUERY_PLAN", "true").lower() == "true":
+        await check_query_plans()
+
+
+# 热点查询，它们的查询计划中不应出现全表扫描或临时排序
+HOT_QUERIES: dict[str, tuple[str, tuple]] = {
+    "find_user_by_qid": (
+        "SELECT * FROM kikaiken_user WHERE qid = ?",
+        (0,),
+    ),
+    "query_record": (
+        "SELECT * FROM kikaiken_user_record WHERE qid = ? ORDER BY record_time DESC LIMIT ?",
+        (0, 1),
+    ),
+    "record_page": (
+        "SELECT record_time, content, id FROM kikaiken_user_record WHERE qid = ? AND (record_time, id) < (?, ?) "
+        "ORDER BY record_time DESC, id DESC LIMIT ?",
+        (0, "", 0, 1),
+    ),
+    "backpack_items": (
+        "SELECT item_id, count FROM kikaiken_backpack_item WHERE qid = ? AND count > 0",
+        (0,),
+    ),
+    "record_count": (
+        "SELECT count(*) FROM kikaiken_user_record WHERE qid = ?",
+        (0,),
+    ),
+}
+
+
+async def check_query_plans():
+    """
+    检查热点查询的 EXPLAIN QUERY PLAN，出现全表扫描时抛出异常
+    """
+    engine = get_engine()
+    problems = []
+    async with engine.connect() as conn:
+        for name, (sql, params) in HOT_QUERIES.items():
+            result = await conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}", params)
+            for row in result.fetchall():
+                detail: str = row[-1]
+                if detail.startswith("SCAN") or "TEMP B-TREE" in detail:
+                    problems.append(f"{name}: {detail}")
+    if problems:
+        raise RuntimeError(f"热点查询没有使用索引：{'; '.join(problems)}")
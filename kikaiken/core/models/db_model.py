@@ -0,0 +1,140 @@
+import datetime
+
+from sqlalchemy import Column, Integer, String, Boolean, Date, DateTime, Index, LargeBinary
+from sqlalchemy.ext.declarative import declarative_base
+
+Base = declarative_base()
+
+
+class KikaikenUserRecord(Base):
+    __tablename__ = "kikaiken_user_record"
+    __table_args__ = (Index("ix_kikaiken_user_record_qid_time", "qid", "record_time"),)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    qid = Column(Integer, nullable=False)
+    record_time = Column(DateTime, nullable=False, default=datetime.datetime.now)
+    content = Column(String(255), nullable=False)
+
+
+class ConfigPersistence(Base):
+    """
+    配置持久化表，用于保存一些全局设置
+    """
+    __tablename__ = "config_persistence"
+    id = Column(Integer, primary_key=True)
+    key = Column(String, unique=True)
+    value = Column(String)
+
+
+class LLMAPIKey(Base):
+    __tablename__ = "llm_apikey"
+    id = Column(Integer, primary_key=True)
+    model_type = Column(String)
+    model_name = Column(String)
+    api_key = Column(String)
+    notice = Column(String)
+
+
+class KikaikenUser(Base):
+    __tablename__ = "kikaiken_user"
+    __table_args__ = (Index("uq_kikaiken_user_qid", "qid", unique=True),)
+    id = Column(Integer, primary_key=True)
+    qid = Column(Integer)
+    nickname = Column(String)
+    permission_group = Column(Integer)
+    is_subscribed = Column(Boolean)  # 是否启用订阅服务
+    join_date = Column(Date)
+    lucky = Column(Integer)  # 幸运值，这个值也会影响一些其他的逻辑
+    last_sign_date = Column(Date)
+    coin = Column(Integer)
+    last_activity_date = Column(Date)
+    backpack = Column(String)  # 已废弃，背包物品保存在 kikaiken_backpack_item 中
+
+
+class KikaikenConversation(Base):
+    """
+    对话记录，seq 为同一用户内递增的序号
+    """
+    __tablename__ = "kikaiken_conversation"
+    __table_args__ = (Index("ix_kikaiken_conversation_qid_seq", "qid", "seq"),)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    qid = Column(Integer, nullable=False)
+    seq = Column(Integer, nullable=False)
+    role = Column(String(16), nullable=False)  # user 或 assistant
+    content = Column(String, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.datetime.now)
+
+
+class KikaikenConversationSummary(Base):
+    """
+    对话摘要，summarized_seq 及之前的对话已经被合并进摘要
+    """
+    __tablename__ = "kikaiken_conversation_summary"
+    qid = Column(Integer, primary_key=True)
+    summary = Column(String, nullable=False)
+    summarized_seq = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, nullable=False, default=datetime.datetime.now)
+
+
+class LLMResponseCache(Base):
+    """
+    模型回复缓存，key 由模型名称、规范化后的系统提示词和用户输入计算得出
+    """
+    __tablename__ = "llm_response_cache"
+    __table_args__ = (Index("ix_llm_response_cache_last_hit_at", "last_hit_at"),)
+    key = Column(String(64), primary_key=True)
+    model_name = Column(String, nullable=False)
+    prompt = Column(String, nullable=False)
+    response = Column(String, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.datetime.now)
+    last_hit_at = Column(DateTime, nullable=False, default=datetime.datetime.now)
+    hits = Column(Integer, nullable=False, default=0)
+    latency_ms = Column(Integer, nullable=False, default=0)  # 首次生成这条回复花费的时间
+    tokens = Column(Integer, nullable=False, default=0)  # 首次生成这条回复消耗的估算token数
+
+
+class KikaikenAccessList(Base):
+    """
+    访问控制名单，list_type 为 group_whitelist（群聊白名单）或 user_blacklist（用户黑名单）
+    """
+    __tablename__ = "kikaiken_access_list"
+    __table_args__ = (Index("uq_kikaiken_access_list_type_target", "list_type", "target_id", unique=True),)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    list_type = Column(String(32), nullable=False)
+    target_id = Column(Integer, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.datetime.now)
+
+
+class KikaikenActivityBitmap(Base):
+    """
+    每日活跃用户位图，第 n 位表示 kikaiken_user.id 为 n 的用户当天是否活跃
+    """
+    __tablename__ = "kikaiken_activity_bitmap"
+    day = Column(Date, primary_key=True)
+    bitmap = Column(LargeBinary, nullable=False)
+    active_count = Column(Integer, nullable=False, default=0)
+
+
+class KikaikenCoinLedger(Base):
+    """
+    硬币流水，只追加不修改，balance 为这笔变动之后的余额
+    """
+    __tablename__ = "kikaiken_coin_ledger"
+    __table_args__ = (Index("ix_kikaiken_coin_ledger_qid_id", "qid", "id"),)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    qid = Column(Integer, nullable=False)
+    delta = Column(Integer, nullable=False)
+    balance = Column(Integer, nullable=False)
+    reason = Column(String(64), nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.datetime.now)
+
+
+class KikaikenBackpackItem(Base):
+    """
+    背包物品，每个用户的每种物品一行
+    """
+    __tablename__ = "kikaiken_backpack_item"
+    __table_args__ = (Index("uq_kikaiken_backpack_item_qid_item", "qid", "item_id", unique=True),)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    qid = Column(Integer, nullable=False)
+    item_id = Column(String(64), nullable=False)
+    count = Column(Integer, nullable=False, default=0)
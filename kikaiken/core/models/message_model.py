@@ -1,5 +1,30 @@
+import asyncio
+import math
+from abc import ABC, abstractmethod
 from io import BytesIO
 
+from kikaiken.core.text import text_find_no_result, text_need_no_paging, text_need_paging, text_paging_too_large
+from kikaiken.utils.image_store import image_store
+from kikaiken.utils.render import text_renderer
+
+
+class PageSource(ABC):
+    """
+    分页数据源，只在需要时读取某一页的内容
+    """
+
+    @abstractmethod
+    async def count(self) -> int:
+        """
+        数据总行数
+        """
+
+    @abstractmethod
+    async def fetch(self, page_num: int, rows_per_page: int) -> list[str]:
+        """
+        读取第 page_num 页的内容，页码从 1 开始
+        """
+
 
 class MessageModel:
     content: list[str]  # 文本内容，可以多行，每行是一个字符串
@@ -7,6 +32,15 @@ class MessageModel:
     is_paged: bool  # 是否分页，如果为True，则将展示分页内容
     paged_content: list[str]  # 分页内容，每页是一个字符串行
     rows_per_page: int  # 每页行数，如果is_paged为True，则该值有效
+    page_source: PageSource | None  # 分页数据源，设置后分页内容按页从数据源读取，不再使用paged_content
+
+    def __init__(self):
+        self.content = []
+        self.image = []
+        self.is_paged = False
+        self.paged_content = []
+        self.rows_per_page = 15
+        self.page_source = None
 
     def get_page_count(self) -> int:
         """
@@ -14,8 +48,24 @@ class MessageModel:
         """
         if not self.is_paged:
             return 1
+        return max(1, math.ceil(len(self.paged_content) / self.rows_per_page))
+
+    async def get_row_count(self) -> int:
+        """
+        分页内容的总行数
+        """
+        if self.page_source is not None:
+            return await self.page_source.count()
         return len(self.paged_content)
 
+    async def fetch_page_count(self) -> int:
+        """
+        计算分页数量，设置了分页数据源时从数据源获取总行数
+        """
+        if not self.is_paged:
+            return 1
+        return max(1, math.ceil(await self.get_row_count() / self.rows_per_page))
+
     def add_content(self, content: str | list[str]):
         if isinstance(content, str):
             self.content.append(content)
@@ -42,6 +92,10 @@ class MessageModel:
         else:
             raise TypeError("paged_content must be str or list[str]")
 
+    def set_page_source(self, page_source: PageSource):
+        self.is_paged = True
+        self.page_source = page_source
+
     def get_content(self):
         return "\n".join(self.content)
 
@@ -53,12 +107,53 @@ class MessageModel:
         end_row = page_num * self.rows_per_page
         return "\n".join(self.paged_content[start_row:end_row])
 
+    async def fetch_paged_content(self, page_num: int = 1):
+        if self.page_source is None:
+            return self.get_paged_content(page_num)
+        return "\n".join(await self.page_source.fetch(page_num, self.rows_per_page))
+
+    async def render_page(self, page_num: int = 1) -> str:
+        """
+        生成某一页的完整回复文本，包括结果数量和页码提示
+        """
+        if not self.is_paged:
+            return self.get_content()
+        result_count = await self.get_row_count()
+        if result_count == 0:
+            return text_find_no_result()
+        total_page = await self.fetch_page_count()
+        if page_num > total_page or page_num < 1:
+            return text_paging_too_large(total_page)
+        paged_result = await self.fetch_paged_content(page_num)
+        if total_page == 1:
+            return text_need_no_paging(paged_result, result_count)
+        return text_need_paging(paged_result, result_count, page_num, total_page)
+
+    async def render_image(self, page_num: int = 1) -> BytesIO:
+        """
+        把某一页的回复文本渲染成图片
+        """
+        return await text_renderer.render(await self.render_page(page_num))
+
+    async def render_long(self, page_num: int = 1) -> str | BytesIO:
+        """
+        某一页的回复文本较长时渲染成图片，否则返回文本
+        """
+        return await text_renderer.render_long(await self.render_page(page_num))
+
+    async def resolve_images(self):
+        """
+        把图片链接替换为本地缓存的图片，相同的图片不会被重复下载
+        """
+        self.image = list(await asyncio.gather(*(image_store.resolve(image) for image in self.image)))
+
     def get_image(self, index: int = 0):
         return self.image[index]
 
 
 def create_message(content: str | list[str] = None, image: BytesIO | str | list[BytesIO | str] | None = None,
-                   paged_content: str | list[str] | None = None, rows_per_page: int = 15):
+                   paged_content: str | list[str] | None = None, rows_per_page: int = 15,
+                   page_source: PageSource | None = None):
     message = MessageModel()
     if content:
         message.add_content(content)
@@ -66,5 +161,7 @@ def create_message(content: str | list[str] = None, image: BytesIO | str | list[
         message.add_image(image)
     if paged_content:
         message.add_paged_content(paged_content)
+    if page_source:
+        message.set_page_source(page_source)
     message.rows_per_page = rows_per_page
     return message
@@ -0,0 +1,102 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from nonebot import logger
+from nonebot.adapters import Bot, Event, Message
+
+OUTBOUND_MAX_NODES = int(os.getenv("OUTBOUND_MAX_NODES", "50"))  # 一条合并转发消息中最多包含的消息数
+OUTBOUND_FLUSH_INTERVAL = float(os.getenv("OUTBOUND_FLUSH_INTERVAL", "2"))  # 缓冲的消息最多等待多久发送，单位秒
+OUTBOUND_NICKNAME = os.getenv("OUTBOUND_NICKNAME", "冰犬")  # 合并转发消息中显示的发送者名称
+
+
+class OutboundBuffer:
+    """
+    出站消息缓冲
+
+    一次处理过程中发送的多条消息先缓存起来，数量达到 max_nodes 或等待超过 flush_interval 时
+    作为一条合并转发消息发出；只有一条消息时直接发送，合并转发失败时合并成一条普通消息发送。
+    """
+    max_nodes: int
+    flush_interval: float
+    api_calls: int = 0  # 所有缓冲区发送消息的 API 调用次数，包括合并转发和回退的普通消息
+
+    def __init__(self, bot: Bot, event: Event, max_nodes: int = OUTBOUND_MAX_NODES,
+                 flush_interval: float = OUTBOUND_FLUSH_INTERVAL):
+        self.bot = bot
+        self.event = event
+        self.max_nodes = max_nodes
+        self.flush_interval = flush_interval
+        self._messages: list[str | Message] = []
+        self._timer: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+        self.buffered = 0
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    async def add(self, message: str | Message):
+        self._messages.append(message)
+        self.buffered += 1
+        if len(self._messages) >= self.max_nodes:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self._timer = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"发送缓冲消息失败：{e}")
+
+    async def flush(self):
+        if self._timer is not None and self._timer is not asyncio.current_task():
+            self._timer.cancel()
+            self._timer = None
+        async with self._lock:
+            if not self._messages:
+                return
+            messages, self._messages = self._messages, []
+            await self._send(messages)
+
+    async def _send(self, messages: list[str | Message]):
+        if len(messages) > 1:
+            nodes = [
+                {"type": "node", "data": {"name": OUTBOUND_NICKNAME, "uin": self.bot.self_id, "content": message}}
+                for message in messages
+            ]
+            group_id = getattr(self.event, "group_id", None)
+            try:
+                OutboundBuffer.api_calls += 1
+                if group_id is not None:
+                    await self.bot.call_api("send_group_forward_msg", group_id=group_id, messages=nodes)
+                else:
+                    await self.bot.call_api("send_private_forward_msg", user_id=int(self.event.get_user_id()),
+                                            messages=nodes)
+                return
+            except Exception as e:
+                logger.warning(f"发送合并转发消息失败，改为发送普通消息：{e}")
+        OutboundBuffer.api_calls += 1
+        message = messages[0]
+        for item in messages[1:]:
+            message = message + "\n" + item
+        await self.bot.send(self.event, message)
+
+    async def close(self):
+        await self.flush()
+
+
+@asynccontextmanager
+async def coalesce(bot: Bot, event: Event, max_nodes: int = OUTBOUND_MAX_NODES,
+                   flush_interval: float = OUTBOUND_FLUSH_INTERVAL) -> AsyncIterator[OutboundBuffer]:
+    """
+    在代码块中缓冲发送的消息，离开代码块时发送剩余的消息
+    """
+    buffer = OutboundBuffer(bot, event, max_nodes, flush_interval)
+    try:
+        yield buffer
+    finally:
+        await buffer.close()
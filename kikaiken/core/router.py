@@ -0,0 +1,183 @@
+import asyncio
+import os
+from collections import deque
+from typing import AsyncIterator, Callable
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from nonebot import logger
+
+from kikaiken.core.key_manager import key_pool, NoAvailableKeyError
+from kikaiken.core.memory import estimate_tokens
+
+ROUTER_HEDGE = os.getenv("ROUTER_HEDGE", "true").lower() == "true"  # 是否启用对冲请求
+ROUTER_HEDGE_DEFAULT = float(os.getenv("ROUTER_HEDGE_DEFAULT", "3"))  # 样本不足时使用的对冲阈值，单位秒
+ROUTER_HEDGE_MIN = float(os.getenv("ROUTER_HEDGE_MIN", "0.5"))
+ROUTER_HEDGE_MAX = float(os.getenv("ROUTER_HEDGE_MAX", "10"))
+ROUTER_TTFT_WINDOW = int(os.getenv("ROUTER_TTFT_WINDOW", "50"))  # 计算首 token 延迟分位数的样本数
+ROUTER_TTFT_MIN_SAMPLES = 5
+
+
+class Provider:
+    """
+    一个模型服务商，负责从 key_pool 中取key并发起流式请求，同时统计首 token 延迟
+    """
+    name: str
+    model_type: str
+    model_name: str
+
+    def __init__(self, name: str, model_type: str, model_name: str, create_llm: Callable[[str], BaseChatModel]):
+        self.name = name
+        self.model_type = model_type
+        self.model_name = model_name
+        self._create_llm = create_llm
+        self._llms: dict[str, BaseChatModel] = {}
+        self.ttft: deque[float] = deque(maxlen=ROUTER_TTFT_WINDOW)
+        self.wins = 0
+        self.errors = 0
+
+    def llm(self, api_key: str) -> BaseChatModel:
+        """
+        获取使用指定key的模型实例
+        """
+        if (llm := self._llms.get(api_key)) is None:
+            llm = self._llms[api_key] = self._create_llm(api_key)
+        return llm
+
+    def available(self) -> bool:
+        return key_pool.has_keys(self.model_type, self.model_name)
+
+    def hedge_threshold(self) -> float:
+        """
+        对冲阈值：最近首 token 延迟的 p90，限制在 [ROUTER_HEDGE_MIN, ROUTER_HEDGE_MAX] 之间
+        """
+        if len(self.ttft) < ROUTER_TTFT_MIN_SAMPLES:
+            return ROUTER_HEDGE_DEFAULT
+        samples = sorted(self.ttft)
+        p90 = samples[int(0.9 * (len(samples) - 1))]
+        return min(max(p90, ROUTER_HEDGE_MIN), ROUTER_HEDGE_MAX)
+
+    async def astream(self, messages: list[BaseMessage]) -> AsyncIterator[str]:
+        tokens = sum(estimate_tokens(message.content) for message in messages)
+        async with key_pool.acquire(self.model_type, self.model_name, tokens) as lease:
+            async for chunk in self.llm(lease.key).astream(messages):
+                # 推理内容保存在 additional_kwargs["reasoning_content"] 中，不会展示给用户
+                if isinstance(chunk.content, str) and chunk.content:
+                    yield chunk.content
+
+
+class _Attempt:
+    """
+    向某个服务商发起的一次请求，first 任务负责等待第一段输出
+    """
+
+    def __init__(self, provider: Provider, messages: list[BaseMessage]):
+        loop = asyncio.get_running_loop()
+        self.provider = provider
+        self.started = loop.time()
+        self.first_at: float | None = None
+        self.stream = provider.astream(messages)
+        self.first = asyncio.create_task(self._first())
+
+    async def _first(self) -> tuple[bool, str | None]:
+        try:
+            chunk = await anext(self.stream)
+        except StopAsyncIteration:
+            chunk = None
+        self.first_at = asyncio.get_running_loop().time()
+        return chunk is not None, chunk
+
+    def elapsed(self) -> float:
+        """
+        首段输出的耗时；还没有输出时返回已经等待的时间，可以作为首 token 延迟的下限
+        """
+        end = self.first_at if self.first_at is not None else asyncio.get_running_loop().time()
+        return end - self.started
+
+    async def cancel(self):
+        self.first.cancel()
+        await asyncio.gather(self.first, return_exceptions=True)
+        await self.stream.aclose()
+
+
+class LLMRouter:
+    """
+    多服务商路由
+
+    按配置顺序选择第一个可用的服务商；如果它在对冲阈值内还没有产出第一段内容，
+    就向下一个服务商发起对冲请求，谁先产出就用谁，另一个请求会被取消；
+    请求在产出内容之前出错时立即切换到下一个服务商。
+    """
+    providers: list[Provider]
+
+    def __init__(self, providers: list[Provider]):
+        self.providers = providers
+
+    def stats(self) -> dict:
+        return {
+            provider.name: {
+                "wins": provider.wins,
+                "errors": provider.errors,
+                "hedge_threshold": provider.hedge_threshold(),
+            }
+            for provider in self.providers
+        }
+
+    async def astream(self, messages: list[BaseMessage]) -> AsyncIterator[str]:
+        loop = asyncio.get_running_loop()
+        candidates = deque(provider for provider in self.providers if provider.available())
+        if not candidates:
+            raise NoAvailableKeyError("没有可用的模型服务商")
+        attempts: list[_Attempt] = [_Attempt(candidates.popleft(), messages)]
+        winner: _Attempt | None = None
+        has_output = False
+        first_chunk = None
+        last_error: BaseException | None = None
+        try:
+            while winner is None:
+                if not attempts:
+                    if not candidates:
+                        raise last_error
+                    attempts.append(_Attempt(candidates.popleft(), messages))
+                timeout = None
+                if ROUTER_HEDGE and candidates and len(attempts) == 1:
+                    primary = attempts[0]
+                    timeout = max(primary.started + primary.provider.hedge_threshold() - loop.time(), 0)
+                done, _ = await asyncio.wait([attempt.first for attempt in attempts], timeout=timeout,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedge = _Attempt(candidates.popleft(), messages)
+                    logger.info(f"路由：{attempts[0].provider.name} 超过 {timeout:.2f} 秒没有输出，"
+                                f"向 {hedge.provider.name} 发起对冲请求")
+                    attempts.append(hedge)
+                    continue
+                for attempt in list(attempts):
+                    if attempt.first not in done:
+                        continue
+                    if (error := attempt.first.exception()) is not None:
+                        attempt.provider.errors += 1
+                        last_error = error
+                        attempts.remove(attempt)
+                        await attempt.cancel()
+                        logger.warning(f"路由：{attempt.provider.name} 请求失败，切换服务商：{error}")
+                        continue
+                    winner = attempt
+                    has_output, first_chunk = attempt.first.result()
+                    break
+            for attempt in attempts:
+                if attempt is not winner:
+                    logger.info(f"路由：{winner.provider.name} 先产出内容，取消 {attempt.provider.name} 的请求")
+                    # 输掉的请求也要计入统计，否则样本只剩下较快的那些，对冲阈值会越来越低
+                    attempt.provider.ttft.append(attempt.elapsed())
+                    await attempt.cancel()
+            attempts = [winner]
+            winner.provider.wins += 1
+            winner.provider.ttft.append(winner.elapsed())
+            logger.debug(f"路由：使用 {winner.provider.name}，首段输出耗时 {winner.elapsed():.2f} 秒")
+            if has_output:
+                yield first_chunk
+                async for chunk in winner.stream:
+                    yield chunk
+        finally:
+            for attempt in attempts:
+                await attempt.cancel()
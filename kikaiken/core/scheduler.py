@@ -0,0 +1,141 @@
+import asyncio
+import os
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from nonebot import get_driver, logger
+
+from kikaiken.core.data_manager import find_user_by_qid
+
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))  # 同时进行的模型生成数量上限
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "20"))  # 排队超过这个时间就直接回复繁忙，单位秒
+
+PRIORITY_SUPERUSER = 100
+PRIORITY_DEFAULT = 0
+PRIORITY_BACKGROUND = -1  # 摘要等后台任务
+
+
+class SchedulerBusyError(Exception):
+    """
+    排队超时，没有等到生成名额
+    """
+
+
+async def get_priority(uid: int) -> int:
+    """
+    计算用户的调度优先级：超级用户最高，其次按权限组从高到低，其余用户为默认优先级
+    """
+    if str(uid) in get_driver().config.superusers:
+        return PRIORITY_SUPERUSER
+    user = await find_user_by_qid(uid)
+    if user is not None and user.permission_group:
+        return min(int(user.permission_group), PRIORITY_SUPERUSER - 1)
+    return PRIORITY_DEFAULT
+
+
+class LLMScheduler:
+    """
+    全局的模型生成调度器
+
+    同时进行的生成数量不超过 max_concurrency，超出的请求进入排队：
+    高优先级的队列先出队，同一优先级内按用户轮询，避免单个用户占满所有名额。
+    """
+    max_concurrency: int
+    queue_timeout: float
+    running: int
+
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY, queue_timeout: float = LLM_QUEUE_TIMEOUT):
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self.running = 0
+        # 优先级 -> (用户 -> 该用户的等待队列)，OrderedDict 的顺序就是轮询顺序
+        self._queues: dict[int, OrderedDict[int, deque[asyncio.Future]]] = {}
+        self.granted = 0
+        self.rejected = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+
+    def depth(self) -> int:
+        return sum(len(waiters) for queue in self._queues.values() for waiters in queue.values())
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "queued": {priority: sum(len(w) for w in queue.values()) for priority, queue in self._queues.items()},
+            "max_depth": self.max_depth,
+            "granted": self.granted,
+            "rejected": self.rejected,
+            "avg_wait": self.total_wait / self.granted if self.granted else 0.0,
+        }
+
+    @asynccontextmanager
+    async def slot(self, uid: int, priority: int = PRIORITY_DEFAULT) -> AsyncIterator[None]:
+        """
+        占用一个生成名额，排队超时抛出 SchedulerBusyError
+        """
+        await self._acquire(uid, priority)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, uid: int, priority: int):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        if self.running < self.max_concurrency and not self.depth():
+            self.running += 1
+            self.granted += 1
+            return
+        future = loop.create_future()
+        self._queues.setdefault(priority, OrderedDict()).setdefault(uid, deque()).append(future)
+        self.max_depth = max(self.max_depth, self.depth())
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # 名额恰好在超时或取消的同时分配下来，需要归还
+                self._release()
+            else:
+                future.cancel()
+                self._discard(priority, uid, future)
+            if isinstance(e, asyncio.TimeoutError):
+                self.rejected += 1
+                logger.warning(f"用户 {uid} 的生成请求排队超时，当前排队 {self.depth()} 个")
+                raise SchedulerBusyError() from e
+            raise
+        self.granted += 1
+        self.total_wait += loop.time() - start
+
+    def _discard(self, priority: int, uid: int, future: asyncio.Future):
+        queue = self._queues.get(priority)
+        if queue is None or uid not in queue:
+            return
+        waiters = queue[uid]
+        if future in waiters:
+            waiters.remove(future)
+        if not waiters:
+            del queue[uid]
+        if not queue:
+            del self._queues[priority]
+
+    def _release(self):
+        self.running -= 1
+        while self.running < self.max_concurrency and self._queues:
+            priority = max(self._queues)
+            queue = self._queues[priority]
+            uid, waiters = next(iter(queue.items()))
+            future = waiters.popleft()
+            if waiters:
+                queue.move_to_end(uid)  # 轮到下一个用户
+            else:
+                del queue[uid]
+            if not queue:
+                del self._queues[priority]
+            if future.done():
+                continue
+            self.running += 1
+            future.set_result(None)
+
+
+llm_scheduler = LLMScheduler()
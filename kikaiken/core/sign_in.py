@@ -0,0 +1,134 @@
+import asyncio
+import datetime
+import hashlib
+import os
+
+from nonebot import logger
+
+from kikaiken.core.economy import economy
+from kikaiken.core.user_manager import user_scope
+
+SIGN_SEED = os.getenv("SIGN_SEED", "kikaiken")  # 幸运值的随机种子，修改后所有人的幸运值都会变化
+SIGN_BASE_COIN = int(os.getenv("SIGN_BASE_COIN", "10"))  # 签到的基础硬币奖励
+SIGN_LUCKY_COIN_DIVISOR = int(os.getenv("SIGN_LUCKY_COIN_DIVISOR", "10"))  # 每多少点幸运值额外奖励一枚硬币
+SIGN_BATCH_WINDOW = float(os.getenv("SIGN_BATCH_WINDOW", "0.05"))  # 签到请求攒批的等待时间，单位秒
+SIGN_BATCH_SIZE = int(os.getenv("SIGN_BATCH_SIZE", "200"))  # 单个事务中最多处理的签到数量
+
+
+def compute_lucky(qid: int, day: datetime.date) -> int:
+    """
+    计算用户某一天的幸运值，范围为 0 到 100，同一天的结果总是相同
+    """
+    digest = hashlib.sha256(f"{SIGN_SEED}:{qid}:{day.isoformat()}".encode()).digest()
+    return int.from_bytes(digest[:8], "big") % 101
+
+
+def compute_reward(lucky: int) -> int:
+    return SIGN_BASE_COIN + lucky // SIGN_LUCKY_COIN_DIVISOR
+
+
+class SignInResult:
+    signed: bool  # 为 False 时表示今天已经签到过
+    lucky: int
+    coin: int  # 本次获得的硬币
+    balance: int | None  # 签到后的硬币数，已经签到过时为 None
+
+    def __init__(self, signed: bool, lucky: int, coin: int, balance: int | None):
+        self.signed = signed
+        self.lucky = lucky
+        self.coin = coin
+        self.balance = balance
+
+
+class SignInEngine:
+    """
+    签到
+
+    幸运值由qq号和日期计算得出，不需要读取数据库；签到判断、幸运值和签到记录在一条条件 UPDATE 中完成，
+    不会出现重复签到，硬币奖励通过 economy 在同一个事务中发放。同时到达的签到请求会在 batch_window 内攒成一批，
+    在同一个事务中处理，同一个用户在一批中的重复请求只会处理一次。
+    """
+    batch_window: float
+    batch_size: int
+
+    def __init__(self, batch_window: float = SIGN_BATCH_WINDOW, batch_size: int = SIGN_BATCH_SIZE):
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self._pending: dict[int, asyncio.Future] = {}
+        self._timer: asyncio.Task | None = None
+        self._tasks: set[asyncio.Task] = set()
+        self.batches = 0
+        self.signed = 0
+
+    async def sign_in(self, qid: int) -> SignInResult:
+        future = self._pending.get(qid)
+        if future is None:
+            future = self._pending[qid] = asyncio.get_running_loop().create_future()
+            if len(self._pending) >= self.batch_size:
+                self._flush_now()
+            elif self._timer is None:
+                self._timer = self._track(asyncio.create_task(self._flush_later()))
+        return await asyncio.shield(future)
+
+    def _track(self, task: asyncio.Task) -> asyncio.Task:
+        # 事件循环只保留任务的弱引用，任务在结束前必须一直留在 _tasks 中
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.batch_window)
+        self._timer = None
+        await self._flush(self._take())
+
+    def _flush_now(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._track(asyncio.create_task(self._flush(self._take())))
+
+    def _take(self) -> dict[int, asyncio.Future]:
+        pending, self._pending = self._pending, {}
+        return pending
+
+    async def _flush(self, pending: dict[int, asyncio.Future]):
+        if not pending:
+            return
+        today = datetime.date.today()
+        results = {}
+        try:
+            async with user_scope() as scope:
+                # 第一次签到的用户先创建账户
+                await scope.create_users(pending)
+                rewards = {}
+                for qid in pending:
+                    lucky = compute_lucky(qid, today)
+                    if await scope.sign_in(qid, today, lucky, compute_reward(lucky)):
+                        rewards[qid] = compute_reward(lucky)
+                    else:
+                        results[qid] = SignInResult(False, lucky, 0, None)
+                # 硬币和签到日期在同一个事务中写入，要么都生效，要么都不生效
+                balances = await economy.add_many({qid: coin for qid, coin in rewards.items() if coin > 0}, "签到",
+                                                  scope)
+        except Exception as e:
+            logger.error(f"签到失败：{e}")
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        except BaseException:
+            # 批次被取消（例如关闭时）也不能让等待中的请求永远挂起
+            logger.warning(f"签到批次被中断，{len(pending)} 个签到请求被取消")
+            for future in pending.values():
+                future.cancel()
+            raise
+        for qid, coin in rewards.items():
+            results[qid] = SignInResult(True, compute_lucky(qid, today), coin, balances.get(qid))
+        self.batches += 1
+        self.signed += sum(result.signed for result in results.values())
+        for qid, future in pending.items():
+            if not future.done():
+                future.set_result(results[qid])
+
+
+sign_in_engine = SignInEngine()
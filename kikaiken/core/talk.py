@@ -1,7 +1,128 @@
 # 提供一个talk函数接口用于封装对话功能
+import hashlib
+import os
+import time
+from io import BytesIO
+from typing import AsyncIterator
+
+from langchain_core.messages import BaseMessage, SystemMessage, HumanMessage
+from langchain_deepseek import ChatDeepSeek
 from nonebot import logger
 
+from kikaiken.core.key_manager import DEEPSEEK_MODEL
+from kikaiken.core.llm import ChatSiliconFlow
+from kikaiken.core.llm_cache import response_cache, normalize_prompt
+from kikaiken.core.memory import conversation_store, Turn, estimate_tokens
+from kikaiken.core.router import Provider, LLMRouter
+from kikaiken.core.scheduler import llm_scheduler, get_priority, SchedulerBusyError, PRIORITY_BACKGROUND
+from kikaiken.core.text import text_global_exception, text_llm_busy
+from kikaiken.utils.http import get_async_client
+from kikaiken.utils.render import text_renderer
+from kikaiken.utils.singleflight import StreamGroup
+from kikaiken.utils.stream import SentenceSplitter, split_sentences, paced
+
+TALK_MODEL = os.getenv("TALK_MODEL", "deepseek-ai/DeepSeek-V3")
+TALK_SYSTEM_PROMPT = os.getenv("TALK_SYSTEM_PROMPT", "你是冰犬，一只友善的机械犬对话助手。")
+TALK_SEND_INTERVAL = float(os.getenv("TALK_SEND_INTERVAL", "1.0"))  # 两条消息之间的最小间隔，单位秒
+TALK_PROVIDERS = os.getenv("TALK_PROVIDERS", "siliconflow,deepseek")  # 按优先顺序排列的模型服务商
+
+# 内容相同的并发请求共享同一次上游生成
+_flights = StreamGroup()
+
+_providers = {
+    "siliconflow": Provider("siliconflow", "siliconflow", TALK_MODEL, lambda api_key: ChatSiliconFlow(
+        model=TALK_MODEL, api_key=api_key, streaming=True, skip_sync_client=True)),
+    "deepseek": Provider("deepseek", "deepseek", DEEPSEEK_MODEL, lambda api_key: ChatDeepSeek(
+        model=DEEPSEEK_MODEL, api_key=api_key, streaming=True, http_async_client=get_async_client())),
+}
+llm_router = LLMRouter([_providers[name.strip()] for name in TALK_PROVIDERS.split(",") if name.strip() in _providers])
+
+
+def _count_tokens(messages: list[BaseMessage]) -> int:
+    return sum(estimate_tokens(message.content) for message in messages)
+
+
+async def _astream_text(uid: int, priority: int, messages: list[BaseMessage]) -> AsyncIterator[str]:
+    """
+    以流的形式读取模型输出的正文，先在 llm_scheduler 中排队，再交给 llm_router 选择服务商
+    """
+    async with llm_scheduler.slot(uid, priority):
+        async for chunk in llm_router.astream(messages):
+            yield chunk
+
+
+async def _summarize(summary: str, turns: list[Turn]) -> str:
+    """
+    把被移出上下文的对话合并进摘要
+    """
+    transcript = "\n".join(f"{'用户' if turn.role == 'user' else '你'}：{turn.content}" for turn in turns)
+    messages = [
+        SystemMessage("请把已有摘要和新的对话合并成一份新的摘要，保留用户的偏好、事实和未完成的话题，不超过300字，只输出摘要本身。"),
+        HumanMessage(f"已有摘要：\n{summary or '（无）'}\n\n新的对话：\n{transcript}"),
+    ]
+    async with llm_scheduler.slot(0, PRIORITY_BACKGROUND):
+        return "".join([chunk async for chunk in llm_router.astream(messages)])
 
-async def talk_v1(uid: int, content: str):
+
+conversation_store.set_summarizer(_summarize)
+
+
+def _flight_key(messages: list[BaseMessage]) -> str:
+    raw = "\x00".join(f"{message.type}:{normalize_prompt(message.content)}" for message in messages)
+    return hashlib.sha256(f"{TALK_MODEL}\x00{raw}".encode()).hexdigest()
+
+
+async def _replay(text: str) -> AsyncIterator[str]:
+    yield text
+
+
+async def talk_stream(uid: int, content: str, use_cache: bool | None = None,
+                      send_interval: float = TALK_SEND_INTERVAL) -> AsyncIterator[str]:
+    """
+    流式对话，按句子或段落逐段产出回复，相邻两段至少间隔 send_interval 秒，为 0 时不限制
+
+    use_cache 为 None 时，只有没有对话历史的请求才会使用回复缓存；传入 False 可以强制跳过缓存
+    """
     logger.info(f"用户 {uid} 发送了消息：{content}")
-    return content
+    reply = []
+    cached = None
+    start = time.monotonic()
+    try:
+        conversation = await conversation_store.get(uid)
+        if use_cache is None:
+            use_cache = not conversation.has_history()
+        if use_cache:
+            cached = await response_cache.get(TALK_MODEL, TALK_SYSTEM_PROMPT, content)
+        if cached is not None:
+            chunks = _replay(cached)
+        else:
+            messages = conversation.build_messages(TALK_SYSTEM_PROMPT, content)
+            priority = await get_priority(uid)
+            chunks = _flights.stream(_flight_key(messages), lambda: _astream_text(uid, priority, messages))
+        segments = split_sentences(chunks, SentenceSplitter())
+        if send_interval > 0:
+            segments = paced(segments, send_interval)
+        async for segment in segments:
+            reply.append(segment)
+            yield segment
+    except SchedulerBusyError:
+        yield text_llm_busy()
+        return
+    except Exception as e:
+        logger.error(f"对话失败：{e}")
+        yield text_global_exception()
+        return
+    text = "\n".join(reply)
+    if use_cache and cached is None and text:
+        latency_ms = int((time.monotonic() - start) * 1000)
+        await response_cache.put(TALK_MODEL, TALK_SYSTEM_PROMPT, content, text, latency_ms,
+                                 _count_tokens(messages) + estimate_tokens(text))
+    # 只有完整生成的回复才会被记入对话上下文
+    await conversation_store.append(uid, "user", content)
+    await conversation_store.append(uid, "assistant", text)
+
+
+async def talk_v1(uid: int, content: str) -> str | BytesIO:
+    # 一次性返回整个回复，不需要按发送间隔等待，较长的回复渲染成图片
+    segments = [segment async for segment in talk_stream(uid, content, send_interval=0)]
+    return await text_renderer.render_long("\n".join(segments))
@@ -40,3 +40,32 @@ def text_be_kicked_from_group(group_id: int):
 
 def text_be_muted_in_group(group_id: int, oprator_id: int):
     return f">>> 「Kikaiken System」 \n\n群聊 {group_id} 里的管理员 {oprator_id} 把我禁言了，我什么都没干，信我啊！"
+
+
+def text_apikey_added(model_type: str, model_name: str):
+    return f">>> 「Kikaiken System」 \n\n{model_type} {model_name} 的API密钥已经添加好了，马上就能用上！"
+
+
+def text_apikey_deleted(key_id: int):
+    return f">>> 「Kikaiken System」 \n\nAPI密钥 {key_id} 已经被我删除了！"
+
+
+def text_llm_busy():
+    return ">>> 「Kikaiken System」 \n\n现在找我聊天的人太多啦，脑子转不过来了，稍等一会儿再来找我吧！"
+
+
+def text_throttled():
+    return ">>> 「Kikaiken System」 \n\n你说得太快啦，我有点跟不上了，歇一会儿再来找我吧！"
+
+
+def text_sign_in_success(lucky: int, coin: int, balance: int):
+    return f">>> 「Kikaiken System」 \n\n签到成功！今天的幸运值是 {lucky}，获得了 {coin} 枚硬币，现在一共有 {balance} 枚硬币~"
+
+
+def text_already_signed(lucky: int):
+    return f">>> 「Kikaiken System」 \n\n今天已经签到过啦，幸运值还是 {lucky}，明天再来吧！"
+
+
+def text_backpack(items: dict[str, int]):
+    content = "\n".join(f"{item_id} × {count}" for item_id, count in items.items())
+    return f">>> 「Kikaiken System」 \n\n你的背包里有这些东西：\n{content}"
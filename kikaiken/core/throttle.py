@@ -0,0 +1,166 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Hashable
+
+from nonebot import get_driver, logger
+
+from kikaiken.core.data_manager import find_user_by_qid
+from kikaiken.utils.rate_limit import TokenBucket
+
+THROTTLE_USER_RPM = float(os.getenv("THROTTLE_USER_RPM", "20"))  # 每个用户每分钟可以触发的次数
+THROTTLE_USER_BURST = float(os.getenv("THROTTLE_USER_BURST", "5"))  # 每个用户允许的突发次数
+THROTTLE_GROUP_RPM = float(os.getenv("THROTTLE_GROUP_RPM", "60"))  # 每个群聊每分钟可以触发的次数
+THROTTLE_GROUP_BURST = float(os.getenv("THROTTLE_GROUP_BURST", "15"))
+THROTTLE_MAX_BUCKETS = int(os.getenv("THROTTLE_MAX_BUCKETS", "10000"))  # 内存中最多保留的令牌桶数量
+THROTTLE_IDLE_SECONDS = float(os.getenv("THROTTLE_IDLE_SECONDS", "600"))  # 令牌桶闲置多久后被回收
+THROTTLE_TALK_RPM = float(os.getenv("THROTTLE_TALK_RPM", "10"))  # 对话每个用户每分钟可以触发的次数
+THROTTLE_TALK_BURST = float(os.getenv("THROTTLE_TALK_BURST", "3"))
+# 权限组对应的额度倍数，格式为 "权限组:倍数,权限组:倍数"，未配置的权限组倍数为 1
+THROTTLE_PERMISSION_MULTIPLIERS = os.getenv("THROTTLE_PERMISSION_MULTIPLIERS", "")
+
+
+def _parse_multipliers(raw: str) -> dict[int, float]:
+    multipliers = {}
+    for item in raw.split(","):
+        if not item.strip():
+            continue
+        try:
+            group, multiplier = item.split(":")
+            multipliers[int(group)] = float(multiplier)
+        except ValueError:
+            logger.error(f"无法解析权限组倍数配置：{item}")
+    return multipliers
+
+
+class ThrottleRule:
+    """
+    限流规则，rpm 为每分钟补充的次数，burst 为允许的突发次数
+
+    deferred 为 True 时不在响应器运行之前检查，由响应器在真正开始处理时自行调用 check，
+    用于会先合并多条消息再处理的响应器
+    """
+    user_rpm: float
+    user_burst: float
+    group_rpm: float
+    group_burst: float
+    deferred: bool
+
+    def __init__(self, user_rpm: float = THROTTLE_USER_RPM, user_burst: float = THROTTLE_USER_BURST,
+                 group_rpm: float = THROTTLE_GROUP_RPM, group_burst: float = THROTTLE_GROUP_BURST,
+                 deferred: bool = False):
+        self.user_rpm = user_rpm
+        self.user_burst = user_burst
+        self.group_rpm = group_rpm
+        self.group_burst = group_burst
+        self.deferred = deferred
+
+
+class _Entry:
+    bucket: TokenBucket
+    used_at: float
+    notified: bool  # 是否已经发送过限流提示
+
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self.used_at = time.monotonic()
+        self.notified = False
+
+
+class RateLimiter:
+    """
+    按用户和群聊限流
+
+    每个响应器可以配置单独的规则，没有配置的使用默认规则；用户的额度按权限组的倍数放大，超级用户不受限制。
+    令牌桶按最近使用顺序保存，闲置超过 idle_seconds 或数量超过 max_buckets 时回收最久未使用的桶。
+    """
+    max_buckets: int
+    idle_seconds: float
+
+    def __init__(self, default_rule: ThrottleRule | None = None, max_buckets: int = THROTTLE_MAX_BUCKETS,
+                 idle_seconds: float = THROTTLE_IDLE_SECONDS):
+        self.default_rule = default_rule or ThrottleRule()
+        self.max_buckets = max_buckets
+        self.idle_seconds = idle_seconds
+        self.multipliers = _parse_multipliers(THROTTLE_PERMISSION_MULTIPLIERS)
+        self._rules: dict[Hashable, ThrottleRule] = {}
+        self._entries: OrderedDict[tuple, _Entry] = OrderedDict()
+        self.passed = 0
+        self.throttled = 0
+        self.evicted = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        return {"buckets": len(self._entries), "passed": self.passed, "throttled": self.throttled,
+                "evicted": self.evicted}
+
+    def set_rule(self, matcher: Hashable, rule: ThrottleRule):
+        """
+        为某个响应器设置单独的限流规则
+        """
+        self._rules[matcher] = rule
+
+    def is_deferred(self, matcher: Hashable) -> bool:
+        return self._rules.get(matcher, self.default_rule).deferred
+
+    def _evict(self, now: float):
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_buckets and now - entry.used_at < self.idle_seconds:
+                break
+            del self._entries[key]
+            self.evicted += 1
+
+    async def _multiplier(self, uid: int) -> float:
+        if not self.multipliers:
+            return 1.0
+        user = await find_user_by_qid(uid)
+        if user is None or user.permission_group is None:
+            return 1.0
+        return self.multipliers.get(int(user.permission_group), 1.0)
+
+    async def _entry(self, key: tuple, rpm: float, burst: float, uid: int | None = None) -> _Entry:
+        entry = self._entries.get(key)
+        if entry is None:
+            # 权限组只在创建令牌桶时查询一次，之后的检查都不需要访问数据库
+            multiplier = await self._multiplier(uid) if uid is not None else 1.0
+            entry = self._entries[key] = _Entry(TokenBucket(rpm * multiplier / 60, burst * multiplier))
+        else:
+            self._entries.move_to_end(key)
+        return entry
+
+    async def check(self, matcher: Hashable, user_id: int | None, group_id: int | None) -> tuple[bool, bool]:
+        """
+        检查一次触发是否放行，返回 (是否放行, 是否需要发送限流提示)
+
+        每个用户或群聊在连续被限流期间只会收到一次提示
+        """
+        if user_id is None or str(user_id) in get_driver().config.superusers:
+            return True, False
+        now = time.monotonic()
+        self._evict(now)
+        rule = self._rules.get(matcher, self.default_rule)
+        entries = [await self._entry(("user", matcher, user_id), rule.user_rpm, rule.user_burst, user_id)]
+        if group_id is not None:
+            entries.append(await self._entry(("group", matcher, group_id), rule.group_rpm, rule.group_burst))
+        for entry in entries:
+            entry.used_at = now
+        blocked = [entry for entry in entries if entry.bucket.wait_time() > 0]
+        if not blocked:
+            for entry in entries:
+                entry.bucket.try_acquire()
+                entry.notified = False
+            self.passed += 1
+            return True, False
+        self.throttled += 1
+        notify = not any(entry.notified for entry in blocked)
+        for entry in blocked:
+            entry.notified = True
+        if notify:
+            logger.info(f"用户 {user_id} 触发过于频繁，已被限流")
+        return False, notify
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,255 @@
+import datetime
+import functools
+import os
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Iterable
+
+from sqlalchemy import select, insert, update, desc, bindparam, Row, or_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from kikaiken.core.db_connect import get_engine
+from kikaiken.core.models.db_model import KikaikenUser, KikaikenUserRecord, ConfigPersistence
+from kikaiken.utils.batch_writer import BatchWriter
+from kikaiken.utils.cache import AsyncLRUCache
+
+# 用户记录的写入器，记录会在内存中攒批后统一写入
+record_writer = BatchWriter(
+    KikaikenUserRecord.__table__,
+    batch_size=int(os.getenv("RECORD_BATCH_SIZE", "100")),
+    flush_interval=float(os.getenv("RECORD_FLUSH_INTERVAL", "1.0")),
+    queue_size=int(os.getenv("RECORD_QUEUE_SIZE", "10000")),
+)
+
+# 用户资料缓存，键为qq号，不存在的用户也会被短暂缓存
+user_cache = AsyncLRUCache(
+    maxsize=int(os.getenv("USER_CACHE_SIZE", "4096")),
+    ttl=float(os.getenv("USER_CACHE_TTL", "300")),
+    negative_ttl=float(os.getenv("USER_CACHE_NEGATIVE_TTL", "30")),
+)
+
+# IN 列表和批量写入的分块大小，避免超过 sqlite 的参数数量上限
+CHUNK_SIZE = int(os.getenv("USER_BULK_CHUNK_SIZE", "500"))
+
+# 预先构造好的语句，参数全部通过 bindparam 传入，使 SQLAlchemy 的编译缓存每次都能命中
+_find_user = select(KikaikenUser).where(KikaikenUser.qid == bindparam("b_qid"))
+_find_users = select(KikaikenUser).where(KikaikenUser.qid.in_(bindparam("b_qids", expanding=True)))
+_insert_user = insert(KikaikenUser)
+_insert_user_ignore = insert(KikaikenUser).prefix_with("OR IGNORE")
+_insert_record = insert(KikaikenUserRecord)
+_query_record = select(KikaikenUserRecord).where(KikaikenUserRecord.qid == bindparam("b_qid")).order_by(
+    desc(KikaikenUserRecord.record_time)).limit(bindparam("b_count"))
+# 只有今天还没有签到的用户才会被更新，签到的判断和写入在同一条语句中完成
+_sign_in = update(KikaikenUser).where(
+    KikaikenUser.qid == bindparam("b_qid"),
+    or_(KikaikenUser.last_sign_date.is_(None), KikaikenUser.last_sign_date < bindparam("b_date")),
+).values(last_sign_date=bindparam("b_date"), lucky=bindparam("b_lucky"))
+_set_lucky = update(KikaikenUser).where(KikaikenUser.qid == bindparam("b_qid")).values(lucky=bindparam("b_lucky"))
+_get_config = select(ConfigPersistence).where(ConfigPersistence.key == bindparam("b_key"))
+_set_config = sqlite_insert(ConfigPersistence).values(key=bindparam("b_key"), value=bindparam("b_value"))
+_set_config = _set_config.on_conflict_do_update(index_elements=["key"], set_={"value": _set_config.excluded.value})
+
+
+def _chunked(items: list) -> Iterable[list]:
+    for i in range(0, len(items), CHUNK_SIZE):
+        yield items[i:i + CHUNK_SIZE]
+
+
+@functools.lru_cache(maxsize=64)
+def _update_user(*columns: str):
+    """
+    按需要更新的列生成 UPDATE 语句，相同的列组合会复用同一个语句对象
+    """
+    return update(KikaikenUser).where(KikaikenUser.qid == bindparam("b_qid")).values(
+        {column: bindparam(column) for column in columns})
+
+
+class UserScope:
+    """
+    用户数据的工作单元
+
+    同一个 scope 内的所有读写共享一个连接和一个事务，
+    产生的用户记录在提交前以一条多行 INSERT 写入，退出 scope 时统一提交。
+    硬币余额由 economy 维护，scope 不直接修改 coin 列，需要一起提交时把 scope 传给 economy.add_many。
+    """
+    conn: AsyncConnection
+
+    def __init__(self, conn: AsyncConnection):
+        self.conn = conn
+        self._records: list[dict] = []
+        self._dirty: set[int] = set()
+        self._rollbacks: list[Callable[[], None]] = []
+
+    async def find_user(self, qid: int) -> Row | None:
+        """
+        通过qq号查找用户，能读到本 scope 内尚未提交的修改
+        """
+        result = await self.conn.execute(_find_user, {"b_qid": qid})
+        return result.fetchone()
+
+    async def create_user(self, qid: int, nickname: str = None, permission_group: int = 0,
+                          is_subscribed: bool = True, lucky: int = 0, last_sign_date: datetime.date = None,
+                          coin: int = 0, last_activity_date: datetime.date = None):
+        """
+        创建用户
+        """
+        await self.conn.execute(_insert_user, {
+            "qid": qid,
+            "nickname": nickname,
+            "permission_group": permission_group,
+            "is_subscribed": is_subscribed,
+            "join_date": datetime.date.today(),
+            "lucky": lucky,
+            "last_sign_date": last_sign_date,
+            "coin": coin,
+            "last_activity_date": last_activity_date,
+        })
+        self._dirty.add(qid)
+
+    async def find_users(self, qids: Iterable[int]) -> dict[int, Row]:
+        """
+        批量查找用户，返回 qq号 -> 用户 的字典，不存在的用户不会出现在结果中
+        """
+        users = {}
+        for chunk in _chunked(list(dict.fromkeys(qids))):
+            result = await self.conn.execute(_find_users, {"b_qids": chunk})
+            users.update((row.qid, row) for row in result.fetchall())
+        return users
+
+    async def create_users(self, qids: Iterable[int], permission_group: int = 0, is_subscribed: bool = True,
+                           coin: int = 0) -> int:
+        """
+        批量创建用户，已存在的用户会被跳过，返回实际创建的数量
+        """
+        today = datetime.date.today()
+        created = 0
+        for chunk in _chunked(list(dict.fromkeys(qids))):
+            result = await self.conn.execute(_insert_user_ignore, [{
+                "qid": qid,
+                "nickname": None,
+                "permission_group": permission_group,
+                "is_subscribed": is_subscribed,
+                "join_date": today,
+                "lucky": 0,
+                "last_sign_date": None,
+                "coin": coin,
+                "last_activity_date": None,
+            } for qid in chunk])
+            created += result.rowcount
+            self._dirty.update(chunk)
+        return created
+
+    async def update_user(self, qid: int, **values) -> int:
+        """
+        更新用户的若干列，返回受影响的行数
+        """
+        result = await self.conn.execute(_update_user(*values), {"b_qid": qid, **values})
+        self._dirty.add(qid)
+        return result.rowcount
+
+    async def set_nickname(self, qid: int, nickname: str):
+        await self.update_user(qid, nickname=nickname)
+        self.add_record(qid, f"修改昵称为：{nickname}")
+
+    async def set_permission_group(self, qid: int, permission_group: int):
+        await self.update_user(qid, permission_group=permission_group)
+        self.add_record(qid, f"权限组被修改为：{permission_group}")
+
+    async def set_subscribe(self, qid: int, is_subscribed: bool):
+        await self.update_user(qid, is_subscribed=is_subscribed)
+        self.add_record(qid, "订阅服务已启用" if is_subscribed else "订阅服务已禁用")
+
+    async def set_lucky(self, qid: int, lucky: int):
+        await self.update_user(qid, lucky=lucky)
+
+    async def set_sign_date(self, qid: int, sign_date: datetime.date):
+        await self.update_user(qid, last_sign_date=sign_date)
+
+    async def set_luckies(self, luckies: dict[int, int]):
+        """
+        批量设置用户幸运值，luckies 为 qq号 -> 幸运值
+        """
+        items = list(luckies.items())
+        for chunk in _chunked(items):
+            await self.conn.execute(_set_lucky, [{"b_qid": qid, "b_lucky": lucky} for qid, lucky in chunk])
+        self._dirty.update(luckies)
+
+    async def sign_in(self, qid: int, sign_date: datetime.date, lucky: int, coin: int) -> bool:
+        """
+        签到并写入幸运值，今天已经签到过或用户不存在时返回 False；
+        签到奖励的硬币由调用方通过 economy.add_many 在同一个 scope 中发放
+        """
+        result = await self.conn.execute(_sign_in, {"b_qid": qid, "b_date": sign_date, "b_lucky": lucky})
+        if not result.rowcount:
+            return False
+        self._dirty.add(qid)
+        self.add_record(qid, f"签到获得硬币：{coin}")
+        return True
+
+    async def update_last_activity_date(self, qid: int):
+        await self.update_user(qid, last_activity_date=datetime.date.today())
+
+    def add_record(self, qid: int, content: str):
+        """
+        添加用户记录，记录会和本 scope 的其他修改一起提交
+        """
+        self._records.append({"qid": qid, "record_time": datetime.datetime.now(), "content": content})
+
+    async def query_record(self, qid: int, count: int):
+        result = await self.conn.execute(_query_record, {"b_qid": qid, "b_count": count})
+        return result.fetchall()
+
+    async def get_config(self, key: str) -> Row | None:
+        result = await self.conn.execute(_get_config, {"b_key": key})
+        return result.fetchone()
+
+    async def set_config(self, key: str, value: str):
+        await self.conn.execute(_set_config, {"b_key": key, "b_value": value})
+
+    def invalidate(self, qids: Iterable[int]):
+        """
+        提交后让这些用户的缓存失效，用于其他模块通过本 scope 的连接修改了用户表的情况
+        """
+        self._dirty.update(qids)
+
+    def on_rollback(self, callback: Callable[[], None]):
+        """
+        注册事务回滚后需要执行的回调，用于撤销内存中已经做出的修改
+        """
+        self._rollbacks.append(callback)
+
+    async def flush(self):
+        """
+        写入本 scope 中积攒的用户记录
+        """
+        if self._records:
+            await self.conn.execute(_insert_record, self._records)
+            self._records = []
+
+
+@asynccontextmanager
+async def user_scope() -> AsyncIterator[UserScope]:
+    """
+    打开一个工作单元，正常退出时一次性提交，出现异常时整体回滚
+
+    用法：
+        async with user_scope() as scope:
+            user = await scope.find_user(qid)
+            await scope.set_nickname(qid, nickname)
+            await economy.add_many({qid: 10}, "改名奖励", scope)
+    """
+    engine = get_engine()
+    scope = None
+    try:
+        async with engine.begin() as conn:
+            scope = UserScope(conn)
+            yield scope
+            await scope.flush()
+    except BaseException:
+        if scope is not None:
+            for callback in scope._rollbacks:
+                callback()
+        raise
+    # 事务提交后再让缓存失效，避免其他协程在提交前重新加载到旧数据
+    for qid in scope._dirty:
+        user_cache.invalidate(qid)
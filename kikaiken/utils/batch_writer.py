@@ -0,0 +1,90 @@
+import asyncio
+from typing import Any
+
+from nonebot import logger
+from sqlalchemy import Table, insert
+
+from kikaiken.core.db_connect import get_engine
+
+_STOP = object()
+
+
+class BatchWriter:
+    """
+    异步批量写入器
+
+    写入请求先进入内存中的有界队列，由后台任务按数量或时间攒成一批，
+    再以一条多行 INSERT 在单个事务中写入数据库。
+    队列满时 put 会等待，以此对调用方施加背压。
+    """
+    table: Table
+    batch_size: int
+    flush_interval: float
+
+    def __init__(self, table: Table, batch_size: int = 100, flush_interval: float = 1.0, queue_size: int = 10000):
+        self.table = table
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._task: asyncio.Task | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        """
+        启动后台写入任务
+        """
+        if not self.running:
+            self._task = asyncio.create_task(self._run())
+
+    async def put(self, row: dict[str, Any]):
+        """
+        将一行数据放入写入队列，写入器未启动时直接写入
+        """
+        if not self.running:
+            await self._flush([row])
+            return
+        await self._queue.put(row)
+
+    async def close(self):
+        """
+        停止后台任务，并把队列中剩余的数据全部写入
+        """
+        if not self.running:
+            return
+        await self._queue.put(_STOP)
+        await self._task
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+
+    async def _flush(self, batch: list[dict[str, Any]]):
+        engine = get_engine()
+        try:
+            async with engine.begin() as conn:
+                await conn.execute(insert(self.table).values(batch))
+        except Exception as e:
+            logger.error(f"批量写入 {self.table.name} 失败，丢弃 {len(batch)} 条数据：{e}")
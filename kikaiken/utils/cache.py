@@ -0,0 +1,145 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+_MISSING = object()
+_NEGATIVE = object()
+
+
+class CacheStats:
+    """
+    缓存命中统计
+    """
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def as_dict(self) -> dict[str, int | float]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": self.hit_rate(),
+        }
+
+
+class AsyncLRUCache:
+    """
+    异步 LRU 缓存
+
+    - 超过 maxsize 时淘汰最久未使用的条目
+    - 每个条目在 ttl 秒后过期
+    - 加载结果为 None 时按 negative_ttl 缓存一个空结果，避免反复查询不存在的数据
+    - 同一个键并发未命中时只会执行一次加载，其余调用等待同一个结果
+    """
+    maxsize: int
+    ttl: float
+    negative_ttl: float
+    stats: CacheStats
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0, negative_ttl: float = 30.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stats = CacheStats()
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._inflight: dict[Hashable, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self._lookup(key) is not _MISSING
+
+    def _lookup(self, key: Hashable) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            return _MISSING
+        expire_at, value = entry
+        if expire_at < time.monotonic():
+            del self._data[key]
+            self.stats.expirations += 1
+            return _MISSING
+        self._data.move_to_end(key)
+        return value
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        读取缓存，未命中或命中空结果时返回 default
+        """
+        value = self._lookup(key)
+        if value is _MISSING:
+            self.stats.misses += 1
+            return default
+        self.stats.hits += 1
+        return default if value is _NEGATIVE else value
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None):
+        """
+        写入缓存，value 为 None 时按空结果缓存
+        """
+        if value is None:
+            value = _NEGATIVE
+            ttl = self.negative_ttl if ttl is None else ttl
+        elif ttl is None:
+            ttl = self.ttl
+        if ttl <= 0:
+            self._data.pop(key, None)
+            return
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.stats.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        """
+        使某个键失效，正在进行中的加载结果也不会再被写入缓存
+        """
+        self._data.pop(key, None)
+        self._inflight.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+        self._inflight.clear()
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        读取缓存，未命中时调用 loader 加载并写入缓存
+        """
+        value = self._lookup(key)
+        if value is not _MISSING:
+            self.stats.hits += 1
+            return None if value is _NEGATIVE else value
+        self.stats.misses += 1
+
+        future = self._inflight.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await loader()
+        except BaseException as e:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+            if isinstance(e, Exception):
+                future.set_exception(e)
+                # 标记异常已被读取，避免没有其他等待者时出现 "exception was never retrieved" 警告
+                future.exception()
+            else:
+                future.cancel()
+            raise
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+            self.set(key, value)
+        future.set_result(value)
+        return value
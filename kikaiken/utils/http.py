@@ -0,0 +1,65 @@
+import importlib.util
+import os
+
+import httpx
+from nonebot import logger
+
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "120"))
+HTTP2 = os.getenv("HTTP2", "false").lower() == "true"
+
+_async_client: httpx.AsyncClient | None = None
+_sync_client: httpx.Client | None = None
+
+
+def _client_options() -> dict:
+    http2 = HTTP2
+    if http2 and importlib.util.find_spec("h2") is None:
+        logger.warning("未安装 h2，HTTP/2 已被禁用")
+        http2 = False
+    return {
+        "limits": httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        "timeout": httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        "http2": http2,
+        "follow_redirects": True,
+    }
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """
+    获取进程内共享的异步 HTTP 客户端，所有请求复用同一个连接池
+    """
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        _async_client = httpx.AsyncClient(**_client_options())
+    return _async_client
+
+
+def get_sync_client() -> httpx.Client:
+    """
+    获取进程内共享的同步 HTTP 客户端
+    """
+    global _sync_client
+    if _sync_client is None or _sync_client.is_closed:
+        _sync_client = httpx.Client(**_client_options())
+    return _sync_client
+
+
+async def close_clients():
+    """
+    关闭共享的 HTTP 客户端，在 driver.on_shutdown 中调用
+    """
+    global _async_client, _sync_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+    if _sync_client is not None:
+        _sync_client.close()
+        _sync_client = None
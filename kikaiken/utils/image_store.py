@@ -0,0 +1,231 @@
+import asyncio
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import httpx
+from PIL import Image
+from nonebot import logger
+
+from kikaiken.utils.http import get_async_client
+
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "image_cache")
+IMAGE_CACHE_BYTES = int(os.getenv("IMAGE_CACHE_BYTES", str(256 * 1024 * 1024)))  # 磁盘缓存的总字节数上限
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(10 * 1024 * 1024)))  # 单张图片的大小上限
+IMAGE_FETCH_CONCURRENCY = int(os.getenv("IMAGE_FETCH_CONCURRENCY", "8"))  # 同时下载的图片数量
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))  # 解码和读写文件使用的线程数
+IMAGE_THUMBNAIL_SIZE = int(os.getenv("IMAGE_THUMBNAIL_SIZE", "256"))
+
+_INDEX_FILE = "index.json"
+
+
+class ImageTooLargeError(Exception):
+    """
+    图片超过 IMAGE_MAX_BYTES
+    """
+
+
+def _write_file(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp = f"{path}.tmp"
+    with open(temp, "wb") as f:
+        f.write(data)
+    os.replace(temp, path)
+
+
+def _read_file(path: str) -> BytesIO:
+    # BytesIO 总要持有一份完整的数据，直接 read 比先 mmap 再复制少一次拷贝
+    with open(path, "rb") as f:
+        return BytesIO(f.read())
+
+
+def _make_thumbnail(source: str, target: str, size: int):
+    with Image.open(source) as image:
+        image.draft("RGB", (size, size))  # JPEG 可以直接以较低的分辨率解码
+        image.thumbnail((size, size))
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA")
+        buffer = BytesIO()
+        image.save(buffer, format="PNG")
+    _write_file(target, buffer.getvalue())
+
+
+class ImageStore:
+    """
+    图片缓存
+
+    图片按内容的 sha256 保存在磁盘上，相同内容的图片只保存一份，链接到哈希的映射保存在 index.json 中；
+    缓存总大小超过 max_bytes 时删除最久未使用的文件。下载的并发数受 concurrency 限制，
+    同一个链接的并发请求只会下载一次；文件读写和缩略图生成都在线程池中执行。
+    """
+    directory: str
+    max_bytes: int
+
+    def __init__(self, directory: str = IMAGE_CACHE_DIR, max_bytes: int = IMAGE_CACHE_BYTES,
+                 concurrency: int = IMAGE_FETCH_CONCURRENCY, client: httpx.AsyncClient | None = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._client = client
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="kikaiken-image")
+        self._index: dict[str, str] = {}  # 链接 -> 内容哈希
+        self._files: OrderedDict[str, int] = OrderedDict()  # 文件名 -> 大小，按最近使用排序
+        self._size = 0
+        self._inflight: dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.downloads = 0
+
+    def stats(self) -> dict:
+        return {"files": len(self._files), "bytes": self._size, "hits": self.hits, "downloads": self.downloads}
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name[:2], name)
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _scan(self):
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name == _INDEX_FILE or name.endswith(".tmp"):
+                    continue
+                stat = os.stat(os.path.join(root, name))
+                files.append((stat.st_mtime, name, stat.st_size))
+        index_path = os.path.join(self.directory, _INDEX_FILE)
+        index = {}
+        if os.path.exists(index_path):
+            with open(index_path, encoding="utf-8") as f:
+                index = json.load(f)
+        return sorted(files), index
+
+    async def start(self):
+        """
+        扫描磁盘上已有的缓存文件
+        """
+        try:
+            files, index = await self._run(self._scan)
+        except Exception as e:
+            logger.error(f"读取图片缓存失败：{e}")
+            return
+        for _, name, size in files:
+            self._files[name] = size
+            self._size += size
+        self._index = {url: digest for url, digest in index.items() if digest in self._files}
+        await self._shrink()
+        logger.info(f"已加载 {len(self._files)} 个缓存图片，共 {self._size / 1024 / 1024:.1f} MB")
+
+    async def close(self):
+        """
+        保存链接索引并关闭线程池
+        """
+        index_path = os.path.join(self.directory, _INDEX_FILE)
+        try:
+            await self._run(_write_file, index_path, json.dumps(self._index).encode())
+        except Exception as e:
+            logger.error(f"保存图片缓存索引失败：{e}")
+        self._executor.shutdown(wait=False)
+
+    def _touch(self, name: str):
+        self._files.move_to_end(name)
+
+    async def _add_file(self, name: str, size: int):
+        if name in self._files:
+            self._touch(name)
+            return
+        self._files[name] = size
+        self._size += size
+        await self._shrink()
+
+    async def _shrink(self):
+        """
+        删除最久未使用的文件，直到缓存总大小不超过 max_bytes
+        """
+        evicted = []
+        while self._size > self.max_bytes and len(self._files) > 1:
+            old, old_size = self._files.popitem(last=False)
+            self._size -= old_size
+            evicted.append(old)
+        if evicted:
+            evicted_set = set(evicted)
+            self._index = {url: digest for url, digest in self._index.items() if digest not in evicted_set}
+            for old in evicted:
+                try:
+                    await self._run(os.remove, self._path(old))
+                except FileNotFoundError:
+                    pass
+
+    async def _download(self, url: str) -> str:
+        client = self._client or get_async_client()
+        async with self._semaphore:
+            async with client.stream("GET", url) as response:
+                response.raise_for_status()
+                chunks, size = [], 0
+                async for chunk in response.aiter_bytes():
+                    size += len(chunk)
+                    if size > IMAGE_MAX_BYTES:
+                        raise ImageTooLargeError(url)
+                    chunks.append(chunk)
+        data = b"".join(chunks)
+        digest = hashlib.sha256(data).hexdigest()
+        self.downloads += 1
+        if digest not in self._files:
+            await self._run(_write_file, self._path(digest), data)
+            await self._add_file(digest, len(data))
+        self._index[url] = digest
+        return digest
+
+    async def fetch(self, url: str) -> str:
+        """
+        确保链接对应的图片已经在缓存中，返回图片的内容哈希
+        """
+        digest = self._index.get(url)
+        if digest is not None and digest in self._files:
+            self.hits += 1
+            self._touch(digest)
+            return digest
+        future = self._inflight.get(url)
+        if future is None:
+            future = asyncio.ensure_future(self._download(url))
+            self._inflight[url] = future
+            future.add_done_callback(lambda _: self._inflight.pop(url, None))
+        return await asyncio.shield(future)
+
+    async def open(self, url: str) -> BytesIO:
+        """
+        读取链接对应的图片
+        """
+        digest = await self.fetch(url)
+        return await self._run(_read_file, self._path(digest))
+
+    async def thumbnail(self, url: str, size: int = IMAGE_THUMBNAIL_SIZE) -> BytesIO:
+        """
+        读取链接对应图片的缩略图，缩略图同样会被缓存
+        """
+        digest = await self.fetch(url)
+        name = f"{digest}_{size}"
+        if name in self._files:
+            self._touch(name)
+        else:
+            path = self._path(name)
+            await self._run(_make_thumbnail, self._path(digest), path, size)
+            await self._add_file(name, (await self._run(os.stat, path)).st_size)
+        return await self._run(_read_file, self._path(name))
+
+    async def resolve(self, image: BytesIO | str) -> BytesIO | str:
+        """
+        把图片链接替换为缓存中的图片，下载失败时原样返回链接，交给适配器处理
+        """
+        if not isinstance(image, str):
+            return image
+        try:
+            return await self.open(image)
+        except Exception as e:
+            logger.error(f"下载图片失败：{e}")
+            return image
+
+
+image_store = ImageStore()
@@ -0,0 +1,54 @@
+import time
+
+
+class TokenBucket:
+    """
+    令牌桶，容量为 capacity，每秒补充 rate 个令牌
+    """
+    rate: float
+    capacity: float
+    tokens: float
+    updated_at: float
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        if now > self.updated_at:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+    def try_acquire(self, amount: float = 1) -> bool:
+        """
+        尝试取出 amount 个令牌，不足时不做任何修改并返回 False
+        """
+        self._refill(time.monotonic())
+        # 单次请求超过桶容量时，只要桶是满的就放行，否则这个请求永远无法通过
+        if self.tokens >= min(amount, self.capacity):
+            self.tokens -= amount
+            return True
+        return False
+
+    def refund(self, amount: float = 1):
+        """
+        退还之前取出的 amount 个令牌，不会超过桶容量
+        """
+        self._refill(time.monotonic())
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def wait_time(self, amount: float = 1) -> float:
+        """
+        距离可以取出 amount 个令牌还需要等待的秒数
+        """
+        self._refill(time.monotonic())
+        missing = min(amount, self.capacity) - self.tokens
+        if missing <= 0:
+            return 0.0
+        return missing / self.rate if self.rate > 0 else float("inf")
+
+    def is_full(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
@@ -0,0 +1,196 @@
+import asyncio
+import hashlib
+import os
+from collections import OrderedDict
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from functools import lru_cache
+from io import BytesIO
+
+from PIL import Image, ImageDraw, ImageFont
+from nonebot import logger
+
+RENDER_FONT_PATH = os.getenv("RENDER_FONT_PATH", "")  # 留空时自动查找系统中的中文字体
+RENDER_FONT_SIZE = int(os.getenv("RENDER_FONT_SIZE", "24"))
+RENDER_WIDTH = int(os.getenv("RENDER_WIDTH", "720"))  # 图片宽度，单位像素
+RENDER_MAX_LINES = int(os.getenv("RENDER_MAX_LINES", "300"))  # 超出的行会被截断
+RENDER_EXECUTOR = os.getenv("RENDER_EXECUTOR", "thread")  # thread 或 process
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "2"))
+RENDER_CACHE_BYTES = int(os.getenv("RENDER_CACHE_BYTES", str(32 * 1024 * 1024)))  # 渲染结果缓存的总字节数上限
+# 文本达到其中任意一个阈值时才渲染成图片，更短的文本直接以文字发送
+RENDER_MIN_LINES = int(os.getenv("RENDER_MIN_LINES", "8"))
+RENDER_MIN_LENGTH = int(os.getenv("RENDER_MIN_LENGTH", "300"))
+
+_FONT_CANDIDATES = (
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc",
+    "/System/Library/Fonts/PingFang.ttc",
+    "C:/Windows/Fonts/msyh.ttc",
+)
+_PADDING = 32
+_LINE_SPACING = 1.5
+_BACKGROUND = (250, 250, 252)
+_FOREGROUND = (40, 40, 48)
+_ACCENT = (90, 130, 200)
+
+
+def _find_font() -> str:
+    if RENDER_FONT_PATH:
+        return RENDER_FONT_PATH
+    return next((path for path in _FONT_CANDIDATES if os.path.exists(path)), "")
+
+
+class _Layout:
+    """
+    同一字体和字号的排版信息，缓存每个字符的宽度，避免重复测量
+    """
+
+    def __init__(self, font_path: str, font_size: int):
+        if font_path:
+            self.font = ImageFont.truetype(font_path, font_size)
+        else:
+            logger.warning("没有找到可用的中文字体，图片中的中文可能无法正常显示，请设置 RENDER_FONT_PATH")
+            self.font = ImageFont.load_default(font_size)
+        self.line_height = int(font_size * _LINE_SPACING)
+        self._widths: dict[str, float] = {}
+
+    def width(self, char: str) -> float:
+        if (width := self._widths.get(char)) is None:
+            width = self._widths[char] = self.font.getlength(char)
+        return width
+
+    def wrap(self, text: str, max_width: int) -> list[str]:
+        """
+        按像素宽度折行，中文可以在任意字符处断开
+        """
+        lines = []
+        for paragraph in text.split("\n"):
+            line, line_width = [], 0.0
+            for char in paragraph:
+                width = self.width(char)
+                if line and line_width + width > max_width:
+                    lines.append("".join(line))
+                    line, line_width = [], 0.0
+                line.append(char)
+                line_width += width
+            lines.append("".join(line))
+        return lines
+
+
+@lru_cache(maxsize=8)
+def _get_layout(font_path: str, font_size: int) -> _Layout:
+    return _Layout(font_path, font_size)
+
+
+def render_text(text: str, width: int = RENDER_WIDTH, font_path: str = "", font_size: int = RENDER_FONT_SIZE) -> bytes:
+    """
+    把文本渲染成 PNG 图片，这个函数会阻塞，需要在线程池或进程池中执行
+    """
+    layout = _get_layout(font_path, font_size)
+    lines = layout.wrap(text, width - _PADDING * 2)
+    if len(lines) > RENDER_MAX_LINES:
+        lines = lines[:RENDER_MAX_LINES - 1] + ["……"]
+    height = _PADDING * 2 + layout.line_height * len(lines)
+    image = Image.new("RGB", (width, height), _BACKGROUND)
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((0, 0, 6, height), fill=_ACCENT)
+    for index, line in enumerate(lines):
+        if line:
+            draw.text((_PADDING, _PADDING + index * layout.line_height), line, font=layout.font, fill=_FOREGROUND)
+    buffer = BytesIO()
+    image.save(buffer, format="PNG", optimize=False, compress_level=3)
+    return buffer.getvalue()
+
+
+class TextRenderer:
+    """
+    文本转图片渲染器
+
+    渲染在线程池或进程池中执行，不会阻塞事件循环；渲染结果按内容哈希缓存，
+    缓存总大小超过 cache_bytes 时淘汰最久未使用的图片，相同内容的并发请求只渲染一次。
+    只有行数达到 min_lines 或长度达到 min_length 的文本才值得渲染，见 should_render。
+    """
+    cache_bytes: int
+    min_lines: int
+    min_length: int
+
+    def __init__(self, executor: str = RENDER_EXECUTOR, workers: int = RENDER_WORKERS,
+                 cache_bytes: int = RENDER_CACHE_BYTES, min_lines: int = RENDER_MIN_LINES,
+                 min_length: int = RENDER_MIN_LENGTH):
+        self._executor_type = executor
+        self._workers = workers
+        self._executor: Executor | None = None
+        self.cache_bytes = cache_bytes
+        self.min_lines = min_lines
+        self.min_length = min_length
+        self._cache: OrderedDict[str, bytes] = OrderedDict()
+        self._size = 0
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._font_path = _find_font()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict:
+        return {"images": len(self._cache), "bytes": self._size, "hits": self.hits, "misses": self.misses}
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self._executor_type == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self._workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="kikaiken-render")
+        return self._executor
+
+    def _store(self, key: str, data: bytes):
+        if len(data) > self.cache_bytes:
+            return
+        self._cache[key] = data
+        self._size += len(data)
+        while self._size > self.cache_bytes:
+            _, evicted = self._cache.popitem(last=False)
+            self._size -= len(evicted)
+
+    def should_render(self, text: str) -> bool:
+        """
+        文本是否足够长，需要渲染成图片发送
+        """
+        return text.count("\n") + 1 >= self.min_lines or len(text) >= self.min_length
+
+    async def render_long(self, text: str) -> str | BytesIO:
+        """
+        长文本渲染成 PNG 图片，短文本原样返回
+        """
+        if self.should_render(text):
+            return await self.render(text)
+        return text
+
+    async def render(self, text: str, width: int = RENDER_WIDTH, font_size: int = RENDER_FONT_SIZE) -> BytesIO:
+        """
+        把文本渲染成 PNG 图片
+        """
+        key = hashlib.sha256(f"{width}\x00{font_size}\x00{text}".encode()).hexdigest()
+        if (data := self._cache.get(key)) is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return BytesIO(data)
+        self.misses += 1
+        future = self._inflight.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self._get_executor(), render_text, text, width, self._font_path, font_size)
+            self._inflight[key] = future
+            future.add_done_callback(lambda done: self._finish(key, done))
+        return BytesIO(await asyncio.shield(future))
+
+    def _finish(self, key: str, future: asyncio.Future):
+        self._inflight.pop(key, None)
+        if not future.cancelled() and future.exception() is None:
+            self._store(key, future.result())
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+text_renderer = TextRenderer()
@@ -0,0 +1,97 @@
+import asyncio
+from typing import AsyncIterator, Callable, Hashable, Any
+
+
+class StreamFlight:
+    """
+    一次共享的上游流，产出的数据会被保存下来，任意时刻加入的等待者都能从头读到完整的流
+    """
+    chunks: list
+    done: bool
+    error: BaseException | None
+    waiters: int
+
+    def __init__(self, factory: Callable[[], AsyncIterator[Any]]):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.waiters = 0
+        self._updated = asyncio.Event()
+        self.task = asyncio.create_task(self._run(factory))
+
+    def _notify(self):
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    async def _run(self, factory: Callable[[], AsyncIterator[Any]]):
+        try:
+            async for chunk in factory():
+                self.chunks.append(chunk)
+                self._notify()
+        except asyncio.CancelledError as e:
+            self.error = e
+            raise
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+
+    async def iterate(self) -> AsyncIterator[Any]:
+        index = 0
+        while True:
+            updated = self._updated
+            if index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+                continue
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await updated.wait()
+
+
+class StreamGroup:
+    """
+    流式请求合并
+
+    相同 key 的并发请求共享同一个上游流，每个等待者都会收到完整的数据；
+    等待者可以随时离开，最后一个等待者离开时上游请求会被取消。
+    """
+    started: int
+    joined: int
+
+    def __init__(self):
+        self._flights: dict[Hashable, StreamFlight] = {}
+        self.started = 0
+        self.joined = 0
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    async def stream(self, key: Hashable, factory: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        """
+        读取 key 对应的流，没有进行中的请求时调用 factory 发起一个新的请求
+        """
+        flight = self._flights.get(key)
+        if flight is None or flight.done:
+            flight = StreamFlight(factory)
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+            self.started += 1
+        else:
+            self.joined += 1
+        flight.waiters += 1
+        try:
+            async for chunk in flight.iterate():
+                yield chunk
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.done:
+                self._forget(key, flight)
+                flight.task.cancel()
+
+    def _forget(self, key: Hashable, flight: StreamFlight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
@@ -0,0 +1,111 @@
+import asyncio
+import re
+from typing import AsyncIterator
+
+# 句子结束符，遇到这些字符且当前片段足够长时就切分
+_SENTENCE_END = re.compile(r"[。！？!?…~～]+[”’」』)）]*|\.(?=\s)|\n")
+
+
+class SentenceSplitter:
+    """
+    把逐 token 到达的文本切分成完整的句子或段落
+
+    - 遇到空行（段落边界）时总是切分
+    - 遇到句子结束符时，只有当前片段不短于 min_length 才切分，避免发出过碎的消息
+    - 片段超过 max_length 仍没有结束符时强制切分
+    """
+    min_length: int
+    max_length: int
+
+    def __init__(self, min_length: int = 12, max_length: int = 300):
+        self.min_length = min_length
+        self.max_length = max_length
+        self._buffer = ""
+
+    def feed(self, text: str) -> list[str]:
+        """
+        追加一段文本，返回已经完整的片段
+        """
+        self._buffer += text
+        segments = []
+        start = 0
+        for match in _SENTENCE_END.finditer(self._buffer):
+            end = match.end()
+            segment = self._buffer[start:end]
+            paragraph = self._buffer.startswith("\n", end) or segment.endswith("\n\n")
+            if len(segment.strip()) >= self.min_length or (paragraph and segment.strip()):
+                segments.append(segment)
+                start = end
+        self._buffer = self._buffer[start:]
+        while len(self._buffer) > self.max_length:
+            segments.append(self._buffer[:self.max_length])
+            self._buffer = self._buffer[self.max_length:]
+        return [s for s in (segment.strip() for segment in segments) if s]
+
+    def flush(self) -> str:
+        """
+        取出剩余的文本
+        """
+        rest, self._buffer = self._buffer.strip(), ""
+        return rest
+
+
+async def split_sentences(chunks: AsyncIterator[str], splitter: SentenceSplitter | None = None) -> AsyncIterator[str]:
+    """
+    将文本流切分为句子流
+    """
+    splitter = splitter or SentenceSplitter()
+    async for chunk in chunks:
+        for segment in splitter.feed(chunk):
+            yield segment
+    if rest := splitter.flush():
+        yield rest
+
+
+async def paced(segments: AsyncIterator[str], interval: float, max_length: int = 500) -> AsyncIterator[str]:
+    """
+    限制片段的输出频率，相邻两次输出至少间隔 interval 秒
+
+    等待期间上游仍在继续读取，积压的片段会按行合并后一起输出，合并后的长度不超过 max_length
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    done = object()
+
+    async def produce():
+        try:
+            async for segment in segments:
+                await queue.put(segment)
+        finally:
+            await queue.put(done)
+
+    producer = asyncio.create_task(produce())
+    loop = asyncio.get_running_loop()
+    next_time = 0.0
+    try:
+        item = await queue.get()
+        while item is not done:
+            merged = item
+            item = None
+            # 等到允许发送的时间，期间到达的片段合并进来
+            while True:
+                delay = next_time - loop.time()
+                try:
+                    if delay > 0:
+                        item = await asyncio.wait_for(queue.get(), delay)
+                    else:
+                        item = queue.get_nowait()
+                except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                    item = None
+                    break
+                if item is done or len(merged) + len(item) > max_length:
+                    break
+                merged += "\n" + item
+                item = None
+            yield merged
+            next_time = loop.time() + interval
+            if item is None:
+                item = await queue.get()
+        # 把上游抛出的异常传递给调用方
+        await producer
+    finally:
+        producer.cancel()
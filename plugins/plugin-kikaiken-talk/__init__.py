@@ -1,13 +1,39 @@
-from arclet.alconna import Alconna, Subcommand, Option, Arparma
+from io import BytesIO
+
+from arclet.alconna import Alconna, Subcommand, Option, Arparma, Args
 from nonebot import on_type, get_driver, logger
-from nonebot.adapters.onebot.v11 import PrivateMessageEvent
+from nonebot.adapters import Bot, Event
+from nonebot.adapters.onebot.v11 import PrivateMessageEvent, MessageEvent, MessageSegment, Message
+from nonebot.exception import IgnoredException
+from nonebot.matcher import Matcher
+from nonebot.message import event_preprocessor, run_preprocessor
 from nonebot.permission import SUPERUSER
 from nonebot_plugin_alconna import on_alconna, AlconnaMatches
 
-from kikaiken.core.data_manager import auto_create_check, list_keys
+from kikaiken.core.access import access_filter
+from kikaiken.core.activity import activity_tracker
+from kikaiken.core.aggregator import input_aggregator
+from kikaiken.core.data_manager import auto_create_check, list_keys, record_writer, add_key, delete_key, \
+    RecordPageSource
 from kikaiken.core.db_connect import sqlite_connect, release_engine
-from kikaiken.core.talk import talk_v1
-from kikaiken.core.text import text_global_exception
+from kikaiken.core.economy import economy
+from kikaiken.core.inventory import inventory
+from kikaiken.core.key_manager import key_pool
+from kikaiken.core.llm import close_llm_clients
+from kikaiken.core.llm_cache import response_cache
+from kikaiken.core.memory import conversation_store
+from kikaiken.core.migration import run_migrations
+from kikaiken.core.models.message_model import create_message, MessageModel
+from kikaiken.core.outbound import coalesce
+from kikaiken.core.sign_in import sign_in_engine
+from kikaiken.core.talk import talk_stream
+from kikaiken.core.throttle import rate_limiter, ThrottleRule, THROTTLE_TALK_RPM, THROTTLE_TALK_BURST
+from kikaiken.core.text import text_global_exception, text_apikey_added, text_apikey_deleted, \
+    text_add_group_into_white_list, text_remove_group_from_white_list, text_add_user_into_black_list, \
+    text_remove_user_from_black_list, text_throttled, text_find_no_result, text_sign_in_success, \
+    text_already_signed, text_backpack
+from kikaiken.utils.image_store import image_store
+from kikaiken.utils.render import text_renderer
 
 driver = get_driver()
 apikey_cmd = on_alconna(
@@ -19,6 +45,32 @@ apikey_cmd = on_alconna(
                 "-s|--show",
             )
         ),
+        Subcommand(
+            "add",
+            Args["model_type", str]["model_name", str]["api_key", str]["notice", str, ""],
+        ),
+        Subcommand(
+            "delete",
+            Args["key_id", int],
+        ),
+    ),
+    use_cmd_sep=True,
+    use_cmd_start=True,
+    priority=10,
+    block=True,
+    permission=SUPERUSER,
+)
+whitelist_cmd = on_alconna(
+    Alconna(
+        "whitelist",
+        Subcommand(
+            "add",
+            Args["group_id", int],
+        ),
+        Subcommand(
+            "remove",
+            Args["group_id", int],
+        ),
     ),
     use_cmd_sep=True,
     use_cmd_start=True,
@@ -26,7 +78,84 @@ apikey_cmd = on_alconna(
     block=True,
     permission=SUPERUSER,
 )
-private_talking = on_type(PrivateMessageEvent)
+blacklist_cmd = on_alconna(
+    Alconna(
+        "blacklist",
+        Subcommand(
+            "add",
+            Args["user_id", int],
+        ),
+        Subcommand(
+            "remove",
+            Args["user_id", int],
+        ),
+    ),
+    use_cmd_sep=True,
+    use_cmd_start=True,
+    priority=10,
+    block=True,
+    permission=SUPERUSER,
+)
+record_cmd = on_alconna(
+    Alconna(
+        "record",
+        Option(
+            "-p|--page",
+            Args["page", int, 1],
+        ),
+    ),
+    use_cmd_sep=True,
+    use_cmd_start=True,
+    priority=10,
+    block=True,
+)
+sign_cmd = on_alconna(
+    Alconna("sign"),
+    aliases={"签到"},
+    use_cmd_start=True,
+    priority=10,
+    block=True,
+)
+backpack_cmd = on_alconna(
+    Alconna("backpack"),
+    aliases={"背包"},
+    use_cmd_start=True,
+    priority=10,
+    block=True,
+)
+
+
+def _not_command(event: PrivateMessageEvent) -> bool:
+    # 以命令前缀开头的消息不交给对话，没有匹配上的命令（例如权限不足）也不会被发送给模型
+    text = event.get_plaintext().lstrip()
+    return not any(text.startswith(start) for start in driver.config.command_start if start)
+
+
+# 对话的优先级低于所有命令，命令处理过的消息不会再进入对话
+private_talking = on_type(PrivateMessageEvent, rule=_not_command, priority=99, block=True)
+# 对话按合并后的提示词限流，一次连续输入只消耗一次额度
+rate_limiter.set_rule(private_talking, ThrottleRule(user_rpm=THROTTLE_TALK_RPM, user_burst=THROTTLE_TALK_BURST,
+                                                    deferred=True))
+
+
+def to_segment(content: str | BytesIO) -> MessageSegment:
+    """
+    渲染好的图片作为图片发送，其余作为文本发送
+    """
+    if isinstance(content, BytesIO):
+        return MessageSegment.image(content)
+    return MessageSegment.text(content)
+
+
+async def build_message(message: MessageModel, page_num: int = 1) -> Message:
+    """
+    把 MessageModel 转换成可以发送的消息，较长的文本渲染成图片，图片链接换成 image_store 中缓存的图片
+    """
+    result = Message(to_segment(await message.render_long(page_num)))
+    await message.resolve_images()
+    for image in message.image:
+        result += MessageSegment.image(image)
+    return result
 
 
 @driver.on_startup
@@ -35,34 +164,165 @@ async def _():
     # 初始化数据库连接
     await sqlite_connect()
     await auto_create_check()
+    await run_migrations()
+    await key_pool.reload()
+    await access_filter.load()
+    await economy.start()
+    # 启动用户记录的批量写入
+    record_writer.start()
+    conversation_store.start()
+    response_cache.start()
+    await activity_tracker.start()
+    await image_store.start()
 
 
 @driver.on_shutdown
 async def _():
+    # 写入尚未落盘的用户记录
+    await record_writer.close()
+    await conversation_store.close()
+    await response_cache.close()
+    await activity_tracker.close()
+    await economy.close()
+    text_renderer.close()
+    await image_store.close()
+    # 关闭共享的 HTTP 连接池
+    await close_llm_clients()
     # 释放数据库连接
     await release_engine()
 
 
+@event_preprocessor
+async def _(event: Event):
+    # 在匹配响应器之前丢弃黑名单用户和非白名单群聊的事件，不会产生任何数据库或模型请求
+    if not access_filter.allow(getattr(event, "user_id", None), getattr(event, "group_id", None)):
+        raise IgnoredException("事件来自黑名单用户或非白名单群聊")
+    if isinstance(event, MessageEvent):
+        # 每个用户每天只有第一条消息会被记下，活跃时间由 activity_tracker 批量写入
+        activity_tracker.touch(event.user_id)
+
+
+@run_preprocessor
+async def _(bot: Bot, event: Event, matcher: Matcher):
+    # 在响应器运行之前限流，被限流的触发不会访问数据库或模型，连续被限流时只提示一次
+    if rate_limiter.is_deferred(type(matcher)):
+        return
+    allowed, notify = await rate_limiter.check(type(matcher), getattr(event, "user_id", None),
+                                               getattr(event, "group_id", None))
+    if allowed:
+        return
+    if notify:
+        await bot.send(event, text_throttled())
+    raise IgnoredException("触发过于频繁")
+
+
 @apikey_cmd.handle()
-async def _(event: PrivateMessageEvent, result: Arparma = AlconnaMatches()):
+async def _(bot: Bot, event: PrivateMessageEvent, result: Arparma = AlconnaMatches()):
     if result.find("list"):
         is_shown = False
         if result.find("list.show"):
             is_shown = True
         # 获取apikey列表
         keys = await list_keys()
-        if keys:
+        if not keys:
+            await apikey_cmd.finish(text_find_no_result())
+        # 所有key合并成一条转发消息发送，避免逐条发送触发风控
+        async with coalesce(bot, event) as out:
             for key in keys:
                 if is_shown:
-                    await apikey_cmd.send(
-                        f"{key.model_type} {key.model_name} {key.api_key} {key.notice}"
-                    )
+                    await out.add(f"{key.id} {key.model_type} {key.model_name} {key.api_key} {key.notice}")
                 else:
-                    await apikey_cmd.send(f"{key.model_type} {key.model_name}")
+                    await out.add(f"{key.id} {key.model_type} {key.model_name}")
+        await apikey_cmd.finish()
+    if result.find("add"):
+        model_type = result.query[str]("add.model_type")
+        model_name = result.query[str]("add.model_name")
+        if await add_key(model_type, model_name, result.query[str]("add.api_key"), result.query[str]("add.notice")):
+            # 新的key立即加入密钥池，不需要重启
+            await key_pool.reload()
+            await apikey_cmd.finish(text_apikey_added(model_type, model_name))
+    if result.find("delete"):
+        key_id = result.query[int]("delete.key_id")
+        if await delete_key(key_id):
+            await key_pool.reload()
+            await apikey_cmd.finish(text_apikey_deleted(key_id))
     await apikey_cmd.finish(text_global_exception())
 
 
+@record_cmd.handle()
+async def _(event: MessageEvent, result: Arparma = AlconnaMatches()):
+    page = result.query[int]("page.page", 1)
+    # 只读取请求的那一页记录，渲染成图片发送，避免长文本被折叠
+    message = create_message(page_source=RecordPageSource(event.user_id))
+    await record_cmd.finish(await build_message(message, page))
+
+
+@sign_cmd.handle()
+async def _(event: MessageEvent):
+    try:
+        result = await sign_in_engine.sign_in(event.user_id)
+    except Exception:
+        await sign_cmd.finish(text_global_exception())
+    if result.signed:
+        await sign_cmd.finish(text_sign_in_success(result.lucky, result.coin, result.balance))
+    await sign_cmd.finish(text_already_signed(result.lucky))
+
+
+@backpack_cmd.handle()
+async def _(event: MessageEvent):
+    try:
+        items = await inventory.get(event.user_id)
+    except Exception:
+        await backpack_cmd.finish(text_global_exception())
+    if not items:
+        await backpack_cmd.finish(text_find_no_result())
+    await backpack_cmd.finish(text_backpack(items))
+
+
 @private_talking.handle()
 async def _(event: PrivateMessageEvent):
-    res = await talk_v1(event.user_id, event.get_plaintext())
-    await private_talking.finish(res)
+    # 短时间内连续发送的消息会被合并，只由最后一条消息负责回复
+    prompt = await input_aggregator.collect(event.user_id, event.get_plaintext())
+    if prompt is None:
+        await private_talking.finish()
+    try:
+        allowed, notify = await rate_limiter.check(private_talking, event.user_id, None)
+        if not allowed:
+            await private_talking.finish(text_throttled() if notify else None)
+
+        async def reply():
+            # 回复按句子逐段发送，不必等待整个回答生成完毕
+            async for segment in talk_stream(event.user_id, prompt):
+                await private_talking.send(to_segment(await text_renderer.render_long(segment)))
+
+        await input_aggregator.run(event.user_id, reply())
+    finally:
+        # 被限流或出错时也要清理合并状态
+        input_aggregator.done(event.user_id)
+    await private_talking.finish()
+
+
+@whitelist_cmd.handle()
+async def _(result: Arparma = AlconnaMatches()):
+    if result.find("add"):
+        group_id = result.query[int]("add.group_id")
+        if await access_filter.add_group(group_id):
+            await whitelist_cmd.finish(text_add_group_into_white_list(group_id))
+    if result.find("remove"):
+        group_id = result.query[int]("remove.group_id")
+        if await access_filter.remove_group(group_id):
+            await whitelist_cmd.finish(text_remove_group_from_white_list(group_id))
+    await whitelist_cmd.finish(text_global_exception())
+
+
+@blacklist_cmd.handle()
+async def _(result: Arparma = AlconnaMatches()):
+    if result.find("add"):
+        user_id = result.query[int]("add.user_id")
+        if await access_filter.block_user(user_id):
+            await blacklist_cmd.finish(text_add_user_into_black_list(user_id))
+    if result.find("remove"):
+        user_id = result.query[int]("remove.user_id")
+        if await access_filter.unblock_user(user_id):
+            await blacklist_cmd.finish(text_remove_user_from_black_list(user_id))
+    await blacklist_cmd.finish(text_global_exception())
@@ -0,0 +1,35 @@
+import os
+from contextlib import asynccontextmanager
+
+import nonebot
+import pytest
+
+# kikaiken 的模块会在导入和运行时使用 nonebot 的 logger 和 driver
+nonebot.init()
+
+
+@pytest.fixture
+def temp_database(tmp_path, monkeypatch):
+    """
+    返回一个异步上下文管理器，在其中使用临时的数据库文件
+
+    数据库连接和测试运行在同一个事件循环中，所以连接在测试的协程里建立和释放
+    """
+    from kikaiken.core.data_manager import auto_create_check
+    from kikaiken.core.db_connect import sqlite_connect, release_engine
+    from kikaiken.core.user_manager import user_cache
+
+    monkeypatch.setenv("BACKUP_PATH", os.fspath(tmp_path / "test.kbp"))
+
+    @asynccontextmanager
+    async def database():
+        # 用户缓存是模块级的单例，不能带着上一个临时数据库的数据
+        user_cache.clear()
+        await sqlite_connect()
+        await auto_create_check()
+        try:
+            yield
+        finally:
+            await release_engine()
+
+    return database
@@ -0,0 +1,74 @@
+import asyncio
+import datetime
+
+from kikaiken.core import activity
+from kikaiken.core.activity import ActivityTracker
+from kikaiken.core.data_manager import create_users_many, create_user
+
+
+def test_daily_and_monthly_activity(temp_database):
+    today = datetime.date.today()
+    yesterday = today - datetime.timedelta(days=1)
+
+    async def scenario():
+        async with temp_database():
+            await create_users_many(range(100, 120))
+            tracker = ActivityTracker()
+            await tracker.start()
+            for _ in range(100):
+                for qid in (100, 105, 119):
+                    tracker.touch(qid)
+            tracker._dirty[yesterday] = {100, 101}
+            await tracker.close()
+            restarted = ActivityTracker()
+            await restarted.start()
+            try:
+                return (await restarted.dau(), await restarted.dau(yesterday), await restarted.mau(),
+                        await restarted.retention(yesterday, today))
+            finally:
+                await restarted.close()
+
+    assert asyncio.run(scenario()) == (3, 2, 4, 0.5)
+
+
+def test_failed_load_does_not_overwrite_stored_bitmap(temp_database, monkeypatch):
+    async def scenario():
+        async with temp_database():
+            await create_users_many(range(100, 110))
+            first = ActivityTracker()
+            await first.start()
+            for qid in (100, 101, 102):
+                first.touch(qid)
+            await first.close()
+
+            read_engine = activity.get_read_engine
+
+            def broken():
+                raise RuntimeError("数据库暂时不可用")
+
+            monkeypatch.setattr(activity, "get_read_engine", broken)
+            second = ActivityTracker()
+            await second.start()  # 读取位图失败
+            monkeypatch.setattr(activity, "get_read_engine", read_engine)
+            second.touch(103)
+            await second.close()
+            return await second.dau()
+
+    assert asyncio.run(scenario()) == 4
+
+
+def test_unregistered_user_is_counted_after_registration(temp_database):
+    async def scenario():
+        async with temp_database():
+            tracker = ActivityTracker()
+            await tracker.start()
+            tracker.touch(200)
+            await tracker.flush()
+            before = await tracker.dau()
+            await create_user(200)
+            await tracker.flush()
+            after = await tracker.dau()
+            await tracker.close()
+            return before, after
+
+    assert asyncio.run(scenario()) == (0, 1)
@@ -0,0 +1,39 @@
+import asyncio
+
+from kikaiken.core.aggregator import InputAggregator
+
+
+def test_done_releases_abandoned_prompt():
+    aggregator = InputAggregator(quiet_window=0.01)
+
+    async def scenario():
+        prompt = await aggregator.collect(1, "你好")
+        # 合并出提示词后没有进入 run（例如被限流）
+        aggregator.done(1)
+        return prompt
+
+    assert asyncio.run(scenario()) == "你好"
+    assert len(aggregator) == 0
+
+
+def test_done_keeps_running_generation():
+    aggregator = InputAggregator(quiet_window=0.01)
+
+    async def scenario():
+        await aggregator.collect(1, "你好")
+        started = asyncio.Event()
+
+        async def reply():
+            started.set()
+            await asyncio.sleep(0.05)
+
+        run = asyncio.create_task(aggregator.run(1, reply()))
+        await started.wait()
+        aggregator.done(1)
+        remaining = len(aggregator)
+        await run
+        aggregator.done(1)
+        return remaining
+
+    assert asyncio.run(scenario()) == 1
+    assert len(aggregator) == 0
@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+from sqlalchemy import text
+
+from kikaiken.core import data_manager
+from kikaiken.core.data_manager import create_users_many, add_coin_many, find_user_by_qid
+from kikaiken.core.db_connect import get_read_engine
+from kikaiken.core.economy import Economy
+from kikaiken.core.user_manager import user_scope
+
+
+@pytest.fixture
+def economy(monkeypatch):
+    economy = Economy()
+    monkeypatch.setattr(data_manager, "economy", economy)
+    return economy
+
+
+async def _scalar(sql: str):
+    async with get_read_engine().connect() as conn:
+        return (await conn.execute(text(sql))).scalar()
+
+
+def test_add_coin_many_writes_in_one_transaction(temp_database, economy):
+    async def scenario():
+        async with temp_database():
+            await create_users_many(range(1, 6), coin=5)
+            await economy.start()
+            assert await add_coin_many({qid: qid for qid in range(1, 6)} | {999: 1})
+            # 不需要等待余额写回，用户表中的硬币已经是最新的
+            user = await find_user_by_qid(5)
+            ledger = await _scalar("SELECT count(*) FROM kikaiken_coin_ledger")
+            records = await _scalar("SELECT count(*) FROM kikaiken_user_record")
+            await economy.close()
+            return user.coin, ledger, records, economy.top(2), await economy.balance(999)
+
+    assert asyncio.run(scenario()) == (10, 5, 5, [(5, 10), (4, 9)], None)
+
+
+def test_rollback_restores_balances(temp_database, economy):
+    async def scenario():
+        async with temp_database():
+            await create_users_many(range(1, 3), coin=5)
+            await economy.start()
+            with pytest.raises(RuntimeError):
+                async with user_scope() as scope:
+                    assert await economy.add_many({1: 10, 2: 3}, "测试", scope) == {1: 15, 2: 8}
+                    raise RuntimeError("回滚")
+            balances = await economy.balance(1), await economy.balance(2)
+            await economy.close()
+            stored = await _scalar("SELECT sum(coin) FROM kikaiken_user")
+            ledger = await _scalar("SELECT count(*) FROM kikaiken_coin_ledger")
+            return balances, stored, ledger, economy.rank(1)
+
+    assert asyncio.run(scenario()) == ((5, 5), 10, 0, 1)
+
+
+def test_rejects_non_positive_amounts(temp_database, economy):
+    async def scenario():
+        async with temp_database():
+            await create_users_many([1], coin=5)
+            await economy.start()
+            for call in (economy.add(1, -100), economy.add(1, 0), economy.consume(1, -5), economy.set(1, -1),
+                         economy.add_many({1: -3})):
+                with pytest.raises(ValueError):
+                    await call
+            assert not await data_manager.add_coin(1, -100)
+            balance = await economy.balance(1)
+            await economy.close()
+            return balance
+
+    assert asyncio.run(scenario()) == 5
+
+
+def test_rollback_forgets_users_created_in_scope(temp_database, economy):
+    async def scenario():
+        async with temp_database():
+            await economy.start()
+            with pytest.raises(RuntimeError):
+                async with user_scope() as scope:
+                    await scope.create_users([42])
+                    await economy.add_many({42: 10}, "测试", scope)
+                    raise RuntimeError("回滚")
+            balance = await economy.balance(42)
+            await economy.close()
+            return balance, economy.top(1), len(economy)
+
+    assert asyncio.run(scenario()) == (None, [], 0)
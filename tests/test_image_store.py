@@ -0,0 +1,186 @@
+import asyncio
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+import httpx
+import pytest
+from PIL import Image
+
+from kikaiken.core.models.message_model import create_message
+from kikaiken.utils import image_store as image_store_module
+from kikaiken.utils.image_store import ImageStore, ImageTooLargeError
+
+
+def _png(color: str, size: int = 64) -> bytes:
+    buffer = BytesIO()
+    Image.new("RGB", (size, size), color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class _ImageServer:
+    """
+    本地的图片服务器，记录每个路径被请求的次数
+    """
+
+    def __init__(self, images: dict[str, bytes], delay: float = 0.0):
+        self.images = images
+        self.requests: dict[str, int] = {}
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests[self.path] = server.requests.get(self.path, 0) + 1
+                if delay:
+                    threading.Event().wait(delay)
+                data = server.images.get(self.path)
+                if data is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    def url(self, path: str) -> str:
+        return f"http://127.0.0.1:{self._httpd.server_port}{path}"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+@pytest.fixture
+def server():
+    images = {"/red.png": _png("red"), "/red-copy.png": _png("red"), "/blue.png": _png("blue", 512),
+              "/green.png": _png("green")}
+    with _ImageServer(images, delay=0.05) as server:
+        yield server
+
+
+def _run(directory, scenario, **kwargs) -> tuple:
+    """
+    在一个新的事件循环中用本地目录创建 ImageStore 并执行 scenario，返回 (结果, store)
+    """
+
+    async def main():
+        async with httpx.AsyncClient() as client:
+            store = ImageStore(directory=str(directory), client=client, **kwargs)
+            await store.start()
+            try:
+                return await scenario(store), store
+            finally:
+                await store.close()
+
+    return asyncio.run(main())
+
+
+def test_concurrent_fetch_downloads_once(server, tmp_path):
+    url = server.url("/red.png")
+
+    async def scenario(store):
+        digests = await asyncio.gather(*(store.fetch(url) for _ in range(20)))
+        assert len(set(digests)) == 1
+        assert (await store.open(url)).getvalue() == server.images["/red.png"]
+        return digests[0]
+
+    digest, store = _run(tmp_path, scenario, concurrency=2)
+    assert digest == hashlib.sha256(server.images["/red.png"]).hexdigest()
+    assert server.requests["/red.png"] == 1
+    assert store.downloads == 1
+    assert store.hits == 1
+
+
+def test_same_content_is_stored_once(server, tmp_path):
+    async def scenario(store):
+        return await store.fetch(server.url("/red.png")), await store.fetch(server.url("/red-copy.png"))
+
+    (first, second), store = _run(tmp_path, scenario)
+    assert first == second
+    assert store.stats()["files"] == 1
+
+
+def test_index_survives_restart(server, tmp_path):
+    url = server.url("/green.png")
+
+    async def first(store):
+        await store.fetch(url)
+
+    async def second(store):
+        return (await store.open(url)).getvalue()
+
+    _run(tmp_path, first)
+    data, store = _run(tmp_path, second)
+    assert data == server.images["/green.png"]
+    assert server.requests["/green.png"] == 1
+    assert store.hits == 1
+
+
+def test_evicts_least_recently_used(server, tmp_path):
+    red, green = len(server.images["/red.png"]), len(server.images["/green.png"])
+
+    async def scenario(store):
+        await store.fetch(server.url("/red.png"))
+        await store.fetch(server.url("/green.png"))
+        await store.fetch(server.url("/red.png"))  # red 变为最近使用
+        await store.fetch(server.url("/blue.png"))  # 超出上限，淘汰最久未使用的 green
+        await store.fetch(server.url("/green.png"))
+
+    _, store = _run(tmp_path, scenario, max_bytes=red + green + len(server.images["/blue.png"]) - 1)
+    assert store.stats()["bytes"] <= store.max_bytes
+    assert server.requests["/red.png"] == 1
+    assert server.requests["/green.png"] == 2
+
+
+def test_thumbnail_is_cached(server, tmp_path):
+    url = server.url("/blue.png")
+
+    async def scenario(store):
+        first = await store.thumbnail(url, 128)
+        second = await store.thumbnail(url, 128)
+        return first.getvalue(), second.getvalue()
+
+    (first, second), store = _run(tmp_path, scenario)
+    assert first == second
+    with Image.open(BytesIO(first)) as image:
+        assert max(image.size) == 128
+    assert store.stats()["files"] == 2
+    assert server.requests["/blue.png"] == 1
+
+
+def test_rejects_large_images(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(image_store_module, "IMAGE_MAX_BYTES", 100)
+
+    async def scenario(store):
+        with pytest.raises(ImageTooLargeError):
+            await store.fetch(server.url("/blue.png"))
+
+    _, store = _run(tmp_path, scenario)
+    assert store.stats()["files"] == 0
+
+
+def test_resolve_images_in_message(server, tmp_path, monkeypatch):
+    local = BytesIO(b"local")
+    missing = server.url("/missing.png")
+    message = create_message("hi", image=[server.url("/red.png"), local, missing])
+
+    async def scenario(store):
+        monkeypatch.setattr("kikaiken.core.models.message_model.image_store", store)
+        await message.resolve_images()
+
+    _run(tmp_path, scenario)
+    assert message.image[0].getvalue() == server.images["/red.png"]
+    assert message.image[1] is local
+    assert message.image[2] == missing  # 下载失败时保留链接，交给适配器处理
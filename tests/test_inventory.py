@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest
+
+from kikaiken.core.inventory import Inventory
+
+
+def test_add_and_remove(temp_database):
+    inventory = Inventory()
+
+    async def scenario():
+        async with temp_database():
+            await inventory.add(1, "苹果", 3)
+            await inventory.grant_many({1: {"苹果": 2, "钥匙": 1}, 2: {"钥匙": 1}})
+            removed = [await inventory.remove(1, "苹果", 4), await inventory.remove(1, "苹果", 2),
+                       await inventory.remove(1, "钥匙")]
+            return removed, await inventory.get(1), await inventory.get(2)
+
+    removed, first, second = asyncio.run(scenario())
+    assert removed == [True, False, True]
+    assert first == {"苹果": 1}
+    assert second == {"钥匙": 1}
+
+
+@pytest.mark.parametrize("count", [0, -5])
+def test_rejects_non_positive_counts(temp_database, count):
+    inventory = Inventory()
+
+    async def scenario():
+        async with temp_database():
+            await inventory.add(1, "苹果", 3)
+            with pytest.raises(ValueError):
+                await inventory.add(1, "苹果", count)
+            with pytest.raises(ValueError):
+                await inventory.remove(1, "苹果", count)
+            with pytest.raises(ValueError):
+                await inventory.grant_many({1: {"苹果": count}})
+            return await inventory.get(1)
+
+    assert asyncio.run(scenario()) == {"苹果": 3}
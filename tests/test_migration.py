@@ -0,0 +1,40 @@
+import asyncio
+import json
+
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from kikaiken.core.migration import merge_duplicate_users
+
+
+def test_merge_duplicate_users(tmp_path):
+    async def scenario():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'old.db'}")
+        try:
+            async with engine.begin() as conn:
+                await conn.exec_driver_sql(
+                    "CREATE TABLE kikaiken_user (id INTEGER PRIMARY KEY, qid INTEGER, nickname TEXT, "
+                    "permission_group INTEGER, coin INTEGER, backpack TEXT, last_sign_date TEXT, "
+                    "last_activity_date TEXT)"
+                )
+                await conn.exec_driver_sql(
+                    "INSERT INTO kikaiken_user (qid, nickname, permission_group, coin, backpack, last_sign_date) "
+                    "VALUES (1, NULL, 0, 10, '苹果:2', '2024-01-01'), (2, 'b', 0, 5, NULL, NULL), "
+                    "(1, 'a', 2, 7, '{\"苹果\": 1, \"钥匙\": 1}', '2024-02-01'), (1, NULL, 1, 3, '', NULL)"
+                )
+                removed = await merge_duplicate_users(conn)
+                result = await conn.exec_driver_sql(
+                    "SELECT id, qid, nickname, permission_group, coin, backpack, last_sign_date "
+                    "FROM kikaiken_user ORDER BY id"
+                )
+                return removed, result.fetchall()
+        finally:
+            await engine.dispose()
+
+    removed, rows = asyncio.run(scenario())
+    assert removed == 2
+    assert [(row.id, row.qid) for row in rows] == [(1, 1), (2, 2)]
+    merged = rows[0]
+    assert (merged.nickname, merged.permission_group, merged.coin) == ("a", 2, 20)
+    assert json.loads(merged.backpack) == {"苹果": 3, "钥匙": 1}
+    assert merged.last_sign_date == "2024-02-01"
+    assert rows[1].coin == 5
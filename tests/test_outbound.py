@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+
+from kikaiken.core.outbound import OutboundBuffer, coalesce
+
+
+class _FakeEvent:
+    def __init__(self, group_id: int | None = None):
+        self.group_id = group_id
+
+    def get_user_id(self) -> str:
+        return "10001"
+
+
+class _FakeBot:
+    """
+    记录所有发送消息的 API 调用
+    """
+    self_id = "10000"
+
+    def __init__(self, forward_fails: bool = False):
+        self.forward_fails = forward_fails
+        self.calls: list[tuple[str, dict]] = []
+
+    async def call_api(self, api: str, **data):
+        self.calls.append((api, data))
+        if self.forward_fails:
+            raise RuntimeError("合并转发不可用")
+
+    async def send(self, event, message):
+        self.calls.append(("send", {"message": message}))
+
+
+@pytest.mark.parametrize("rows", [1, 10, 120])
+def test_api_calls_before_and_after(rows):
+    """
+    逐条发送和合并转发的 API 调用次数对比
+    """
+    messages = [f"{index} siliconflow deepseek-ai/DeepSeek-V3" for index in range(rows)]
+    before, after = _FakeBot(), _FakeBot()
+    event = _FakeEvent(group_id=123)
+
+    async def scenario():
+        for message in messages:
+            await before.send(event, message)
+        async with coalesce(after, event, max_nodes=50) as out:
+            for message in messages:
+                await out.add(message)
+
+    asyncio.run(scenario())
+    print(f"\n{rows} 条消息：逐条发送 {len(before.calls)} 次调用，合并后 {len(after.calls)} 次调用")
+    assert len(before.calls) == rows
+    assert len(after.calls) == (rows + 49) // 50
+    if rows == 1:
+        assert after.calls[0][0] == "send"
+    else:
+        assert {api for api, _ in after.calls} == {"send_group_forward_msg"}
+        assert [node["data"]["content"] for _, data in after.calls for node in data["messages"]] == messages
+
+
+def test_private_forward_and_timer_flush():
+    bot, event = _FakeBot(), _FakeEvent()
+
+    async def scenario():
+        buffer = OutboundBuffer(bot, event, flush_interval=0.05)
+        await buffer.add("a")
+        await buffer.add("b")
+        await asyncio.sleep(0.1)
+        return len(buffer)
+
+    assert asyncio.run(scenario()) == 0
+    assert [(api, data["user_id"]) for api, data in bot.calls] == [("send_private_forward_msg", 10001)]
+
+
+def test_falls_back_to_single_message():
+    bot, event = _FakeBot(forward_fails=True), _FakeEvent(group_id=123)
+
+    async def scenario():
+        async with coalesce(bot, event) as out:
+            await out.add("a")
+            await out.add("b")
+
+    asyncio.run(scenario())
+    assert [api for api, _ in bot.calls] == ["send_group_forward_msg", "send"]
+    assert bot.calls[-1][1]["message"] == "a\nb"
@@ -0,0 +1,19 @@
+from kikaiken.utils.rate_limit import TokenBucket
+
+
+def test_refund_restores_tokens():
+    bucket = TokenBucket(rate=0, capacity=10)
+    assert bucket.try_acquire(8)
+    assert not bucket.try_acquire(5)
+    bucket.refund(8)
+    assert bucket.is_full()
+    bucket.refund(3)
+    assert bucket.tokens == 10
+
+
+def test_refund_oversized_request():
+    # 超过容量的请求会让令牌变成负数，退还后回到满桶
+    bucket = TokenBucket(rate=0, capacity=10)
+    assert bucket.try_acquire(25)
+    bucket.refund(25)
+    assert bucket.is_full()
@@ -0,0 +1,65 @@
+import asyncio
+import datetime
+
+import pytest
+from sqlalchemy import insert
+
+from kikaiken.core.data_manager import RecordPageSource, record_count_cache, record_cursor_cache
+from kikaiken.core.db_connect import get_engine
+from kikaiken.core.models.db_model import KikaikenUserRecord
+from kikaiken.core.models.message_model import PageSource, create_message
+
+RECORDS = 100
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    record_count_cache.clear()
+    record_cursor_cache.clear()
+
+
+async def _insert_records(qid: int):
+    start = datetime.datetime(2025, 1, 1)
+    # 每两条记录时间相同，翻页需要依靠 id 区分先后
+    async with get_engine().begin() as conn:
+        await conn.execute(insert(KikaikenUserRecord), [
+            {"qid": qid, "record_time": start + datetime.timedelta(minutes=index // 2), "content": f"r{index}"}
+            for index in range(RECORDS)
+        ])
+
+
+def test_page_source_is_abstract():
+    with pytest.raises(TypeError):
+        PageSource()
+
+
+def test_pages_follow_record_order(temp_database):
+    async def scenario():
+        async with temp_database():
+            await _insert_records(1)
+            pages = [await RecordPageSource(1).fetch(page, 15) for page in range(1, 9)]
+            count = await RecordPageSource(1).count()
+            return pages, count
+
+    pages, count = asyncio.run(scenario())
+    contents = [row.split()[-1] for page in pages for row in page]
+    assert contents == [f"r{index}" for index in reversed(range(RECORDS))]
+    assert [len(page) for page in pages] == [15] * 6 + [10, 0]
+    assert count == RECORDS
+
+
+def test_cursors_are_reused_between_commands(temp_database):
+    async def scenario():
+        async with temp_database():
+            await _insert_records(1)
+            for page in range(1, 4):
+                # 每次命令都会新建数据源，翻页位置从缓存中继续
+                await create_message(page_source=RecordPageSource(1)).render_page(page)
+            cursors = dict(record_cursor_cache.get(1))
+            far = await RecordPageSource(1).fetch(6, 15)
+            return cursors, far
+
+    cursors, far = asyncio.run(scenario())
+    assert sorted(cursors) == [15, 30, 45]
+    assert [row.split()[-1] for row in far] == [f"r{index}" for index in range(24, 9, -1)]
+    assert sorted(record_cursor_cache.get(1)) == [15, 30, 45, 75, 90]
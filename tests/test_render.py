@@ -0,0 +1,101 @@
+import asyncio
+import time
+
+from PIL import Image
+
+from kikaiken.utils.render import TextRenderer
+
+# 常见的三种输出：简短的回复、一页 15 行的记录、较长的模型回答
+SIZES = {
+    "短回复": 3,
+    "记录分页": 15,
+    "长回答": 60,
+}
+IMAGES_PER_SIZE = 20
+
+
+def _text(lines: int, seed: int) -> str:
+    return "\n".join(f"{seed:04d}-{line:02d} 2025-01-01 12:00:00 冰犬机械研究会 kikaiken 签到获得硬币：{line}"
+                     for line in range(lines))
+
+
+def test_render_throughput():
+    """
+    渲染吞吐量，分别统计未命中缓存和命中缓存时每秒生成的图片数量
+    """
+    renderer = TextRenderer(executor="thread", workers=2)
+
+    async def scenario():
+        report = {}
+        for name, lines in SIZES.items():
+            texts = [_text(lines, seed) for seed in range(IMAGES_PER_SIZE)]
+            started = time.perf_counter()
+            images = await asyncio.gather(*(renderer.render(text) for text in texts))
+            rendered = time.perf_counter() - started
+            started = time.perf_counter()
+            await asyncio.gather(*(renderer.render(text) for text in texts))
+            cached = time.perf_counter() - started
+            report[name] = (IMAGES_PER_SIZE / rendered, IMAGES_PER_SIZE / cached, images[0])
+        return report
+
+    try:
+        report = asyncio.run(scenario())
+    finally:
+        renderer.close()
+    print()
+    for name, (rendered, cached, image) in report.items():
+        with Image.open(image) as png:
+            assert png.format == "PNG"
+            print(f"{name}（{png.width}x{png.height}）：渲染 {rendered:.0f} 张/秒，命中缓存 {cached:.0f} 张/秒")
+    assert renderer.misses == renderer.hits == IMAGES_PER_SIZE * len(SIZES)
+
+
+def test_concurrent_render_runs_once():
+    renderer = TextRenderer(executor="thread", workers=2)
+
+    async def scenario():
+        return await asyncio.gather(*(renderer.render(_text(15, 0)) for _ in range(10)))
+
+    try:
+        images = asyncio.run(scenario())
+    finally:
+        renderer.close()
+    assert len({image.getvalue() for image in images}) == 1
+    assert renderer.stats()["images"] == 1
+
+
+def test_cache_respects_byte_budget():
+    renderer = TextRenderer(executor="thread", workers=1)
+
+    async def scenario():
+        first = await renderer.render(_text(15, 0))
+        renderer.cache_bytes = len(first.getvalue()) * 3
+        for seed in range(1, 10):
+            await renderer.render(_text(15, seed))
+        await renderer.render(_text(15, 9))
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        renderer.close()
+    stats = renderer.stats()
+    assert stats["bytes"] <= renderer.cache_bytes
+    assert 0 < stats["images"] < 10
+    assert stats["hits"] == 1
+
+
+def test_only_long_text_is_rendered():
+    renderer = TextRenderer(executor="thread", workers=1, min_lines=8, min_length=300)
+
+    async def scenario():
+        return await renderer.render_long(_text(3, 0)), await renderer.render_long(_text(8, 0))
+
+    try:
+        short, long = asyncio.run(scenario())
+    finally:
+        renderer.close()
+    assert short == _text(3, 0)
+    with Image.open(long) as png:
+        assert png.format == "PNG"
+    assert renderer.should_render("字" * 300)
+    assert renderer.stats()["images"] == 1
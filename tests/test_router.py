@@ -0,0 +1,33 @@
+import asyncio
+
+from kikaiken.core.router import LLMRouter, Provider
+
+
+class FakeProvider(Provider):
+    def __init__(self, name: str, delay: float):
+        super().__init__(name, "fake", name, lambda api_key: None)
+        self.delay = delay
+
+    def available(self) -> bool:
+        return True
+
+    async def astream(self, messages):
+        await asyncio.sleep(self.delay)
+        yield self.name
+
+
+def test_hedge_records_loser_ttft(monkeypatch):
+    """
+    对冲请求胜出后，被取消的主请求按已经等待的时间计入首 token 延迟
+    """
+    monkeypatch.setattr("kikaiken.core.router.ROUTER_HEDGE_DEFAULT", 0.05)
+    slow, fast = FakeProvider("slow", 10), FakeProvider("fast", 0.01)
+    router = LLMRouter([slow, fast])
+
+    async def scenario():
+        return [chunk async for chunk in router.astream([])]
+
+    assert asyncio.run(scenario()) == ["fast"]
+    assert fast.wins == 1 and slow.wins == 0
+    assert len(slow.ttft) == 1 and 0.05 <= slow.ttft[0] < 1
+    assert len(fast.ttft) == 1 and fast.ttft[0] < slow.ttft[0]
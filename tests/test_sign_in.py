@@ -0,0 +1,139 @@
+import asyncio
+import datetime
+import math
+import time
+
+import pytest
+from sqlalchemy import text
+
+from kikaiken.core.db_connect import get_read_engine
+from kikaiken.core.economy import Economy
+from kikaiken.core.sign_in import SignInEngine, compute_lucky, compute_reward
+
+USERS = 1000
+
+
+@pytest.fixture(autouse=True)
+def economy(monkeypatch):
+    # 每个测试使用独立的 economy，避免内存中的余额在不同的临时数据库之间串用
+    economy = Economy()
+    monkeypatch.setattr("kikaiken.core.sign_in.economy", economy)
+    return economy
+
+
+async def _scalar(sql: str, **params):
+    async with get_read_engine().connect() as conn:
+        return (await conn.execute(text(sql), params)).scalar()
+
+
+def test_concurrent_sign_in_load(temp_database, economy):
+    """
+    大量用户同时签到，每人重复请求三次：每个用户只签到一次，请求按 batch_size 攒批
+    """
+    engine = SignInEngine(batch_window=0.05, batch_size=200)
+    today = datetime.date.today()
+
+    async def scenario():
+        async with temp_database():
+            started = time.perf_counter()
+            results = await asyncio.gather(*(engine.sign_in(qid) for qid in range(1, USERS + 1) for _ in range(3)))
+            elapsed = time.perf_counter() - started
+            print(f"\n{USERS} 个用户签到，{engine.batches} 批，{USERS / elapsed:.0f} 次/秒")
+            again = await asyncio.gather(*(engine.sign_in(qid) for qid in range(1, 11)))
+            counts = {
+                "signed": await _scalar("SELECT count(*) FROM kikaiken_user WHERE last_sign_date = :day", day=today),
+                "coin": await _scalar("SELECT sum(coin) FROM kikaiken_user"),
+                "ledger": await _scalar("SELECT count(*) FROM kikaiken_coin_ledger WHERE reason = '签到'"),
+                "records": await _scalar("SELECT count(*) FROM kikaiken_user_record"),
+            }
+            return results, again, counts
+
+    results, again, counts = asyncio.run(scenario())
+    rewards = {qid: compute_reward(compute_lucky(qid, today)) for qid in range(1, USERS + 1)}
+    for qid in range(1, USERS + 1):
+        group = results[(qid - 1) * 3:qid * 3]
+        # 同一批中的重复请求共享一个结果，被分到下一批的重复请求会得到“已经签到过”
+        signed = {id(result): result for result in group if result.signed}
+        assert len(signed) == 1
+        result = next(iter(signed.values()))
+        assert result.lucky == compute_lucky(qid, today)
+        assert result.coin == result.balance == rewards[qid]
+    assert engine.signed == USERS
+    # 每批最多 batch_size 个不同的用户，跨批的重复请求最多让每个批次边界多出一个用户
+    assert engine.batches <= math.ceil(USERS / (engine.batch_size - 1)) + 1
+    assert not any(result.signed for result in again)
+    assert counts == {"signed": USERS, "coin": sum(rewards.values()), "ledger": USERS, "records": USERS}
+    assert economy.top(1)[0][1] == max(rewards.values())
+
+
+def test_competing_batches_sign_once(temp_database, economy):
+    """
+    两个签到引擎的批次同时处理同一批用户，条件 UPDATE 保证每个用户只有一次签到生效
+    """
+    first, second = SignInEngine(batch_window=0.01), SignInEngine(batch_window=0.01)
+    qids = range(1, 101)
+
+    async def scenario():
+        async with temp_database():
+            results = await asyncio.gather(*(engine.sign_in(qid) for qid in qids for engine in (first, second)))
+            ledger = await _scalar("SELECT count(*) FROM kikaiken_coin_ledger")
+            return results, ledger
+
+    results, ledger = asyncio.run(scenario())
+    for qid in qids:
+        index = (qid - 1) * 2
+        assert results[index].signed != results[index + 1].signed
+    assert first.signed + second.signed == len(qids)
+    assert ledger == len(qids)
+
+
+def test_failed_grant_rolls_back_sign_in(temp_database, economy, monkeypatch):
+    """
+    发放硬币失败时整批签到回滚，用户可以重新签到
+    """
+    engine = SignInEngine(batch_window=0.01)
+    add_many = economy.add_many
+
+    async def broken(*args, **kwargs):
+        raise RuntimeError("写入流水失败")
+
+    async def scenario():
+        async with temp_database():
+            monkeypatch.setattr(economy, "add_many", broken)
+            with pytest.raises(RuntimeError):
+                await engine.sign_in(1)
+            signed = await _scalar("SELECT count(*) FROM kikaiken_user WHERE last_sign_date IS NOT NULL")
+            monkeypatch.setattr(economy, "add_many", add_many)
+            return signed, await engine.sign_in(1)
+
+    signed, retry = asyncio.run(scenario())
+    assert signed == 0
+    assert retry.signed
+    assert retry.balance == retry.coin
+
+
+def test_cancelled_batch_cancels_waiters(temp_database, economy, monkeypatch):
+    """
+    批次在事务中被取消时，等待中的签到请求随之取消，不会一直挂起
+    """
+    engine = SignInEngine(batch_window=0.01)
+
+    async def stuck(*args, **kwargs):
+        await asyncio.sleep(3600)
+
+    async def scenario():
+        async with temp_database():
+            monkeypatch.setattr(economy, "add_many", stuck)
+            waiters = asyncio.gather(*(engine.sign_in(qid) for qid in (1, 2)), return_exceptions=True)
+            await asyncio.sleep(0.1)
+            assert len(engine._tasks) == 1
+            for task in list(engine._tasks):
+                task.cancel()
+            results = await asyncio.wait_for(waiters, 1)
+            signed = await _scalar("SELECT count(*) FROM kikaiken_user WHERE last_sign_date IS NOT NULL")
+            return results, signed, engine._tasks
+
+    results, signed, tasks = asyncio.run(scenario())
+    assert all(isinstance(result, asyncio.CancelledError) for result in results)
+    assert signed == 0
+    assert not tasks